@@ -1,11 +1,23 @@
 # This is a template.
 # You should modify the functions below to match
 # the signatures determined by the project specification
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Callable, Union
+import atexit
+import functools
+import hashlib
+import heapq
+import json
+import math
 import utils
 import numpy as np
-from matplotlib import pyplot as mat_plot
 import os
+import re
+import struct
+import threading
+import time
+import zlib
 
 
 # -------------------------
@@ -30,14 +42,349 @@ def read_image(file_name: str) -> Union[np.ndarray, None]:
     :param file_name: Name of the image file to load
     :return: 2d numpy array containing image data
     """
+    # matplotlib takes a long time to import, so it is only imported when the first image is read
+    from matplotlib import image as mat_image
+
     try:
-        cwd = os.getcwd()
-        img = mat_plot.imread(f"{cwd}/data/{file_name}")
+        img = mat_image.imread(data_path(file_name))
         return img
     except FileNotFoundError:
         return None
 
 
+def data_path(file_name: str) -> str:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the path of a file in the data directory, the same place read_image looks
+    Absolute paths are returned unchanged
+
+    :param file_name: Name of the file
+    :return: Path to the file
+    """
+
+    return os.path.join(os.getcwd(), "data", file_name)
+
+
+# Most bytes of working memory png_rows uses to unfilter a batch of rows, see unfilter_png_rows
+PNG_UNFILTER_BYTES = 64 * 1024 * 1024
+
+
+def unfilter_png_rows(filter_types: np.ndarray, rows: np.ndarray, prior: np.ndarray, bytes_per_pixel: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Undoes the PNG filters on a batch of rows of an image
+    None, Sub and Up only need the row itself and the row above, so when there are no Average or Paeth rows
+    the rows are done one at a time with whole row numpy operations
+
+    Average and Paeth need the byte to the left, which has to be unfiltered first, so a row can not be done all at once
+    Instead the batch is done along its anti-diagonals: pixel (r, x) only needs (r, x - 1), (r - 1, x) and (r - 1, x - 1),
+    which are all on the two diagonals before it, so every pixel on a diagonal (r + x the same) is done at once
+    That takes rows + width numpy steps for the whole batch, rather than a Python step for every byte of every row
+
+    ---------------
+    General Overview
+    ---------------
+    Copy the batch into a skewed array where column c holds diagonal c - 1 (row r shifted right by r), with the row above
+    the batch as row 0 and a column of zeros to the left of every row
+    For each diagonal work out the predictor of every filter type that is used, pick each row's predictor and add it on
+    Copy the rows back out of the skewed array
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when a filter type is unknown
+
+    :param filter_types: PNG filter type (0 to 4) of each row
+    :param rows: 2d uint8 array of the filtered bytes of each row
+    :param prior: Unfiltered bytes of the row above the batch (all zeros for the first row of the image)
+    :param bytes_per_pixel: Number of bytes in a pixel
+    :return: 2d uint8 array of the unfiltered bytes of each row
+    """
+
+    filter_types = np.asarray(filter_types)
+    if filter_types.size and filter_types.max() > 4:
+        raise ValueError(f"Unknown PNG filter type: {int(filter_types.max())}")
+    count, stride = rows.shape
+    unfiltered = np.empty_like(rows)
+
+    if not np.isin(filter_types, (3, 4)).any():
+        above = np.asarray(prior, dtype=np.uint8)
+        for i in range(count):
+            if filter_types[i] == 0:  # None
+                unfiltered[i] = rows[i]
+            elif filter_types[i] == 1:  # Sub - a running sum of each channel along the row
+                unfiltered[i] = np.cumsum(rows[i].reshape(-1, bytes_per_pixel), axis=0, dtype=np.uint8).ravel()
+            else:  # Up
+                unfiltered[i] = rows[i] + above
+            above = unfiltered[i]
+        return unfiltered
+
+    # skewed[r + x + 1, r] is pixel x of row r, row 0 being the row above the batch, skewed[r, r] is the zero left of row r
+    # Each diagonal is a contiguous row of skewed, it holds the filtered bytes until they are unfiltered in place
+    width = stride // bytes_per_pixel
+    skewed = np.zeros((count + width + 1, count + 1, bytes_per_pixel), dtype=np.int16)
+    column_step, row_step, byte_step = skewed.strides
+    pixels = np.lib.stride_tricks.as_strided(skewed[1:], shape=(count + 1, width, bytes_per_pixel),
+                                             strides=(column_step + row_step, column_step, byte_step))
+    pixels[0] = np.asarray(prior).reshape(width, bytes_per_pixel)
+    pixels[1:] = rows.reshape(count, width, bytes_per_pixel)
+
+    # 1 for the rows of each filter type that is used, so the predictor of a row is a sum of predictors times these
+    is_type = [(filter_types == filter_type).astype(np.int16)[:, np.newaxis] if (filter_types == filter_type).any() else None
+               for filter_type in range(5)]
+    for c in range(2, count + width + 1):
+        # Rows first to last of the batch have a pixel on this diagonal
+        first = max(1, c - width)
+        last = min(count, c - 1)
+        left = skewed[c - 1, first:last + 1]
+        above = skewed[c - 1, first - 1:last]
+        upper_left = skewed[c - 2, first - 1:last]
+
+        predicted = skewed[c, first:last + 1].copy()
+        if is_type[1] is not None:  # Sub
+            predicted += is_type[1][first - 1:last] * left
+        if is_type[2] is not None:  # Up
+            predicted += is_type[2][first - 1:last] * above
+        if is_type[3] is not None:  # Average
+            predicted += is_type[3][first - 1:last] * ((left + above) >> 1)
+        if is_type[4] is not None:  # Paeth - whichever of left, above and upper left is nearest to left + above - upper left
+            above_change = above - upper_left
+            left_change = left - upper_left
+            distance_left = np.abs(above_change)
+            distance_above = np.abs(left_change)
+            distance_upper_left = np.abs(above_change + left_change)
+            paeth = np.where(distance_above <= distance_upper_left, above, upper_left)
+            np.copyto(paeth, left, where=(distance_left <= distance_above) & (distance_left <= distance_upper_left))
+            predicted += is_type[4][first - 1:last] * paeth
+        np.bitwise_and(predicted, 0xFF, out=skewed[c, first:last + 1])
+
+    unfiltered[:] = pixels[1:].reshape(count, stride)
+    return unfiltered
+
+
+def png_rows(path: str, block_rows: int = 256, stop_row: Union[int, None] = None, expand_palette: bool = True):
+    """
+    ---------------
+    Description
+    ---------------
+    Decodes a PNG image a block of rows at a time, so the whole image never has to be in memory
+    Only 8 bit, non-interlaced images are supported, which covers the maps we are given
+    Palette images are expanded to RGB (or RGBA if they have transparency)
+
+    ---------------
+    General Overview
+    ---------------
+    Read the chunks of the file in order
+    Feed the compressed image data into a decompressor as it is read, a batch of rows at most at a time
+    Whenever a whole batch of rows has been decompressed, unfilter it (see unfilter_png_rows)
+    Yield the batch a block at a time
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when the file is not a PNG or uses a format that is not supported
+
+    :param path: Path to the PNG file
+    :param block_rows: Number of rows in each block
+    :param stop_row: Stop decoding once this row is reached, None decodes the whole image
+    :param expand_palette: False gives the palette index of each pixel of a palette image rather than its colour
+    :return: Generator of (first row of block, uint8 array of shape (rows, width, channels))
+    """
+
+    channels_for_colour_type = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    with open(path, 'rb') as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            raise ValueError("File is not a PNG image")
+
+        width = height = channels = None
+        palette = None
+        transparency = None
+        decompressor = zlib.decompressobj()
+        buffer = bytearray()
+        row_number = 0
+        prior = None
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("PNG image ends before its IEND chunk")
+            length, chunk_type = struct.unpack(">I4s", header)
+            data = f.read(length)
+            f.read(4)  # CRC
+
+            if chunk_type == b"IHDR":
+                width, height, bit_depth, colour_type, _, _, interlace = struct.unpack(">IIBBBBB", data)
+                if bit_depth != 8 or interlace != 0 or colour_type not in channels_for_colour_type:
+                    raise ValueError("Only 8 bit non-interlaced PNG images can be decoded by rows")
+                channels = channels_for_colour_type[colour_type]
+                stride = width * channels
+                prior = np.zeros(stride, dtype=np.uint8)
+                if stop_row is None or stop_row > height:
+                    stop_row = height
+                # Rows are unfiltered in batches of whole blocks, as large as PNG_UNFILTER_BYTES allows, since each batch of
+                # Average or Paeth rows takes a numpy step for every column as well as every row (see unfilter_png_rows)
+                # The skewed array of a batch of b rows is (b + 1) * (b + 1 + width) * channels int16s, solve for b
+                limit = PNG_UNFILTER_BYTES // (2 * channels)
+                batch_rows = (math.isqrt(width * width + 4 * limit) - width) // 2 - 1
+                batch_rows = max(block_rows, batch_rows // block_rows * block_rows)
+
+            elif chunk_type == b"PLTE":
+                palette = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+
+            elif chunk_type == b"tRNS" and palette is not None:
+                transparency = np.full(palette.shape[0], 255, dtype=np.uint8)
+                transparency[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+            elif chunk_type == b"IDAT":
+                while data and row_number < stop_row:
+                    # Decompress at most a batch of rows at a time, so a large chunk is never decompressed all at once
+                    buffer += decompressor.decompress(data, batch_rows * (stride + 1))
+                    data = decompressor.unconsumed_tail
+                    # Each row is a filter type byte followed by the row's bytes
+                    while len(buffer) >= min(batch_rows, stop_row - row_number) * (stride + 1):
+                        count = min(batch_rows, stop_row - row_number)
+                        filtered = np.frombuffer(bytes(buffer[:count * (stride + 1)]), dtype=np.uint8).reshape(count, stride + 1)
+                        del buffer[:count * (stride + 1)]
+                        unfiltered = unfilter_png_rows(filtered[:, 0], filtered[:, 1:], prior, channels)
+                        prior = unfiltered[-1]
+
+                        for start in range(0, count, block_rows):
+                            rows = unfiltered[start:start + block_rows].reshape(-1, width, channels)
+                            if palette is not None and expand_palette:
+                                rows = palette[rows[:, :, 0]] if transparency is None else \
+                                    np.concatenate([palette[rows[:, :, 0]], transparency[rows[:, :, 0], np.newaxis]], axis=2)
+                            yield row_number + start, rows
+                        row_number += count
+                        if row_number == stop_row:
+                            return
+
+            elif chunk_type == b"IEND":
+                return
+
+
+def image_blocks(file_name: str, block_rows: int = 256, stop_row: Union[int, None] = None):
+    """
+    ---------------
+    Description
+    ---------------
+    Reads an image from the data directory a block of rows at a time as uint8 RGB(A) values (0 to 255)
+    PNG images are decoded by rows (see png_rows), anything else is read whole with read_image and then split up
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when a PNG image turns out to be broken after some of its rows have been given out
+    FileNotFoundError when the image can not be read
+
+    :param file_name: Name of the image file in the data directory
+    :param block_rows: Number of rows in each block
+    :param stop_row: Stop once this row is reached, None reads the whole image
+    :return: Generator of (first row of block, uint8 array of shape (rows, width, channels))
+    """
+
+    path = data_path(file_name)
+    yielded = False
+    try:
+        for first_row, rows in png_rows(path, block_rows, stop_row):
+            # Grey images are repeated into RGB so the colour predicates can be used on them
+            if rows.shape[2] <= 2:
+                rows = np.concatenate([rows[:, :, :1]] * 3 + [rows[:, :, 1:]], axis=2)
+            yielded = True
+            yield first_row, rows
+        return
+    except ValueError:
+        # Once rows have been given out, starting again from row 0 would give them out twice
+        if yielded:
+            raise
+
+    img = read_image(file_name)
+    if img is None:
+        raise FileNotFoundError(path)
+    if img.dtype.kind == "f":
+        img = np.round(img * 255).astype(np.uint8)
+    img = img[:stop_row]
+    for first_row in range(0, img.shape[0], block_rows):
+        yield first_row, img[first_row:first_row + block_rows]
+
+
+def load_image(file_name: str, region: Union[tuple, None] = None, step: int = 1) -> Union[np.ndarray, None]:
+    """
+    ---------------
+    Description
+    ---------------
+    Reads part of an image, or a smaller version of it, as uint8 values (0 to 255) rather than float32 (0 to 1)
+    Only the rows up to the end of the region are decoded, and only the pixels that are kept are stored
+    Every step-th pixel is taken (rather than averaging blocks of pixels) so the colours of the map are not blended
+
+    The last few images loaded are cached by their path, modification time, region and step,
+    so a changed image is always read again
+    The cached arrays are read only, copy one before changing it
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when step is less than 1 or the region does not overlap the image
+
+    :param file_name: Name of the image file in the data directory
+    :param region: (min_x, min_y, max_x, max_y) rows and columns to read (inclusive), None reads the whole image
+    :param step: Take every step-th row and column
+    :return: uint8 array of shape (rows, columns, channels), None if the file is not found
+    """
+
+    path = data_path(file_name)
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if region is not None:
+        region = tuple(int(value) for value in region)
+
+    return decode_image(path, modified, region, int(step))
+
+
+@functools.lru_cache(maxsize=8)
+def decode_image(path: str, modified: int, region: Union[tuple, None], step: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Decodes the region of an image for load_image, the result is cached by all of the arguments
+
+    :param path: Path to the image
+    :param modified: Modification time of the image, only used as part of the cache key
+    :param region: (min_x, min_y, max_x, max_y) rows and columns to read (inclusive), None reads the whole image
+    :param step: Take every step-th row and column
+    :return: Read only uint8 array of shape (rows, columns, channels)
+    """
+
+    if step < 1:
+        raise ValueError("Step must be at least 1")
+    height, width = image_shape(path)
+    min_x, min_y, max_x, max_y = region if region is not None else (0, 0, height - 1, width - 1)
+    # Clip the region to the image, then make the ends exclusive
+    min_x, min_y = max(min_x, 0), max(min_y, 0)
+    stop_x, stop_y = min(max_x, height - 1) + 1, min(max_y, width - 1) + 1
+    if min_x >= stop_x or min_y >= stop_y:
+        raise ValueError("Region does not overlap the image")
+
+    blocks = []
+    for first_row, rows in image_blocks(path, stop_row=stop_x):
+        # First row of this block that is in the region and a multiple of step from its start
+        start = max(min_x, first_row)
+        start += -(start - min_x) % step
+        if start < first_row + rows.shape[0]:
+            blocks.append(rows[start - first_row:stop_x - first_row:step, min_y:stop_y:step])
+
+    image = np.concatenate(blocks)
+    image.flags.writeable = False
+    return image
+
+
 def red_pixel_condition(map_file: np.array, upper_threshold: int, lower_threshold: int, x: int, y: int) -> bool:
     """
     ---------------
@@ -99,41 +446,346 @@ def top_two_condition(map_file: np.array, upper_threshold: int, lower_threshold:
     return False
 
 
-def filter_pixels(map_file: np.array, upper_threshold: int, lower_threshold: int, condition_valid_pixel: Callable) -> np.array:
+def red_pixel_mask(map_file: np.array, upper_threshold: int, lower_threshold: int) -> np.ndarray:
     """
     ---------------
     Description
     ---------------
-    Will filter pixels into a binary image based on a condition
+    Whole image version of red_pixel_condition
+    Evaluates every pixel for being red in one vectorised operation
+
+    :param map_file: Array containing map data
+    :param upper_threshold: Value of the upper threshold
+    :param lower_threshold: Value of the lower threshold
+    :return: 2d boolean array, True where the pixel is red
+    """
+
+    red = map_file[:, :, 0] > upper_threshold
+    green = map_file[:, :, 1] < lower_threshold
+    blue = map_file[:, :, 2] < lower_threshold
+    return red & green & blue
+
+
+def cyan_pixel_mask(map_file: np.array, upper_threshold: int, lower_threshold: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Whole image version of cyan_pixel_condition
+    Evaluates every pixel for being cyan in one vectorised operation
+
+    :param map_file: Array containing map data
+    :param upper_threshold: Value of the upper threshold
+    :param lower_threshold: Value of the lower threshold
+    :return: 2d boolean array, True where the pixel is cyan
+    """
+
+    red = map_file[:, :, 0] < upper_threshold
+    green = map_file[:, :, 1] > lower_threshold
+    blue = map_file[:, :, 2] > lower_threshold
+    return red & green & blue
+
+
+def top_two_mask(map_file: np.array, upper_threshold: int, lower_threshold: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Whole image version of top_two_condition
+    Evaluates every pixel for being either the upper or lower threshold in one vectorised operation
+
+    :param map_file: Array containing map data
+    :param upper_threshold: Value of first valid pixel
+    :param lower_threshold: Value of second valid pixel
+    :return: 2d boolean array, True where the pixel is either value
+    """
+
+    return (map_file == upper_threshold) | (map_file == lower_threshold)
+
+
+# Per pixel conditions that have a whole image equivalent
+# filter_pixels uses these so that it does not have to call the condition for every pixel
+VECTORISED_CONDITIONS = {
+    red_pixel_condition: red_pixel_mask,
+    cyan_pixel_condition: cyan_pixel_mask,
+    top_two_condition: top_two_mask
+}
+
+
+def pixel_mask(map_file: np.array, upper_threshold: int, lower_threshold: int, condition: Callable) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Evaluates a condition for every pixel in the image and returns the result as a boolean mask
+    The condition can either be a whole image predicate (e.g. red_pixel_mask) or a per pixel condition (e.g. red_pixel_condition)
+    Per pixel conditions with a whole image equivalent in VECTORISED_CONDITIONS are swapped for it,
+    any other per pixel condition is called for each pixel in turn
 
     ---------------
     General Overview
     ---------------
-    Create empty np array to store binary pixels
-    For each pixel
-    If it satisfies the condition, add it to the binary image
+    If the condition is a whole image predicate, call it once
+    If it is a per pixel condition with a whole image equivalent, call that once
+    Otherwise call the condition for each pixel
 
     :param map_file: Numpy array containing the map
-    :param upper_threshold: Upper threshold to consider that a pixel has a big enough value for either R, G or B
-    :param lower_threshold: Lower threshold to consider that a pixel has a small enough value for either R, G or B
-    :param condition_valid_pixel: Function that will use the thresholds to identify a colour
-    :return: ndarry containing a binary representation of the image with only the valid colours present
+    :param upper_threshold: Upper threshold passed to the condition
+    :param lower_threshold: Lower threshold passed to the condition
+    :param condition: Whole image predicate or per pixel condition
+    :return: 2d boolean array, True where the condition holds
     """
 
-    # Get the dimensions of the image
+    map_file = np.asarray(map_file)
+    condition = VECTORISED_CONDITIONS.get(condition, condition)
+    if condition in VECTORISED_CONDITIONS.values():
+        return np.asarray(condition(map_file, upper_threshold, lower_threshold), dtype=bool)
+
+    # Compatibility fallback for per pixel conditions that have no whole image version
     width = map_file.shape[0]
     height = map_file.shape[1]
-    empty_map_file = np.zeros((width, height, 3))
-    # For each pixel in the image
+    mask = np.zeros((width, height), dtype=bool)
     for x in range(width):
         for y in range(height):
-            # Check if the RGB values of the pixel satisfy the condition to be filtered
-            if condition_valid_pixel(map_file, upper_threshold, lower_threshold, x, y):
-                empty_map_file[x, y] = np.array([255, 255, 255])  # White pixel
-            else:
-                empty_map_file[x, y] = np.array([0, 0, 0])  # Black pixel
+            mask[x, y] = condition(map_file, upper_threshold, lower_threshold, x, y)
+
+    return mask
+
+
+def build_colour_lut(rules: list, bits: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Builds a lookup table giving the class of every RGB colour, so any number of colour classes
+    can be found with one pass over an image (see classify_pixels)
+    Rules are (condition, upper threshold, lower threshold), e.g. (red_pixel_condition, 100, 50)
+    A colour's class is the number of the first rule it meets (rule 0 is class 1), 0 if it meets none
+
+    With 8 bits per channel the table has an entry for every colour (16 MB) and gives exactly the same answer as the conditions
+    With fewer bits the colours are grouped into bins and each bin gets the class of the colour in its centre,
+    this makes a smaller table but pixels close to a threshold can be given the wrong class
+
+    ---------------
+    General Overview
+    ---------------
+    Go through the colour cube one red value (or bin) at a time
+    Evaluate each rule for every green and blue value at once with pixel_mask
+    Give colours that have no class yet the class of each rule they meet
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when bits is not 1 to 8 or there are more than 255 rules
+
+    :param rules: List of (condition, upper threshold, lower threshold)
+    :param bits: Number of bits of each channel used to index the table
+    :return: 1d uint8 array with 2 ** (3 * bits) entries
+    """
+
+    if not 1 <= bits <= 8:
+        raise ValueError("Bits must be between 1 and 8")
+    if len(rules) > 255:
+        raise ValueError("There can be at most 255 rules")
+
+    levels = 1 << bits
+    shift = 8 - bits
+    # Value in the middle of each bin, which is the value itself with 8 bits
+    centres = (np.arange(levels) << shift) + ((1 << shift) >> 1)
+    green, blue = np.meshgrid(centres, centres, indexing='ij')
+
+    lut = np.zeros(levels ** 3, dtype=np.uint8)
+    colours = np.empty((levels * levels, 1, 3), dtype=np.uint8)
+    colours[:, 0, 1] = green.ravel()
+    colours[:, 0, 2] = blue.ravel()
+    for red in range(levels):
+        colours[:, 0, 0] = centres[red]
+        classes = np.zeros(levels * levels, dtype=np.uint8)
+        # Go through the rules backwards so the first rule a colour meets is the one that is kept
+        for number in range(len(rules), 0, -1):
+            condition, upper_threshold, lower_threshold = rules[number - 1]
+            classes[pixel_mask(colours, upper_threshold, lower_threshold, condition)[:, 0]] = number
+        lut[red * levels * levels:(red + 1) * levels * levels] = classes
+
+    return lut
+
+
+def classify_pixels(map_file: np.ndarray, lut: np.ndarray, bits: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Gives every pixel of an image its colour class by looking its colour up in a table from build_colour_lut
+
+    :param map_file: Array of the map, either 0 to 255 values (e.g. read_image(...) * 255) or uint8
+    :param lut: Lookup table from build_colour_lut
+    :param bits: Number of bits the table was built with
+    :return: 2d uint8 array of the class of each pixel
+    """
+
+    map_file = np.asarray(map_file)
+    if map_file.dtype != np.uint8:
+        map_file = np.clip(np.rint(map_file[:, :, :3]), 0, 255).astype(np.uint8)
+    shift = 8 - bits
+    red = (map_file[:, :, 0] >> shift).astype(np.intp)
+    green = (map_file[:, :, 1] >> shift).astype(np.intp)
+    blue = (map_file[:, :, 2] >> shift).astype(np.intp)
+    return lut[(red << (2 * bits)) | (green << bits) | blue]
+
+
+def segment_map(file_name: str, rules: list, bits: int = 8, block_rows: int = 256) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Classifies every pixel of a map in the data directory by the colour rules in one pass,
+    reading and classifying the image a block of rows at a time (see image_blocks)
+
+    :param file_name: Name of the map
+    :param rules: List of (condition, upper threshold, lower threshold), see build_colour_lut
+    :param bits: Number of bits of each channel used to index the lookup table
+    :param block_rows: Number of rows read at a time
+    :return: 2d uint8 array of the class of each pixel
+    """
+
+    lut = build_colour_lut(rules, bits)
+    width, height = image_shape(file_name)
+    classes = np.zeros((width, height), dtype=np.uint8)
+    for first_row, rows in image_blocks(file_name, block_rows):
+        classes[first_row:first_row + rows.shape[0]] = classify_pixels(rows, lut, bits)
+
+    return classes
+
+
+class BinaryMask:
+    """
+    ---------------
+    Description
+    ---------------
+    Binary image where each pixel is either on (white) or off (black)
+    Pixels are stored as a 2d bool array (1 byte per pixel) rather than a (width, height, 3) float64 RGB array (24 bytes per pixel)
+    A bit packed copy (1 bit per pixel) can be made with pack for storing or sending the mask
+
+    The RGB form that filter_pixels used to return is only made when it is asked for,
+    either through to_rgb (e.g. when writing an image) or by numpy through __array__,
+    so code written for the RGB array keeps working
+    """
+
+    def __init__(self, mask: np.ndarray):
+        """
+        :param mask: 2d array, non-zero pixels are on
+        """
+        self.mask = np.asarray(mask, dtype=bool)
+
+    @property
+    def shape(self) -> tuple:
+        """
+        :return: Shape of the RGB form of the mask, (width, height, 3)
+        """
+        return self.mask.shape[0], self.mask.shape[1], 3
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: Number of bytes used to store the mask
+        """
+        return self.mask.nbytes
+
+    def to_rgb(self) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Makes the RGB form of the mask, white (255) where the mask is on and black (0) elsewhere
+
+        :return: uint8 array of shape (width, height, 3)
+        """
+        rgb = np.zeros(self.shape, dtype=np.uint8)
+        rgb[self.mask] = 255
+        return rgb
+
+    def pack(self) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Packs the mask into bits, 8 pixels per byte
+        The shape is needed to unpack it again, see from_packed
+
+        :return: 1d uint8 array of packed bits
+        """
+        return np.packbits(self.mask, axis=None)
+
+    @classmethod
+    def from_packed(cls, packed: np.ndarray, shape: tuple) -> "BinaryMask":
+        """
+        ---------------
+        Description
+        ---------------
+        Rebuilds a mask from the output of pack
+
+        :param packed: Packed bits from pack
+        :param shape: (width, height) of the mask
+        :return: The unpacked mask
+        """
+        count = shape[0] * shape[1]
+        return cls(np.unpackbits(packed, count=count).reshape(shape[0], shape[1]))
+
+    def __array__(self, dtype=None, copy=None):
+        """
+        Lets numpy treat the mask as its RGB form
+        """
+        rgb = self.to_rgb()
+        return rgb if dtype is None else rgb.astype(dtype)
+
+
+def as_binary_mask(img) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets a 2d bool array out of any of the forms a binary image is passed around in
+
+    ---------------
+    General Overview
+    ---------------
+    If it is a BinaryMask, return its mask
+    If it is an RGB array, pixels are on where the first channel is 255
+    If it is 2d, pixels are on where they are not 0
+
+    :param img: BinaryMask, (width, height, 3) RGB array or 2d array
+    :return: 2d bool array
+    """
+
+    if isinstance(img, BinaryMask):
+        return img.mask
+    img = np.asarray(img)
+    if img.ndim == 3:
+        return img[:, :, 0] >= 255
+    return img != 0
+
+
+def filter_pixels(map_file: np.array, upper_threshold: int, lower_threshold: int, condition_valid_pixel: Callable) -> BinaryMask:
+    """
+    ---------------
+    Description
+    ---------------
+    Will filter pixels into a binary image based on a condition
+
+    ---------------
+    General Overview
+    ---------------
+    Find the pixels that satisfy the condition as a boolean mask (see pixel_mask)
+    Wrap it in a BinaryMask, valid pixels are white and the rest are black
+
+    :param map_file: Numpy array containing the map
+    :param upper_threshold: Upper threshold to consider that a pixel has a big enough value for either R, G or B
+    :param lower_threshold: Lower threshold to consider that a pixel has a small enough value for either R, G or B
+    :param condition_valid_pixel: Function that will use the thresholds to identify a colour
+    :return: BinaryMask containing a binary representation of the image with only the valid colours present
+    """
 
-    return empty_map_file
+    return BinaryMask(pixel_mask(map_file, upper_threshold, lower_threshold, condition_valid_pixel))
 
 
 def push_queue(queue: np.array, value, tail: int) -> np.array:
@@ -220,97 +872,2519 @@ def countvalue_2d(array: np.array, xw):
     :return: Number of xw instances
     """
 
-    # Holds the number of occurrences of xw found in values
-    xw_count = 0
-    # For each element in values, if it is equal to xw, add 1 to xw_count
-    for row in array:
-        xw_count += utils.countvalue(row, xw)
-
-    return xw_count
+    # Counts over the whole array in one pass rather than a pass per row
+    return utils.countvalues_array(array, [xw])[xw]
 
 
-# -------------------------
-# Template Functions
-# -------------------------
-
-def find_red_pixels(map_filename, upper_threshold=100, lower_threshold=50):
+def shifted_slices(length: int, offset: int) -> tuple:
     """
     ---------------
     Description
     ---------------
-    Finds all the red pixels in the input image and saves them to a binary png file
-    If, at a pixel, r > Upper Threshold and g < Lower Threshold
-    and b < Lower Threshold, this pixel is red.
+    Makes two slices along one axis so that element i of the first lines up with element i + offset of the second
 
-    :param lower_threshold: Lower threshold for considering an RGB value in a pixel to be valid
-    :param upper_threshold: Upper threshold for considering an RGB value in a pixel to be valid
-    :param map_filename: Name of the map to load
-    :return: An array containing all the binary pixels
+    :param length: Length of the axis
+    :param offset: Offset of the second slice
+    :return: Tuple of (first slice, second slice)
     """
 
-    # Load the image
-    map_file = read_image(map_filename) * 255
-    # Get all red pixels from the image
-    new_map = filter_pixels(map_file, upper_threshold, lower_threshold, red_pixel_condition)
+    if offset < 0:
+        return slice(-offset, length), slice(0, length + offset)
+    return slice(0, length - offset), slice(offset, length)
 
-    # Save the binary image array as a jpg file
-    mat_plot.imsave("map-red-pixels.jpg", np.uint8(new_map))
 
-    return new_map
-
-
-def find_cyan_pixels(map_filename, upper_threshold, lower_threshold):
+def neighbour_pairs(mask: np.ndarray, connectivity: int = 8) -> list:
     """
     ---------------
     Description
     ---------------
-    Finds all the cyan pixels in the input image and saves them to a binary png file
-    If, at a pixel, r < Lower Threshold and
-    g > Upper Threshold and b > Upper Threshold, this pixel is cyan
+    Finds every pair of on pixels that are neighbours, looking back in raster scan order
+    These are the pairs the first pass of the two pass algorithm would compare, found with array slices instead of a loop
 
-    :param lower_threshold: Lower threshold for considering an RGB value in a pixel to be valid
-    :param upper_threshold: Upper threshold for considering an RGB value in a pixel to be valid
-    :param map_filename: Name of the map to load
-    :return: An array containing all the binary pixels
+    ---------------
+    General Overview
+    ---------------
+    For the west and north neighbour (and north-west and north-east for 8-connectivity)
+    Line up the image with a copy of itself shifted by that offset
+    Keep the places where both pixels are on
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when connectivity is not 4 or 8
+
+    :param mask: 2d bool array of on pixels
+    :param connectivity: 4 or 8
+    :return: List of (pixel slice, neighbour slice) pairs of 2d slices into mask, one for each neighbour direction
     """
 
-    # Load the image
-    map_file = read_image(map_filename) * 255
-    # Get all cyan pixels from the image
-    new_map = filter_pixels(map_file, upper_threshold, lower_threshold, cyan_pixel_condition)
+    if connectivity == 4:
+        offsets = [(0, -1), (-1, 0)]
+    elif connectivity == 8:
+        offsets = [(0, -1), (-1, -1), (-1, 0), (-1, 1)]
+    else:
+        raise ValueError("Connectivity must be 4 or 8")
 
-    # Save the binary image array as a jpg file
-    mat_plot.imsave("map-cyan-pixels.jpg", np.uint8(new_map))
+    pairs = []
+    for dx, dy in offsets:
+        # Slices that line up each pixel with its neighbour at (x + dx, y + dy)
+        pixel_x, neighbour_x = shifted_slices(mask.shape[0], dx)
+        pixel_y, neighbour_y = shifted_slices(mask.shape[1], dy)
+        pairs.append(((pixel_x, pixel_y), (neighbour_x, neighbour_y)))
 
-    return new_map
+    return pairs
 
 
-def detect_connected_components(img):
+def find_roots(parent: np.ndarray) -> np.ndarray:
     """
     ---------------
     Description
     ---------------
-    Detects all of the connected components in the input image
-    Gives each connected component a number and counts the number of pixels in the component
-    Writes the output to a txt file called cc-output-2a.txt
+    Compresses every path in a union-find parent array so each label points straight at its root
+    Done for all labels at once by pointer jumping (parent = parent[parent]) until nothing changes
 
-    :param img: Numpy array containing binary image to find connected components for
-    :return: 2D array MARK
+    :param parent: Parent array of the union-find, modified in place
+    :return: The parent array, now holding the root of every label
     """
 
-    # Gets the width and height of the input image
-    img_width = img.shape[0]
-    img_height = img.shape[1]
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent[:] = grandparent
 
-    # List to store lines to write to cc-output-2a.txt (modification to original algorithm)
-    output_strings = []
-    # Two variables to hold the number of the component that is currently being processed and the number of pixels in the component (modification to original algorithm)
-    component_number = 0
-    current_component_pixel_count = 0
 
-    # Set all elements in MARK as unvisited, i.e., 0.
-    # When a pixel is visited it will be marked in MARK with its component number (modification to original algorithm)
-    mark = np.zeros((img_width, img_height), dtype=int)
+def union_labels(parent: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Merges the union-find sets of each pair of labels (a[i], b[i])
+    The root of a set is always its smallest label, so labels given in raster order keep the first pixel as the root
+
+    ---------------
+    General Overview
+    ---------------
+    Compress the paths so every label points at its root
+    Drop the pairs that are already in the same set
+    Point the larger root of each remaining pair at the smaller root
+    Repeat until every pair is in the same set
+
+    :param parent: Parent array of the union-find where parent[i] <= i, modified in place
+    :param a: Labels of the first item of each pair
+    :param b: Labels of the second item of each pair
+    :return: The parent array, holding the root of every label
+    """
+
+    while True:
+        find_roots(parent)
+        root_a = parent[a]
+        root_b = parent[b]
+        different = root_a != root_b
+        if not different.any():
+            return parent
+
+        # Only pairs that are still in different sets need looking at again
+        a = a[different]
+        b = b[different]
+        root_a = root_a[different]
+        root_b = root_b[different]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+
+def label_union_find(mask: np.ndarray, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels the connected components of a binary image with the two pass union-find algorithm
+
+    First pass: every on pixel gets a provisional label (its position in raster order) and
+    each pixel is unioned with its already scanned neighbours
+    Second pass: every provisional label is replaced by its root, renumbered 1, 2, 3... in raster order
+
+    Both passes are done with whole array operations rather than a loop over the pixels,
+    the union-find uses path compression (see find_roots and union_labels)
+    A binary image is a class image with one class, so the work is done by label_classes
+
+    :param mask: 2d bool array of on pixels
+    :param connectivity: 4 or 8
+    :return: 2D array MARK, 0 for off pixels and the component number for on pixels
+    """
+
+    mark, _ = label_classes(np.asarray(mask, dtype=bool).view(np.uint8), connectivity)
+    return mark
+
+
+def label_classes(classes: np.ndarray, connectivity: int = 8) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels the connected components of every class in a class image (e.g. from classify_pixels) at the same time
+    Neighbouring pixels are only connected when they have the same class, class 0 is the background
+    Components of all classes are numbered together in raster order, use class_mark to get the MARK of one class
+
+    Uses the two pass union-find algorithm described in label_union_find
+
+    :param classes: 2d array of the class of each pixel
+    :param connectivity: 4 or 8
+    :return: Tuple of (2D array MARK, array where element i is the class of component i + 1)
+    """
+
+    classes = np.asarray(classes)
+    mask = classes != 0
+    mark = np.zeros(classes.shape, dtype=int)
+
+    # First pass - provisional labels in raster order
+    on_pixels = np.flatnonzero(mask)
+    provisional = np.full(classes.shape, -1, dtype=np.int64)
+    provisional.ravel()[on_pixels] = np.arange(on_pixels.size)
+
+    parent = np.arange(on_pixels.size)
+    pixel_labels = []
+    neighbour_labels = []
+    for pixel, neighbour in neighbour_pairs(mask, connectivity):
+        same_class = mask[pixel] & (classes[pixel] == classes[neighbour])
+        pixel_labels.append(provisional[pixel][same_class])
+        neighbour_labels.append(provisional[neighbour][same_class])
+    if pixel_labels:
+        union_labels(parent, np.concatenate(pixel_labels), np.concatenate(neighbour_labels))
+
+    # Second pass - roots are the first pixel of each component, so numbering them in order gives raster order numbering
+    roots = find_roots(parent)
+    is_root = roots == np.arange(on_pixels.size)
+    component_number = np.cumsum(is_root)
+    mark.ravel()[on_pixels] = component_number[roots]
+    component_class = classes.ravel()[on_pixels[is_root]]
+
+    return mark, component_class
+
+
+def class_mark(mark: np.ndarray, component_class: np.ndarray, class_number: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the MARK of one class from the output of label_classes
+    This is the same as labelling a binary image of just that class
+
+    :param mark: MARK from label_classes
+    :param component_class: Class of each component from label_classes
+    :param class_number: Class to get the MARK of
+    :return: 2D array MARK of the class, numbered 1, 2, 3... in raster order
+    """
+
+    in_class = component_class == class_number
+    renumber = np.zeros(component_class.size + 1, dtype=mark.dtype)
+    renumber[1:][in_class] = np.arange(1, np.count_nonzero(in_class) + 1)
+    return renumber[mark]
+
+
+class RunLabels:
+    """
+    ---------------
+    Description
+    ---------------
+    Connected component labels stored as runs rather than as a dense MARK array
+    A run is a horizontal stretch of on pixels in one row of the image, pixels [start, end) of that row
+    Road maps are mostly background so there are far fewer runs than pixels
+    Runs are stored in raster order, the dense MARK is only made when to_mark is called
+    """
+
+    def __init__(self, shape: tuple, rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, labels: np.ndarray):
+        """
+        :param shape: (width, height) of the image
+        :param rows: Row of each run
+        :param starts: First pixel of each run
+        :param ends: One past the last pixel of each run
+        :param labels: Component number of each run
+        """
+        self.shape = shape
+        self.rows = rows
+        self.starts = starts
+        self.ends = ends
+        self.labels = labels
+
+    @property
+    def component_count(self) -> int:
+        """
+        :return: Number of connected components
+        """
+        return int(self.labels.max()) if self.labels.size > 0 else 0
+
+    def sizes(self) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Counts the number of pixels in each component from the lengths of its runs
+
+        :return: Array where element i is the number of pixels in component i + 1
+        """
+        lengths = self.ends - self.starts
+        return np.bincount(self.labels, weights=lengths, minlength=self.component_count + 1)[1:].astype(int)
+
+    def to_mark(self) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Makes the dense MARK array
+        Each run adds its label at its start and takes it away at its end, a running sum along each row then fills the run in
+
+        :return: 2D array MARK
+        """
+        steps = np.zeros((self.shape[0], self.shape[1] + 1), dtype=int)
+        steps[self.rows, self.starts] += self.labels
+        steps[self.rows, self.ends] -= self.labels
+        return np.cumsum(steps, axis=1)[:, :self.shape[1]]
+
+
+def encode_runs(mask: np.ndarray) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Run length encodes each row of a binary image
+
+    ---------------
+    General Overview
+    ---------------
+    Take the difference between neighbouring pixels along each row, with an off pixel either side of the row
+    A run starts where the difference is +1 and ends where it is -1
+
+    :param mask: 2d bool array of on pixels
+    :return: Tuple of (rows, starts, ends) arrays, one element per run in raster order
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    steps = np.diff(mask.view(np.int8), axis=1, prepend=0, append=0)
+    start_rows, starts = np.nonzero(steps == 1)
+    end_rows, ends = np.nonzero(steps == -1)
+
+    return start_rows, starts, ends
+
+
+def label_runs(mask: np.ndarray, connectivity: int = 8) -> RunLabels:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels the connected components of a binary image using its runs
+    Runs in neighbouring rows that overlap (or touch diagonally for 8-connectivity) are unioned,
+    so the work done depends on the number of runs rather than the number of pixels
+    Components are numbered in raster order, the same as the other engines
+
+    ---------------
+    General Overview
+    ---------------
+    Run length encode the rows
+    For each run, find the range of runs in the row above that it overlaps with
+    Union the overlapping runs
+    Number the root runs in raster order and give each run its root's number
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when connectivity is not 4 or 8
+
+    :param mask: 2d bool array of on pixels
+    :param connectivity: 4 or 8
+    :return: RunLabels holding the runs and their component numbers
+    """
+
+    if connectivity not in (4, 8):
+        raise ValueError("Connectivity must be 4 or 8")
+    mask = np.asarray(mask, dtype=bool)
+    rows, starts, ends = encode_runs(mask)
+
+    # Runs in a row do not overlap, so putting the row into the key keeps the keys of all runs sorted
+    # The gap between rows is wide enough that reaching one pixel past either end never crosses into another row
+    row_stride = mask.shape[1] + 3
+    start_keys = rows * row_stride + starts
+    end_keys = rows * row_stride + ends
+    # Runs touch diagonally with 8-connectivity, so reach one pixel further either side
+    reach = 1 if connectivity == 8 else 0
+
+    # Runs in the row above overlap this run if they end after its start and start before its end
+    above = (rows - 1) * row_stride
+    first = np.searchsorted(end_keys, above + starts - reach, side='right')
+    last = np.searchsorted(start_keys, above + ends + reach, side='left')
+    overlaps = np.maximum(last - first, 0)
+
+    # Turn each range [first, last) into a list of (run, run above) pairs
+    run = np.repeat(np.arange(rows.size), overlaps)
+    offsets = np.arange(run.size) - np.repeat(np.cumsum(overlaps) - overlaps, overlaps)
+    run_above = np.repeat(first, overlaps) + offsets
+
+    parent = union_labels(np.arange(rows.size), run, run_above)
+    is_root = parent == np.arange(rows.size)
+    labels = np.cumsum(is_root)[parent]
+
+    return RunLabels(mask.shape, rows, starts, ends, labels)
+
+
+def label_rle(mask: np.ndarray, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Labelling engine wrapper around label_runs that returns the dense MARK
+
+    :param mask: 2d bool array of on pixels
+    :param connectivity: 4 or 8
+    :return: 2D array MARK
+    """
+
+    return label_runs(mask, connectivity).to_mark()
+
+
+def component_statistics(mark: np.ndarray) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Works out a table of statistics for every component in MARK in one vectorised pass
+    The table is a dictionary of columns, row i of every column is about component i + 1:
+    • label - Component number
+    • size - Number of pixels
+    • min_x, max_x, min_y, max_y - Bounding box (inclusive)
+    • extent_x, extent_y - Number of rows and columns the component spans
+    • centroid_x, centroid_y - Mean position of the component's pixels
+    • first_pixel - Position of the component's first pixel in raster order (x * height + y)
+
+    ---------------
+    General Overview
+    ---------------
+    Find the position and label of every pixel in a component
+    Count pixels and add up positions per label with bincount
+    Find the smallest and largest positions per label
+
+    :param mark: 2D array MARK
+    :return: Dictionary of column name -> numpy array
+    """
+
+    mark = np.asarray(mark)
+    x, y = np.nonzero(mark)
+    labels = mark[x, y]
+    count = int(labels.max()) if labels.size > 0 else 0
+
+    size = np.bincount(labels, minlength=count + 1)[1:]
+    # Labels that do not appear (there are none in a MARK from detect_connected_components) get a centroid of 0
+    divisor = np.maximum(size, 1)
+    stats = {
+        'label': np.arange(1, count + 1),
+        'size': size,
+        'centroid_x': np.bincount(labels, weights=x, minlength=count + 1)[1:] / divisor,
+        'centroid_y': np.bincount(labels, weights=y, minlength=count + 1)[1:] / divisor
+    }
+    for name, position, ufunc, start in [('min_x', x, np.minimum, mark.shape[0]), ('max_x', x, np.maximum, -1),
+                                         ('min_y', y, np.minimum, mark.shape[1]), ('max_y', y, np.maximum, -1)]:
+        column = np.full(count + 1, start, dtype=np.int64)
+        ufunc.at(column, labels, position)
+        stats[name] = column[1:]
+    stats['extent_x'] = stats['max_x'] - stats['min_x'] + 1
+    stats['extent_y'] = stats['max_y'] - stats['min_y'] + 1
+    first_pixel = np.full(count + 1, mark.size, dtype=np.int64)
+    np.minimum.at(first_pixel, labels, x.astype(np.int64) * mark.shape[1] + y)
+    stats['first_pixel'] = first_pixel[1:]
+
+    return stats
+
+
+def top_components(stats: dict, k: Union[int, None] = None) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Finds the k largest components in a table from component_statistics, largest first
+    Components of the same size are ordered by component number
+    Only the top k are sorted, the rest are split off with a partition in linear time
+
+    :param stats: Table from component_statistics
+    :param k: Number of components to return, None returns them all
+    :return: Rows of the table of the k largest components, largest first
+    """
+
+    size = stats['size']
+    # Combine size (largest first) and row (smallest first) into one key so ties are broken by component number
+    key = -size.astype(np.int64) * (size.size + 1) + np.arange(size.size)
+    if k is None or k >= size.size:
+        return np.argsort(key)
+
+    top = np.argpartition(key, k)[:k] if k > 0 else np.zeros(0, dtype=int)
+    return top[np.argsort(key[top])]
+
+
+def distance_transform(mask: np.ndarray) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Exact Euclidean distance transform of a binary image
+    For every pixel, finds the distance to the nearest on pixel and where that pixel is
+    Runs in linear time using the separable lower envelope of parabolas method (Felzenszwalb and Huttenlocher)
+
+    ---------------
+    General Overview
+    ---------------
+    Down each column, find the nearest on pixel in that column (a sweep in each direction)
+    Along each row, the squared distance to an on pixel in column j is (y - j)^2 + (column distance at j)^2,
+    which is a parabola in y, so find the lower envelope of those parabolas
+    Read the distance and nearest column off the envelope for every pixel
+    Every row is worked on at once, stepping along the columns
+
+    ---------------
+    Memory
+    ---------------
+    Positions are int32, the squared distances and envelope starts stay float64 as float32 is not exact for them on large maps
+    Every full size array is made once and filled in place, about 40 bytes a pixel including the output
+
+    :param mask: 2d bool array of on pixels
+    :return: Tuple of (float64 distance array, int32 nearest x array, int32 nearest y array),
+             distance is inf and nearest is -1 if there are no on pixels
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    width, height = mask.shape
+    distances = np.full(mask.shape, np.inf)
+    nearest_x = np.full(mask.shape, -1, dtype=np.int32)
+    nearest_y = np.full(mask.shape, -1, dtype=np.int32)
+    if mask.size == 0 or not mask.any():
+        return distances, nearest_x, nearest_y
+
+    # Down each column - row of the nearest on pixel, swept forwards then backwards
+    column_nearest = np.full(mask.shape, -1, dtype=np.int32)
+    last = np.full(height, -1, dtype=np.int32)
+    for x in range(width):
+        last = np.where(mask[x], x, last)
+        column_nearest[x] = last
+    last = np.full(height, -1, dtype=np.int32)
+    for x in range(width - 1, -1, -1):
+        last = np.where(mask[x], x, last)
+        closer = (last >= 0) & ((column_nearest[x] < 0) | (last - x < x - column_nearest[x]))
+        column_nearest[x] = np.where(closer, last, column_nearest[x])
+
+    # Squared column distances, a column with no on pixels gets a value bigger than any real squared distance
+    no_pixel = float(width * width + height * height + 1)
+    f = np.empty(mask.shape)
+    np.subtract(np.arange(width, dtype=float)[:, np.newaxis], column_nearest, out=f)
+    np.square(f, out=f)
+    f[column_nearest < 0] = no_pixel
+
+    # Along each row - lower envelope of the parabolas, v holds the column of each parabola and z where it starts
+    rows = np.arange(width)
+    k = np.zeros(width, dtype=np.int64)
+    v = np.zeros((width, height), dtype=np.int32)
+    z = np.full((width, height + 1), np.inf)
+    z[:, 0] = -np.inf
+
+    def intersection(q, active):
+        vk = v[active, k[active]].astype(np.int64)
+        return ((f[active, q] + q * q) - (f[active, vk] + vk * vk)) / (2 * q - 2 * vk)
+
+    for q in range(1, height):
+        active = rows
+        s = intersection(q, active)
+        # Pop parabolas that are now hidden by the new one, rows pop different numbers of times
+        hidden = s <= z[active, k[active]]
+        while hidden.any():
+            active = active[hidden]
+            k[active] -= 1
+            s_active = intersection(q, active)
+            s[active] = s_active
+            hidden = s_active <= z[active, k[active]]
+        k += 1
+        v[rows, k] = q
+        z[rows, k] = s
+        z[rows, k + 1] = np.inf
+
+    # Read off the parabola that is lowest at each column
+    k = np.zeros(width, dtype=np.int64)
+    for q in range(height):
+        passed = z[rows, k + 1] < q
+        while passed.any():
+            k[passed] += 1
+            passed = z[rows, k + 1] < q
+        vk = v[rows, k].astype(np.int64)
+        squared = (q - vk) ** 2 + f[rows, vk]
+        found = squared < no_pixel
+        distances[found, q] = np.sqrt(squared[found])
+        nearest_y[found, q] = vk[found]
+        nearest_x[found, q] = column_nearest[rows[found], vk[found]]
+
+    return distances, nearest_x, nearest_y
+
+
+class RoadDistances:
+    """
+    ---------------
+    Description
+    ---------------
+    Distance from every pixel of a map to the nearest road pixel (on pixel of a mask, e.g. from find_red_pixels),
+    and where that road pixel is, so a point (e.g. a monitoring station) can be joined to the road network in O(1)
+    Only the position of the nearest road pixel is stored (as int32), distances are worked out from it when they are asked for
+
+    Use road_distances to get the distances of a mask, which works out the distance transform once per mask
+    """
+
+    def __init__(self, nearest_x: np.ndarray, nearest_y: np.ndarray):
+        """
+        :param nearest_x: x of the nearest road pixel to each pixel, -1 if there are no road pixels
+        :param nearest_y: y of the nearest road pixel to each pixel, -1 if there are no road pixels
+        """
+        self.nearest_x = np.asarray(nearest_x, dtype=np.int32)
+        self.nearest_y = np.asarray(nearest_y, dtype=np.int32)
+
+    @property
+    def distances(self) -> np.ndarray:
+        """
+        Distance from every pixel to the nearest road pixel, worked out from the nearest positions each time (it is not stored)
+        :return: 2d float array, inf if there are no road pixels
+        """
+        x, y = np.indices(self.nearest_x.shape, dtype=np.int32, sparse=True)
+        return self.distances_at(x, y)
+
+    def distances_at(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        :param xs: x of each point (row), inside the map
+        :param ys: y of each point (column), inside the map
+        :return: Distance from each point to its nearest road pixel, inf if there are no road pixels
+        """
+        nearest_x = self.nearest_x[xs, ys]
+        nearest_y = self.nearest_y[xs, ys]
+        return np.where(nearest_x >= 0, np.hypot(xs - nearest_x, ys - nearest_y), np.inf)
+
+    @classmethod
+    def from_mask(cls, mask) -> "RoadDistances":
+        """
+        :param mask: BinaryMask or anything as_binary_mask accepts
+        :return: Distances to the on pixels of the mask, see distance_transform
+        """
+        _, nearest_x, nearest_y = distance_transform(as_binary_mask(mask))
+        return cls(nearest_x, nearest_y)
+
+    def query(self, xs, ys) -> tuple:
+        """
+        ---------------
+        Description
+        ---------------
+        Finds the nearest road pixel to each point
+
+        ---------------
+        Raises
+        ---------------
+        ValueError when a point is outside the map
+
+        :param xs: x of each point (row)
+        :param ys: y of each point (column)
+        :return: Tuple of (distances, nearest x, nearest y) arrays, inf and -1 if there are no road pixels
+        """
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        width, height = self.nearest_x.shape
+        if ((xs < 0) | (xs >= width) | (ys < 0) | (ys >= height)).any():
+            raise ValueError("Points must be inside the map")
+        return self.distances_at(xs, ys), self.nearest_x[xs, ys], self.nearest_y[xs, ys]
+
+    def save(self, path: str):
+        """
+        Saves the nearest road pixels to a compressed .npz file
+        :param path: Path of the file
+        :return: None
+        """
+        np.savez_compressed(path, nearest_x=self.nearest_x, nearest_y=self.nearest_y)
+
+    @classmethod
+    def load(cls, path: str) -> "RoadDistances":
+        """
+        :param path: Path of a file written by save
+        :return: The loaded distances
+        """
+        with np.load(path) as data:
+            return cls(data['nearest_x'], data['nearest_y'])
+
+
+# Distances of the masks road_distances has been asked for most recently, keyed by a hash of the mask
+DISTANCE_CACHE = OrderedDict()
+DISTANCE_CACHE_SIZE = 8
+
+
+def road_distances(mask) -> RoadDistances:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the distance from every pixel to the nearest on pixel of a mask (e.g. the roads from find_red_pixels)
+    The distances of the last DISTANCE_CACHE_SIZE masks are kept, keyed by a hash of the mask's pixels,
+    so asking again for the same mask (even a different array with the same pixels) does not work them out again
+
+    :param mask: BinaryMask or anything as_binary_mask accepts
+    :return: RoadDistances of the mask
+    """
+
+    mask = as_binary_mask(mask)
+    key = hashlib.sha256(np.packbits(mask, axis=None).tobytes() + str(mask.shape).encode()).hexdigest()
+    if key in DISTANCE_CACHE:
+        DISTANCE_CACHE.move_to_end(key)
+        return DISTANCE_CACHE[key]
+
+    distances = RoadDistances.from_mask(mask)
+    DISTANCE_CACHE[key] = distances
+    while len(DISTANCE_CACHE) > DISTANCE_CACHE_SIZE:
+        DISTANCE_CACHE.popitem(last=False)
+    return distances
+
+
+# Largest number of grid cells a bounding box can cover and still be listed in each cell, see ComponentIndex.build_box_grid
+BOX_GRID_MAX_CELLS = 256
+
+
+class ComponentIndex:
+    """
+    ---------------
+    Description
+    ---------------
+    Answers questions about where components are, built once from MARK
+    • component_at / components_at - Which component is at a pixel, O(1) per point
+    • components_in_box - Which components have a bounding box overlapping a box, using a grid of buckets of bounding boxes
+    • nearest_road_pixel - Where the nearest component pixel is and how far away, O(1) per point from a precomputed distance transform
+      (only the position of the nearest pixel is kept, as int32, see RoadDistances)
+
+    The index can be saved to a compressed .npz file and loaded again without relabelling the map
+    """
+
+    def __init__(self, mark: np.ndarray, nearest_x: Union[np.ndarray, None] = None, nearest_y: Union[np.ndarray, None] = None):
+        """
+        ---------------
+        Raises
+        ---------------
+        ValueError when only one of nearest_x and nearest_y is given, or they are not the same shape as MARK
+
+        :param mark: 2D array MARK
+        :param nearest_x: x of the nearest component pixel to each pixel (see distance_transform), None works it out
+        :param nearest_y: y of the nearest component pixel to each pixel, None works it out
+        """
+        self.mark = np.asarray(mark)
+        if (nearest_x is None) != (nearest_y is None):
+            raise ValueError("nearest_x and nearest_y must be given together")
+        if nearest_x is None:
+            self.roads = road_distances(self.mark > 0)
+        else:
+            self.roads = RoadDistances(nearest_x, nearest_y)
+            if self.roads.nearest_x.shape != self.mark.shape or self.roads.nearest_y.shape != self.mark.shape:
+                raise ValueError("nearest_x and nearest_y must be the same shape as MARK")
+        self.stats = component_statistics(self.mark)
+        self.build_box_grid()
+
+    @property
+    def nearest_x(self) -> np.ndarray:
+        """
+        :return: x of the nearest component pixel to each pixel, -1 if there are no components
+        """
+        return self.roads.nearest_x
+
+    @property
+    def nearest_y(self) -> np.ndarray:
+        """
+        :return: y of the nearest component pixel to each pixel, -1 if there are no components
+        """
+        return self.roads.nearest_y
+
+    @property
+    def distances(self) -> np.ndarray:
+        """
+        Distance from every pixel to the nearest component pixel, worked out each time as only the nearest positions are stored
+        :return: 2d float array, inf if there are no components
+        """
+        return self.roads.distances
+
+    def build_box_grid(self):
+        """
+        ---------------
+        Description
+        ---------------
+        Builds the bounding box index, a grid of square cells where each cell lists the components whose bounding box overlaps it
+        There are about as many cells as components, so a query only looks at the few components in the cells it covers
+        Components covering more than BOX_GRID_MAX_CELLS cells (e.g. long roads) are kept in a separate list
+        that every query looks at, so they do not fill every cell
+
+        ---------------
+        General Overview
+        ---------------
+        Pick the cell size so there is about one cell per component
+        Find the range of cells each bounding box covers
+        Make one (cell, component) pair for every cell of every box, all at once with repeat
+        Sort the pairs by cell, so the components of each cell (and of a run of cells along a row of the grid) are contiguous
+
+        :return: None
+        """
+        width, height = self.mark.shape
+        count = self.stats['label'].size
+        self.cell_size = max(1, math.ceil(math.sqrt(width * height / max(1, count))))
+        self.grid_rows = max(1, -(-width // self.cell_size))
+        self.grid_columns = max(1, -(-height // self.cell_size))
+
+        first_x = self.stats['min_x'] // self.cell_size
+        first_y = self.stats['min_y'] // self.cell_size
+        span_x = self.stats['max_x'] // self.cell_size - first_x + 1
+        span_y = self.stats['max_y'] // self.cell_size - first_y + 1
+        cells = span_x * span_y
+        large = cells > BOX_GRID_MAX_CELLS
+        self.large_boxes = np.flatnonzero(large)
+        cells[large] = 0
+
+        # Position of each pair within its component's box of cells, read across the rows of the box
+        component = np.repeat(np.arange(count), cells)
+        position = np.arange(component.size) - np.repeat(np.cumsum(cells) - cells, cells)
+        cell = (first_x[component] + position // span_y[component]) * self.grid_columns + first_y[component] + position % span_y[component]
+
+        order = np.argsort(cell, kind="stable")
+        self.cell_components = component[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(self.grid_rows * self.grid_columns + 1))
+
+    def component_at(self, x: int, y: int) -> int:
+        """
+        :param x: Row of the pixel
+        :param y: Column of the pixel
+        :return: Component number at the pixel, 0 if it is not in a component
+        """
+        return int(self.mark[x, y])
+
+    def components_at(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Vectorised component_at for many points at once
+
+        :param xs: Rows of the pixels
+        :param ys: Columns of the pixels
+        :return: Component number at each pixel, 0 if it is not in a component
+        """
+        return self.mark[np.asarray(xs), np.asarray(ys)]
+
+    def components_in_box(self, min_x: int, min_y: int, max_x: int, max_y: int) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Finds the components whose bounding box overlaps the box [min_x, max_x] x [min_y, max_y] (inclusive)
+        Only the components listed in the grid cells the box covers (and the large components) are checked, see build_box_grid
+
+        :param min_x: First row of the box
+        :param min_y: First column of the box
+        :param max_x: Last row of the box
+        :param max_y: Last column of the box
+        :return: Component numbers, in order
+        """
+        width, height = self.mark.shape
+        if max_x < 0 or max_y < 0 or min_x >= width or min_y >= height or min_x > max_x or min_y > max_y:
+            return np.zeros(0, dtype=self.stats['label'].dtype)
+
+        # Cells covered by the box, the cells of one row of the grid are next to each other in cell_components
+        first_y = max(min_y, 0) // self.cell_size
+        last_y = min(max_y, height - 1) // self.cell_size
+        candidates = [self.large_boxes]
+        for cell_x in range(max(min_x, 0) // self.cell_size, min(max_x, width - 1) // self.cell_size + 1):
+            row_start = cell_x * self.grid_columns
+            candidates.append(self.cell_components[self.cell_start[row_start + first_y]:self.cell_start[row_start + last_y + 1]])
+        # A box covering several cells is listed in each of them
+        candidates = np.unique(np.concatenate(candidates))
+
+        overlapping = (self.stats['min_x'][candidates] <= max_x) & \
+                      (self.stats['max_x'][candidates] >= min_x) & \
+                      (self.stats['min_y'][candidates] <= max_y) & \
+                      (self.stats['max_y'][candidates] >= min_y)
+        return np.sort(self.stats['label'][candidates[overlapping]])
+
+    def nearest_road_pixel(self, x: int, y: int) -> tuple:
+        """
+        :param x: Row of the pixel
+        :param y: Column of the pixel
+        :return: Tuple of (x, y, distance) of the nearest component pixel, (-1, -1, inf) if there are no components
+        """
+        return int(self.nearest_x[x, y]), int(self.nearest_y[x, y]), float(self.roads.distances_at(x, y))
+
+    def nearest_component(self, x: int, y: int) -> int:
+        """
+        :param x: Row of the pixel
+        :param y: Column of the pixel
+        :return: Component number of the nearest component pixel, 0 if there are no components
+        """
+        nearest_x, nearest_y, distance = self.nearest_road_pixel(x, y)
+        return 0 if nearest_x < 0 else self.component_at(nearest_x, nearest_y)
+
+    def save(self, path: str):
+        """
+        ---------------
+        Description
+        ---------------
+        Saves the index to a compressed .npz file
+
+        :param path: Path to save to
+        :return: None
+        """
+        np.savez_compressed(path, mark=self.mark, nearest_x=self.nearest_x, nearest_y=self.nearest_y)
+
+    @classmethod
+    def load(cls, path: str) -> "ComponentIndex":
+        """
+        ---------------
+        Description
+        ---------------
+        Loads an index saved with save
+
+        :param path: Path of the .npz file
+        :return: The loaded index
+        """
+        with np.load(path) as data:
+            return cls(data['mark'], data['nearest_x'], data['nearest_y'])
+
+
+def skeletonise(mask: np.ndarray) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Thins a binary image down to lines one pixel wide, keeping the shape of each component (Zhang-Suen thinning)
+    Each sub-iteration is worked out for the whole image at once
+
+    ---------------
+    General Overview
+    ---------------
+    Repeat until nothing changes:
+    Find the 8 neighbours of every pixel (P2 is north, going clockwise to P9 north-west)
+    Remove boundary pixels with 2 to 6 neighbours, a single 0 -> 1 transition around them
+    and no neighbour on the south-east side (first sub-iteration) or north-west side (second sub-iteration)
+
+    :param mask: 2d bool array of on pixels
+    :return: 2d bool array of the skeleton
+    """
+
+    skeleton = np.pad(np.asarray(mask, dtype=bool), 1)
+    width, height = skeleton.shape
+
+    def neighbours(img):
+        # P2 to P9, clockwise from north
+        offsets = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+        return [img[1 + dx:width - 1 + dx, 1 + dy:height - 1 + dy] for dx, dy in offsets]
+
+    changed = True
+    while changed:
+        changed = False
+        for sub_iteration in range(2):
+            p = neighbours(skeleton)
+            count = sum(n.astype(np.int8) for n in p)
+            transitions = sum((~p[i] & p[(i + 1) % 8]).astype(np.int8) for i in range(8))
+            p2, p3, p4, p5, p6, p7, p8, p9 = p
+            if sub_iteration == 0:
+                side = ~(p2 & p4 & p6) & ~(p4 & p6 & p8)
+            else:
+                side = ~(p2 & p4 & p8) & ~(p2 & p6 & p8)
+            centre = skeleton[1:-1, 1:-1]
+            remove = centre & (count >= 2) & (count <= 6) & (transitions == 1) & side
+            if remove.any():
+                centre[remove] = False
+                changed = True
+
+    return skeleton[1:-1, 1:-1]
+
+
+class RoadGraph:
+    """
+    ---------------
+    Description
+    ---------------
+    Graph of the roads in a map, made by build_road_graph
+    Nodes are the junctions and dead ends of the skeleton of each component, edges are the stretches of road between them
+    Routing over the graph is much cheaper than a breadth first search over every pixel
+
+    • node_x, node_y - Position of each node (the centre of its skeleton pixels)
+    • node_component - Component number from MARK of each node
+    • adjacency - For each node, a dictionary of neighbouring node -> length of the road to it
+    """
+
+    def __init__(self, node_x: np.ndarray, node_y: np.ndarray, node_component: np.ndarray, edges: list):
+        """
+        :param node_x: Row of each node
+        :param node_y: Column of each node
+        :param node_component: Component number of each node
+        :param edges: List of (node, node, length) tuples
+        """
+        self.node_x = node_x
+        self.node_y = node_y
+        self.node_component = node_component
+        self.adjacency = [{} for i in range(node_x.size)]
+        for a, b, length in edges:
+            a, b, length = int(a), int(b), float(length)
+            # Keep the shortest road if two nodes are joined more than once
+            if a != b and length < self.adjacency[a].get(b, np.inf):
+                self.adjacency[a][b] = length
+                self.adjacency[b][a] = length
+
+    @property
+    def node_count(self) -> int:
+        """
+        :return: Number of nodes
+        """
+        return self.node_x.size
+
+    @property
+    def edge_count(self) -> int:
+        """
+        :return: Number of edges
+        """
+        return sum(len(neighbours) for neighbours in self.adjacency) // 2
+
+    def nearest_node(self, x: float, y: float, component: Union[int, None] = None) -> int:
+        """
+        ---------------
+        Description
+        ---------------
+        Finds the node closest to a point, optionally only looking at nodes in one component
+
+        :param x: Row of the point
+        :param y: Column of the point
+        :param component: Component number to look in, None looks at every node
+        :return: Node number, -1 if there are no nodes to choose from
+        """
+        distances = np.hypot(self.node_x - x, self.node_y - y)
+        if component is not None:
+            distances[self.node_component != component] = np.inf
+        if distances.size == 0 or np.isinf(distances.min()):
+            return -1
+        return int(np.argmin(distances))
+
+    def shortest_path(self, start: int, end: int) -> tuple:
+        """
+        ---------------
+        Description
+        ---------------
+        Finds the shortest route between two nodes with the A* search
+        The straight line distance to the end node is used as the heuristic,
+        edge lengths are never shorter than the straight line between their nodes so the route found is the shortest
+
+        ---------------
+        General Overview
+        ---------------
+        Put the start node in a priority queue, ordered by distance so far plus straight line distance to the end
+        Take the node with the lowest estimate off the queue
+        If it is the end node, follow the previous nodes back to the start
+        Otherwise update the distance to each of its neighbours and add them to the queue
+
+        :param start: Node to start at
+        :param end: Node to finish at
+        :return: Tuple of (length, list of nodes on the route), (inf, []) if there is no route
+        """
+
+        def heuristic(node):
+            return float(np.hypot(self.node_x[node] - self.node_x[end], self.node_y[node] - self.node_y[end]))
+
+        distance = {start: 0.0}
+        previous = {}
+        queue = [(heuristic(start), start)]
+        visited = set()
+        while queue:
+            estimate, node = heapq.heappop(queue)
+            if node in visited:
+                continue
+            if node == end:
+                route = [end]
+                while route[-1] != start:
+                    route.append(previous[route[-1]])
+                return distance[end], route[::-1]
+            visited.add(node)
+
+            for neighbour, length in self.adjacency[node].items():
+                new_distance = distance[node] + length
+                if new_distance < distance.get(neighbour, np.inf):
+                    distance[neighbour] = new_distance
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_distance + heuristic(neighbour), neighbour))
+
+        return np.inf, []
+
+    def route(self, start_x: int, start_y: int, end_x: int, end_y: int) -> tuple:
+        """
+        ---------------
+        Description
+        ---------------
+        Finds the shortest route between two points on the map
+        Each point is snapped to the nearest node, the end point is snapped to a node in the same component as the start
+
+        :param start_x: Row of the start point
+        :param start_y: Column of the start point
+        :param end_x: Row of the end point
+        :param end_y: Column of the end point
+        :return: Tuple of (length, list of (x, y) node positions on the route), (inf, []) if there is no route
+        """
+        start = self.nearest_node(start_x, start_y)
+        if start < 0:
+            return np.inf, []
+        end = self.nearest_node(end_x, end_y, self.node_component[start])
+        length, nodes = self.shortest_path(start, end)
+        return length, [(float(self.node_x[node]), float(self.node_y[node])) for node in nodes]
+
+
+def build_road_graph(mark: np.ndarray) -> RoadGraph:
+    """
+    ---------------
+    Description
+    ---------------
+    Builds a RoadGraph from the components found by detect_connected_components
+
+    ---------------
+    General Overview
+    ---------------
+    Skeletonise the components
+    Skeleton pixels without exactly two neighbours are junctions or dead ends, touching ones are grouped into a node
+    The rest of the skeleton is split into stretches of road, each joining the nodes at its ends
+    The length of a stretch is the length of the skeleton along it, diagonal steps counting sqrt(2)
+    (diagonal steps with a pixel in the corner are skipped, since the path goes round the corner)
+
+    :param mark: 2D array MARK
+    :return: RoadGraph of the components
+    """
+
+    mark = np.asarray(mark)
+    skeleton = skeletonise(mark > 0)
+
+    # Count the skeleton neighbours of every pixel
+    degree = np.zeros(mark.shape, dtype=np.int8)
+    for pixel, neighbour in neighbour_pairs(skeleton, 8):
+        both = (skeleton[pixel] & skeleton[neighbour]).astype(np.int8)
+        degree[pixel] += both
+        degree[neighbour] += both
+
+    node_labels = label_union_find(skeleton & (degree != 2), 8)
+    stretch_labels = label_union_find(skeleton & (degree == 2), 8)
+    node_count = int(node_labels.max()) if node_labels.size > 0 else 0
+    stretch_count = int(stretch_labels.max()) if stretch_labels.size > 0 else 0
+
+    # A stretch that touches no node is a loop of road on its own, give it a node so it is in the graph
+    stretch_pixel_x, stretch_pixel_y = np.nonzero(stretch_labels)
+    stretch_first = np.full(stretch_count + 1, -1, dtype=np.int64)
+    stretch_first[stretch_labels[stretch_pixel_x, stretch_pixel_y][::-1]] = np.arange(stretch_pixel_x.size)[::-1]
+
+    # Go through every pair of neighbouring skeleton pixels, adding up stretch lengths and which nodes each stretch touches
+    stretch_length = np.zeros(stretch_count + 1)
+    touches = []
+    node_to_node = []
+    for pixel, neighbour in neighbour_pairs(skeleton, 8):
+        both = skeleton[pixel] & skeleton[neighbour]
+        dx = pixel[0].start - neighbour[0].start
+        dy = pixel[1].start - neighbour[1].start
+        if dx != 0 and dy != 0:
+            # Skip diagonal steps that go past a corner pixel
+            corner_a = skeleton[pixel[0], neighbour[1]]
+            corner_b = skeleton[neighbour[0], pixel[1]]
+            both &= ~corner_a & ~corner_b
+        step = float(np.hypot(dx, dy))
+
+        pixel_stretch, neighbour_stretch = stretch_labels[pixel][both], stretch_labels[neighbour][both]
+        pixel_node, neighbour_node = node_labels[pixel][both], node_labels[neighbour][both]
+        # Steps inside a stretch, or between a stretch and a node, are part of the stretch
+        np.add.at(stretch_length, np.maximum(pixel_stretch, neighbour_stretch), step)
+        touches.append(np.stack([pixel_stretch, neighbour_node]))
+        touches.append(np.stack([neighbour_stretch, pixel_node]))
+        # Steps straight from one node to another are their own edge
+        between_nodes = (pixel_node > 0) & (neighbour_node > 0) & (pixel_node != neighbour_node)
+        node_to_node.append(np.stack([pixel_node[between_nodes], neighbour_node[between_nodes]]))
+
+    touches = np.concatenate(touches, axis=1) if touches else np.zeros((2, 0), dtype=np.int64)
+    touches = np.unique(touches[:, (touches[0] > 0) & (touches[1] > 0)], axis=1)
+
+    # Nodes for the junctions and dead ends, and for loops with no junction
+    stats = component_statistics(node_labels)
+    node_x = list(stats['centroid_x'])
+    node_y = list(stats['centroid_y'])
+    node_pixel_x, node_pixel_y = np.nonzero(node_labels)
+    node_component = np.zeros(node_count, dtype=np.int64)
+    node_component[node_labels[node_pixel_x, node_pixel_y] - 1] = mark[node_pixel_x, node_pixel_y]
+    node_component = list(node_component)
+
+    stretch_nodes = [[] for i in range(stretch_count + 1)]
+    for stretch, node in touches.T:
+        stretch_nodes[stretch].append(node - 1)
+    for stretch in range(1, stretch_count + 1):
+        if not stretch_nodes[stretch]:
+            x, y = stretch_pixel_x[stretch_first[stretch]], stretch_pixel_y[stretch_first[stretch]]
+            node_x.append(float(x))
+            node_y.append(float(y))
+            node_component.append(int(mark[x, y]))
+    node_x = np.array(node_x, dtype=float)
+    node_y = np.array(node_y, dtype=float)
+
+    # Edges, never shorter than the straight line between their nodes so A* stays exact
+    edges = []
+    for stretch in range(1, stretch_count + 1):
+        nodes = stretch_nodes[stretch]
+        for i in range(len(nodes)):
+            for j in range(i + 1, len(nodes)):
+                straight = float(np.hypot(node_x[nodes[i]] - node_x[nodes[j]], node_y[nodes[i]] - node_y[nodes[j]]))
+                edges.append((nodes[i], nodes[j], max(stretch_length[stretch], straight)))
+    for a, b in np.concatenate(node_to_node, axis=1).T if node_to_node else []:
+        straight = float(np.hypot(node_x[a - 1] - node_x[b - 1], node_y[a - 1] - node_y[b - 1]))
+        edges.append((a - 1, b - 1, max(straight, 1.0)))
+
+    return RoadGraph(node_x, node_y, np.array(node_component, dtype=np.int64), edges)
+
+
+def relabel_incremental(old_mask: np.ndarray, old_mark: np.ndarray, new_mask: np.ndarray, old_stats: Union[dict, None] = None,
+                        halo: int = 1, connectivity: int = 8) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Updates MARK after a change to a small area of the map, without labelling the whole map again
+    Only the window around the change is labelled, so the work depends on the size of the change rather than the map
+    MARK and the statistics table are updated in place (a read only MARK, e.g. from AnalysisCache, is copied first)
+    The components and their statistics are the same as labelling the new mask from scratch, but components keep their
+    numbers where they can rather than being numbered in raster order again (sort by first_pixel for raster order)
+
+    ---------------
+    General Overview
+    ---------------
+    Find the window around the changed pixels, grown by the halo, so the pixels on its edge have not changed
+    Label the old and new masks inside the window, the pieces
+    A component crossing the edge of the window might have been split if two of its edge pixels were in one old piece
+    but are in different new pieces, they may still be joined outside the window, so grow the window and start again
+    Join each new piece to the components it touches on the edge of the window with union-find
+    Work out the statistics of each joined group from its pieces and the parts of its components outside the window
+    Each group keeps the number of its largest component, so the fewest pixels are written again,
+    new groups take the numbers freed by removed or joined components, and the highest numbered components
+    are moved into any numbers left over so components are still numbered 1 to the number of components
+    Write the new numbers into the window and the components that were joined or moved
+
+    :param old_mask: Previous 2d bool array of on pixels
+    :param old_mark: MARK of the previous mask, updated in place
+    :param new_mask: New 2d bool array of on pixels
+    :param old_stats: Table from component_statistics for old_mark, updated in place, None works it out
+    :param halo: Number of pixels to grow the changed area by (at least 1)
+    :param connectivity: 4 or 8
+    :return: Tuple of (new MARK, new statistics table)
+    """
+
+    old_mask = np.asarray(old_mask, dtype=bool)
+    new_mask = np.asarray(new_mask, dtype=bool)
+    mark = np.asarray(old_mark)
+    if not mark.flags.writeable:
+        mark = mark.copy()
+    stats = component_statistics(mark) if old_stats is None else old_stats
+    width, height = mark.shape
+
+    changed_x, changed_y = np.nonzero(old_mask != new_mask)
+    if changed_x.size == 0:
+        return mark, stats
+
+    # The changed area, grown by the halo so the pixels on the edge of the window are never changed ones
+    halo = max(halo, 1)
+    x0, x1 = max(int(changed_x.min()) - halo, 0), min(int(changed_x.max()) + halo + 1, width)
+    y0, y1 = max(int(changed_y.min()) - halo, 0), min(int(changed_y.max()) + halo + 1, height)
+    while True:
+        window_mark = mark[x0:x1, y0:y1]
+        # Pixels on the sides of the window that have neighbours outside it (not the sides on the edge of the map)
+        edge = np.zeros(window_mark.shape, dtype=bool)
+        edge[0] |= x0 > 0
+        edge[-1] |= x1 < width
+        edge[:, 0] |= y0 > 0
+        edge[:, -1] |= y1 < height
+        edge_x, edge_y = np.nonzero(edge & (window_mark > 0))
+        edge_labels = window_mark[edge_x, edge_y]
+        # Only components with pixels outside the window are joined to the pieces, the rest are labelled again whole
+        rows = edge_labels - 1
+        crossing = (stats['min_x'][rows] < x0) | (stats['max_x'][rows] >= x1) | (stats['min_y'][rows] < y0) | (stats['max_y'][rows] >= y1)
+        edge_x, edge_y, edge_labels = edge_x[crossing], edge_y[crossing], edge_labels[crossing]
+
+        old_pieces = label_union_find(old_mask[x0:x1, y0:y1], connectivity)
+        new_pieces = label_union_find(new_mask[x0:x1, y0:y1], connectivity)
+        # Unique (old piece, new piece) pairs of the edge pixels, an old piece in more than one pair has been split
+        pairs = np.unique(np.stack([old_pieces[edge_x, edge_y], new_pieces[edge_x, edge_y]]), axis=1)
+        split = np.isin(old_pieces[edge_x, edge_y], pairs[0, 1:][pairs[0, 1:] == pairs[0, :-1]])
+        if not split.any():
+            break
+        # Double the window, but no further than the suspect components, until the split pieces meet again inside it
+        # (e.g. round the block from a closed road) or the suspects are wholly inside and labelled again whole
+        suspects = np.unique(edge_labels[split]) - 1
+        size_x, size_y = x1 - x0, y1 - y0
+        x0 = max(x0 - size_x, min(x0, int(stats['min_x'][suspects].min())))
+        x1 = min(x1 + size_x, max(x1, int(stats['max_x'][suspects].max()) + 1))
+        y0 = max(y0 - size_y, min(y0, int(stats['min_y'][suspects].min())))
+        y1 = min(y1 + size_y, max(y1, int(stats['max_y'][suspects].max()) + 1))
+
+    # Union-find over the new pieces (1 to piece_count) and then the crossing components
+    # A group's root is always a piece, as every crossing component touches a piece on the edge and pieces come first
+    piece_count = int(new_pieces.max())
+    crossing_labels, edge_crossing = np.unique(edge_labels, return_inverse=True)
+    crossing_count = crossing_labels.size
+    parent = union_labels(np.arange(piece_count + crossing_count + 1), new_pieces[edge_x, edge_y], edge_crossing + piece_count + 1)
+    group_roots, piece_group = np.unique(parent[1:piece_count + 1], return_inverse=True)
+    crossing_group = np.searchsorted(group_roots, parent[piece_count + 1:])
+    group_count = group_roots.size
+
+    # Statistics of the parts of the crossing components outside the window, size and sums by taking away the part inside
+    rows = crossing_labels - 1
+    old_box = {name: stats[name][rows].copy() for name in ['min_x', 'max_x', 'min_y', 'max_y']}
+    inside_x, inside_y = np.nonzero(np.isin(window_mark, crossing_labels))
+    inside_index = np.searchsorted(crossing_labels, window_mark[inside_x, inside_y])
+    outside = {
+        'size': stats['size'][rows] - np.bincount(inside_index, minlength=crossing_count),
+        'sum_x': stats['centroid_x'][rows] * stats['size'][rows] - np.bincount(inside_index, weights=inside_x + x0, minlength=crossing_count),
+        'sum_y': stats['centroid_y'][rows] * stats['size'][rows] - np.bincount(inside_index, weights=inside_y + y0, minlength=crossing_count),
+        'first_pixel': stats['first_pixel'][rows].copy(),
+        **{name: column.copy() for name, column in old_box.items()}
+    }
+    # An old bounding box side or first pixel still holds if it is outside the window, otherwise look at the component's pixels
+    first_x, first_y = np.divmod(outside['first_pixel'], height)
+    unsure = (old_box['min_x'] >= x0) | (old_box['max_x'] < x1) | (old_box['min_y'] >= y0) | (old_box['max_y'] < y1) | \
+             ((first_x >= x0) & (first_x < x1) & (first_y >= y0) & (first_y < y1))
+    for i in np.nonzero(unsure)[0]:
+        x, y = np.nonzero(mark[old_box['min_x'][i]:old_box['max_x'][i] + 1, old_box['min_y'][i]:old_box['max_y'][i] + 1] == crossing_labels[i])
+        x = x + old_box['min_x'][i]
+        y = y + old_box['min_y'][i]
+        keep = (x < x0) | (x >= x1) | (y < y0) | (y >= y1)
+        x, y = x[keep], y[keep]
+        outside['size'][i] = x.size
+        outside['sum_x'][i], outside['sum_y'][i] = x.sum(), y.sum()
+        outside['min_x'][i], outside['max_x'][i], outside['min_y'][i], outside['max_y'][i] = x.min(), x.max(), y.min(), y.max()
+        outside['first_pixel'][i] = (x.astype(np.int64) * height + y).min()
+
+    # Statistics of each group, from its pieces and the outside parts of its crossing components
+    piece_stats = component_statistics(new_pieces)
+    group_of = np.concatenate([piece_group, crossing_group]).astype(np.intp)
+    piece_x, piece_y = np.divmod(piece_stats['first_pixel'], new_pieces.shape[1])
+    items = {
+        'size': np.concatenate([piece_stats['size'], outside['size']]),
+        'sum_x': np.concatenate([(piece_stats['centroid_x'] + x0) * piece_stats['size'], outside['sum_x']]),
+        'sum_y': np.concatenate([(piece_stats['centroid_y'] + y0) * piece_stats['size'], outside['sum_y']]),
+        'min_x': np.concatenate([piece_stats['min_x'] + x0, outside['min_x']]),
+        'max_x': np.concatenate([piece_stats['max_x'] + x0, outside['max_x']]),
+        'min_y': np.concatenate([piece_stats['min_y'] + y0, outside['min_y']]),
+        'max_y': np.concatenate([piece_stats['max_y'] + y0, outside['max_y']]),
+        'first_pixel': np.concatenate([(piece_x + x0) * height + piece_y + y0, outside['first_pixel']])
+    }
+    size = np.bincount(group_of, weights=items['size'], minlength=group_count).astype(stats['size'].dtype)
+    group = {
+        'size': size,
+        'centroid_x': np.bincount(group_of, weights=items['sum_x'], minlength=group_count) / size,
+        'centroid_y': np.bincount(group_of, weights=items['sum_y'], minlength=group_count) / size
+    }
+    for name, ufunc, start in [('min_x', np.minimum, width), ('max_x', np.maximum, -1), ('min_y', np.minimum, height),
+                               ('max_y', np.maximum, -1), ('first_pixel', np.minimum, mark.size)]:
+        column = np.full(group_count, start, dtype=np.int64)
+        ufunc.at(column, group_of, items[name])
+        group[name] = column
+    group['extent_x'] = group['max_x'] - group['min_x'] + 1
+    group['extent_y'] = group['max_y'] - group['min_y'] + 1
+
+    # Each group with crossing components keeps the number of the one with the most pixels outside the window
+    order = np.lexsort((-outside['size'], crossing_group))
+    first_of_group = np.ones(crossing_count, dtype=bool)
+    first_of_group[1:] = crossing_group[order][1:] != crossing_group[order][:-1]
+    group_label = np.zeros(group_count, dtype=np.int64)
+    group_label[crossing_group[order][first_of_group]] = crossing_labels[order][first_of_group]
+    joined = crossing_labels[order][~first_of_group]
+    joined_set = set(joined.tolist())
+
+    # Numbers freed by joined components and components that were inside the window, and new groups that need one
+    window_labels = np.unique(window_mark)
+    freed = np.union1d(joined, np.setdiff1d(window_labels[window_labels > 0], crossing_labels))
+    new_groups = np.nonzero(group_label == 0)[0]
+    count = stats['size'].size
+    new_count = count - freed.size + new_groups.size
+    # Components numbered above the new count move into the free numbers first, then new groups take the rest
+    moved = np.setdiff1d(np.arange(new_count + 1, count + 1), freed)
+    slots = np.concatenate([freed[freed <= new_count], np.arange(count + 1, new_count + 1)])
+    moved_to = dict(zip(moved.tolist(), slots[:moved.size].tolist()))
+    group_label[new_groups] = slots[moved.size:]
+    group_label = np.array([moved_to.get(label, label) for label in group_label.tolist()], dtype=np.int64)
+
+    # Components to number again outside the window, every pixel is found before any are written
+    # since the number a component moves to may be the old number of another component that is still to be found
+    targets = {label: int(group_label[crossing_group[i]]) for i, label in enumerate(crossing_labels.tolist()) if label in joined_set}
+    targets.update(moved_to)
+    rewrites = []
+    for source, target in targets.items():
+        box = (slice(stats['min_x'][source - 1], stats['max_x'][source - 1] + 1),
+               slice(stats['min_y'][source - 1], stats['max_y'][source - 1] + 1))
+        rewrites.append((box, mark[box] == source, target))
+    for box, pixels, target in rewrites:
+        mark[box][pixels] = target
+    piece_label = np.concatenate([[0], group_label[piece_group]]).astype(mark.dtype)
+    window_mark[:] = piece_label[new_pieces]
+
+    # Patch the statistics, moved components take their old rows and groups get their new rows
+    for name in stats:
+        column = stats[name]
+        if new_count != count:
+            column = np.concatenate([column[:min(count, new_count)], np.zeros(max(new_count - count, 0), dtype=column.dtype)])
+        if name == 'label':
+            column = np.arange(1, new_count + 1)
+        else:
+            column[np.array(list(moved_to.values()), dtype=np.int64) - 1] = stats[name][moved - 1]
+            column[group_label - 1] = group[name]
+        stats[name] = column
+
+    return mark, stats
+
+
+def detect_connected_components_incremental(img, previous_img, previous_mark: np.ndarray, previous_stats: Union[dict, None] = None,
+                                            halo: int = 1, connectivity: int = 8) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Incremental version of detect_connected_components for a map that has changed a little since it was last labelled
+    Writes the output to a txt file called cc-output-2a.txt, the same as detect_connected_components
+    The statistics table returned can be passed to detect_connected_components_sorted so it does not have to be worked out again
+
+    :param img: BinaryMask or numpy array containing the new binary image
+    :param previous_img: BinaryMask or numpy array containing the binary image previous_mark was made from
+    :param previous_mark: MARK of the previous image, updated in place (see relabel_incremental)
+    :param previous_stats: Table from component_statistics for previous_mark, updated in place, None works it out
+    :param halo: Number of pixels to grow the changed area by
+    :param connectivity: 4 or 8
+    :return: Tuple of (new MARK, new statistics table)
+    """
+
+    mark, stats = relabel_incremental(as_binary_mask(previous_img), previous_mark, as_binary_mask(img), previous_stats, halo, connectivity)
+    # List the sizes in raster order, the same order as labelling the image from scratch
+    write_component_sizes("cc-output-2a.txt", stats['size'][np.argsort(stats['first_pixel'])])
+
+    return mark, stats
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    """
+    :param chunk_type: Four letter type of the chunk, e.g. b"IHDR"
+    :param data: Contents of the chunk
+    :return: The chunk with its length and CRC
+    """
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def encode_png(rows: np.ndarray, width: int, bit_depth: int, colour_type: int, palette: Union[np.ndarray, None] = None) -> bytes:
+    """
+    ---------------
+    Description
+    ---------------
+    Encodes rows of pixel bytes as a PNG file, without going through matplotlib
+    Rows are stored unfiltered (filter type 0), which suits masks and label images as they are mostly runs of the same value
+
+    :param rows: 2d uint8 array, one row of the image's bytes per row
+    :param width: Width of the image in pixels
+    :param bit_depth: Bits per sample
+    :param colour_type: PNG colour type, 0 for greyscale or 3 for palette
+    :param palette: (n, 3) uint8 array of colours for a palette image
+    :return: Bytes of the PNG file
+    """
+
+    header = struct.pack(">IIBBBBB", width, rows.shape[0], bit_depth, colour_type, 0, 0, 0)
+    # Each row starts with its filter type
+    filtered = np.concatenate([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows], axis=1)
+
+    chunks = [png_chunk(b"IHDR", header)]
+    if palette is not None:
+        chunks.append(png_chunk(b"PLTE", np.ascontiguousarray(palette, dtype=np.uint8).tobytes()))
+    chunks.append(png_chunk(b"IDAT", zlib.compress(filtered.tobytes(), 6)))
+    chunks.append(png_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+def write_mask_png(path: str, mask) -> str:
+    """
+    ---------------
+    Description
+    ---------------
+    Writes a binary image as a 1 bit greyscale PNG (white for on pixels), which is lossless and 8 pixels per byte
+    before compression, so the mask is the same when it is read back in
+
+    :param path: Path of the file to write
+    :param mask: BinaryMask or anything as_binary_mask accepts
+    :return: The path written to
+    """
+
+    mask = as_binary_mask(mask)
+    with open(path, 'wb') as f:
+        f.write(encode_png(np.packbits(mask, axis=1), mask.shape[1], 1, 0))
+    return path
+
+
+def label_palette(count: int) -> np.ndarray:
+    """
+    :param count: Number of colours, including black for the background
+    :return: (count, 3) uint8 array of colours, black first, then colours that are easy to tell apart from their neighbours
+    """
+    labels = np.arange(count)[:, np.newaxis]
+    palette = (labels * np.array([97, 57, 151])) % 200 + 55
+    palette[0] = 0
+    return palette.astype(np.uint8)
+
+
+def write_label_image(path: str, mark: np.ndarray) -> str:
+    """
+    ---------------
+    Description
+    ---------------
+    Writes MARK losslessly
+    With at most 255 components it is written as a palette PNG where the palette index is the component number,
+    so it can be viewed and the numbers read back exactly
+    With more components, or when the path ends in .npy, the array is saved as a .npy file (the path is changed to end in .npy)
+
+    :param path: Path of the file to write
+    :param mark: 2D array MARK
+    :return: The path written to
+    """
+
+    mark = np.asarray(mark)
+    count = int(mark.max(initial=0)) + 1
+    if path.endswith(".npy") or count > 256:
+        path = os.path.splitext(path)[0] + ".npy"
+        np.save(path, mark)
+        return path
+
+    with open(path, 'wb') as f:
+        f.write(encode_png(mark.astype(np.uint8), mark.shape[1], 8, 3, label_palette(count)))
+    return path
+
+
+def read_label_image(path: str) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Reads MARK back from a file written by write_label_image
+
+    :param path: Path of the .png or .npy file
+    :return: 2D array MARK
+    """
+
+    if path.endswith(".npy"):
+        return np.load(path)
+    blocks = [rows[:, :, 0] for _, rows in png_rows(path, expand_palette=False)]
+    return np.concatenate(blocks).astype(int)
+
+
+class ImageWriter:
+    """
+    ---------------
+    Description
+    ---------------
+    Writes output images on a background thread, so the caller can carry on while the image is compressed and written
+    A single thread is used so files are written in the order they are asked for
+    The data is copied when the write is asked for, so the caller can change its arrays straight away
+    Call flush to wait for every write to finish (it raises the first error from a write), e.g. before reading a file back
+    Writes are kept track of for each thread that asks for them, so threads sharing a writer (e.g. process_maps with threads)
+    only wait for, and only get the errors of, their own writes
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Lists of writes not yet flushed, keyed by the thread that asked for them
+        self.pending = {}
+        self.lock = threading.Lock()
+        # A forked process does not get the writer's thread, so it needs a new one
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """
+        Starts again with a new thread and no writes, for a forked process
+        :return: None
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, function: Callable, path: str, data: np.ndarray):
+        """
+        Queues function(path, data) to run on the background thread
+        :param function: Function that writes the file
+        :param path: Path of the file to write
+        :param data: Array to write
+        :return: Future for the write
+        """
+        # Resolve the path now, the working directory may change before the write runs
+        path = os.path.abspath(path)
+        thread = threading.get_ident()
+        with self.lock:
+            # Forget writes that finished without an error
+            pending = [future for future in self.pending.get(thread, []) if not future.done() or future.exception() is not None]
+            future = self.executor.submit(function, path, data)
+            pending.append(future)
+            self.pending[thread] = pending
+        return future
+
+    def write_mask(self, path: str, mask):
+        """
+        Writes a binary image as a 1 bit PNG in the background, see write_mask_png
+        :param path: Path of the file to write
+        :param mask: BinaryMask or anything as_binary_mask accepts
+        :return: Future for the write
+        """
+        return self.submit(write_mask_png, path, as_binary_mask(mask).copy())
+
+    def write_labels(self, path: str, mark: np.ndarray):
+        """
+        Writes MARK in the background, see write_label_image
+        :param path: Path of the file to write
+        :param mark: 2D array MARK
+        :return: Future for the write
+        """
+        return self.submit(write_label_image, path, np.array(mark))
+
+    def flush(self, every_thread: bool = False):
+        """
+        Waits for the writes asked for by this thread to finish, then raises the first error from them
+        :param every_thread: True to wait for the writes of every thread
+        :return: None
+        """
+        with self.lock:
+            if every_thread:
+                pending = [future for futures in self.pending.values() for future in futures]
+                self.pending = {}
+            else:
+                pending = self.pending.pop(threading.get_ident(), [])
+        # Wait for every write before raising, so no write is still going on afterwards
+        errors = [future.exception() for future in pending]
+        for error in errors:
+            if error is not None:
+                raise error
+
+
+# Writer used for the output images of the template functions
+IMAGE_WRITER = ImageWriter()
+# Images asked for by code that never flushes are still written before the program ends
+atexit.register(IMAGE_WRITER.flush, True)
+
+
+def filter_components(mark: np.ndarray, min_size: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Removes the components of MARK with fewer than min_size pixels, using a lookup table of component sizes
+    The components that are kept are numbered 1, 2, 3... again, keeping their order
+
+    :param mark: 2D array MARK
+    :param min_size: Smallest number of pixels a component can have and be kept
+    :return: 2D array MARK of the kept components
+    """
+
+    mark = np.asarray(mark)
+    sizes = np.bincount(mark.ravel())
+    keep = sizes >= min_size
+    keep[0] = False
+    renumber = np.zeros(sizes.size, dtype=mark.dtype)
+    renumber[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return renumber[mark]
+
+
+def find_holes(mask: np.ndarray, max_hole_size: Union[int, None] = None, connectivity: int = 8) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Finds the holes in a binary image, areas of off pixels that are completely surrounded by on pixels
+    The off pixels are labelled with the other connectivity (4 for 8-connected on pixels and 8 for 4-connected),
+    so that a gap that joins two on pixels diagonally does not also let the off pixels through
+    Areas of off pixels that touch the edge of the image are not holes
+
+    :param mask: 2d bool array of on pixels
+    :param max_hole_size: Largest hole in pixels, None for any size
+    :param connectivity: Connectivity of the on pixels, 4 or 8
+    :return: Tuple of (MARK of the off pixels, bool array where element i is True if off area i is a hole)
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    background = label_union_find(~mask, 4 if connectivity == 8 else 8)
+    sizes = np.bincount(background.ravel())
+
+    is_hole = np.ones(sizes.size, dtype=bool)
+    is_hole[0] = False
+    # Areas touching an edge of the image
+    is_hole[background[0]] = False
+    is_hole[background[-1]] = False
+    is_hole[background[:, 0]] = False
+    is_hole[background[:, -1]] = False
+    if max_hole_size is not None:
+        is_hole &= sizes <= max_hole_size
+
+    return background, is_hole
+
+
+def fill_holes(mask: np.ndarray, max_hole_size: Union[int, None] = None, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Fills the holes in a binary image with on pixels, see find_holes
+
+    :param mask: 2d bool array of on pixels
+    :param max_hole_size: Largest hole to fill in pixels, None fills every hole
+    :param connectivity: Connectivity of the on pixels, 4 or 8
+    :return: 2d bool array with the holes filled
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    background, is_hole = find_holes(mask, max_hole_size, connectivity)
+    return mask | is_hole[background]
+
+
+def fill_mark_holes(mark: np.ndarray, max_hole_size: Union[int, None] = None, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Fills the holes in the components of MARK with the number of the component around them, see find_holes
+    A hole can have islands (other components) inside it, filling the hole joins them to the component around it,
+    so every component next to a hole is merged into one and the components are numbered 1, 2, 3... again
+
+    ---------------
+    General Overview
+    ---------------
+    Find the holes
+    Find the components next to each hole, looking at the pixels either side of every horizontal and vertical pair
+    Union every component next to a hole with the smallest one next to it
+    Fill each hole with that smallest component
+    Number the merged components again, the root of each is its smallest number so raster order is kept
+
+    :param mark: 2D array MARK
+    :param max_hole_size: Largest hole to fill in pixels, None fills every hole
+    :param connectivity: Connectivity of the components, 4 or 8
+    :return: 2D array MARK with the holes filled
+    """
+
+    mark = np.asarray(mark)
+    background, is_hole = find_holes(mark > 0, max_hole_size, connectivity)
+    holes = is_hole[background]
+    if not holes.any():
+        return mark
+
+    # Pairs of (hole, component next to it)
+    hole_numbers = []
+    component_numbers = []
+    for pixel, neighbour in neighbour_pairs(mark, 4):
+        for hole_side, other_side in [(pixel, neighbour), (neighbour, pixel)]:
+            next_to_component = holes[hole_side] & (mark[other_side] > 0)
+            hole_numbers.append(background[hole_side][next_to_component])
+            component_numbers.append(mark[other_side][next_to_component])
+    hole_numbers = np.concatenate(hole_numbers)
+    component_numbers = np.concatenate(component_numbers).astype(np.int64)
+
+    # Smallest component next to each hole, every other component next to the hole is merged into it
+    count = int(mark.max())
+    surrounding = np.full(is_hole.size, count + 1, dtype=np.int64)
+    np.minimum.at(surrounding, hole_numbers, component_numbers)
+    parent = np.arange(count + 1)
+    roots = union_labels(parent, component_numbers, surrounding[hole_numbers])
+
+    filled = mark.copy()
+    filled[holes] = surrounding[background[holes]]
+    # Number the merged components 1, 2, 3... again, label 0 is its own root so the background stays 0
+    renumber = (np.cumsum(roots == np.arange(count + 1)) - 1)[roots]
+    return renumber.astype(mark.dtype)[filled]
+
+
+def clean_mask(mask, min_size: int = 0, max_hole_size: Union[int, None] = 0, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Removes noise from a binary image before it is labelled
+    Components with fewer than min_size pixels are removed, then holes of up to max_hole_size pixels are filled
+    Labelling the cleaned mask gives the same MARK as clean_mark gives for the MARK of the original mask
+
+    :param mask: BinaryMask or anything as_binary_mask accepts
+    :param min_size: Smallest component to keep in pixels, 0 keeps them all
+    :param max_hole_size: Largest hole to fill in pixels, 0 fills none and None fills every hole
+    :param connectivity: 4 or 8
+    :return: Cleaned 2d bool array
+    """
+
+    mask = as_binary_mask(mask)
+    if min_size > 1:
+        mask = filter_components(label_union_find(mask, connectivity), min_size) > 0
+    if max_hole_size is None or max_hole_size > 0:
+        mask = fill_holes(mask, max_hole_size, connectivity)
+    return mask
+
+
+def clean_mark(mark: np.ndarray, min_size: int = 0, max_hole_size: Union[int, None] = 0, connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Removes noise from MARK after labelling, so small components are not written to the output files
+    Components with fewer than min_size pixels are removed, then holes of up to max_hole_size pixels are filled
+    The components that are kept are numbered 1, 2, 3... again in raster order (a hole never holds the first pixel of a component,
+    so components joined by filling a hole keep the first pixel of the one around it)
+
+    :param mark: 2D array MARK
+    :param min_size: Smallest component to keep in pixels, 0 keeps them all
+    :param max_hole_size: Largest hole to fill in pixels, 0 fills none and None fills every hole
+    :param connectivity: Connectivity MARK was labelled with, 4 or 8
+    :return: Cleaned 2D array MARK
+    """
+
+    mark = np.asarray(mark)
+    if min_size > 1:
+        mark = filter_components(mark, min_size)
+    if max_hole_size is None or max_hole_size > 0:
+        mark = fill_mark_holes(mark, max_hole_size, connectivity)
+    return mark
+
+
+def component_sizes(mark: np.ndarray) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Counts the number of pixels in each component of MARK
+
+    :param mark: 2D array MARK
+    :return: Array where element i is the number of pixels in component i + 1
+    """
+
+    return np.bincount(np.asarray(mark).ravel())[1:]
+
+
+def write_component_sizes(file_name: str, sizes):
+    """
+    ---------------
+    Description
+    ---------------
+    Writes the number of pixels in each connected component to a txt file, followed by the total number of components
+
+    :param file_name: Name of the file to write to (it is overwritten if it exists)
+    :param sizes: Number of pixels in each component, in component number order
+    :return: None
+    """
+
+    # Opens and overwrites the file if it exists, else it makes a new one
+    with open(file_name, 'w') as f:
+        # Writes a line for each component
+        for component_number, size in enumerate(sizes, start=1):
+            f.write(f"Connected Component {component_number}, number of pixels = {size}")
+            f.write("\n")
+        # Writes the total number of connected components to the end of the file
+        f.write(f"Total number of connected components = {len(sizes)}")
+
+
+def mask_to_memmap(file_name: str, mask_path: str, condition: Callable, upper_threshold: int, lower_threshold: int, block_rows: int = 256) -> np.memmap:
+    """
+    ---------------
+    Description
+    ---------------
+    Converts an image into a binary mask stored in a memory mapped .npy file
+    The image is decoded a block of rows at a time so only one block is in memory at once
+
+    :param file_name: Name of the image file in the data directory
+    :param mask_path: Path of the .npy file to write the mask to
+    :param condition: Whole image predicate, e.g. red_pixel_mask
+    :param upper_threshold: Upper threshold passed to the condition
+    :param lower_threshold: Lower threshold passed to the condition
+    :param block_rows: Number of rows decoded at a time
+    :return: Memory mapped 2d bool array of the mask
+    """
+
+    mask = np.lib.format.open_memmap(mask_path, mode='w+', dtype=bool, shape=image_shape(file_name))
+    for first_row, rows in image_blocks(file_name, block_rows):
+        mask[first_row:first_row + rows.shape[0]] = pixel_mask(rows, upper_threshold, lower_threshold, condition)
+
+    mask.flush()
+    return mask
+
+
+def image_shape(file_name: str) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the (height, width) of an image in the data directory
+    PNG images are read from the header without decoding the image, anything else has to be read whole
+
+    :param file_name: Name of the image file in the data directory
+    :return: Tuple of (height, width)
+    """
+
+    with open(data_path(file_name), 'rb') as f:
+        header = f.read(24)
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        width, height = struct.unpack(">II", header[16:24])
+        return height, width
+
+    return read_image(file_name).shape[:2]
+
+
+def map_bounded(executor: Executor, function: Callable, items, window: Union[int, None] = None):
+    """
+    ---------------
+    Description
+    ---------------
+    Same as executor.map, but only a window of items is submitted at a time rather than every item at once
+    executor.map takes every item from the iterable before giving any results, so items made on the fly
+    (e.g. tiles read from a memory mapped mask) would all be in memory at once
+
+    :param executor: Thread or process pool to run the function on
+    :param function: Function to call on each item
+    :param items: Iterable of items, only taken from as they are needed
+    :param window: Most items submitted and not yet given back, None uses twice the number of workers
+    :return: Generator of the results, in the order of the items
+    """
+
+    if window is None:
+        # Both pools keep their number of workers in _max_workers
+        window = 2 * (getattr(executor, "_max_workers", None) or os.cpu_count() or 1)
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def label_tile(tile_info: tuple) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels one tile of an image for label_tiled
+    Takes its arguments as one tuple so it can be used with map_bounded (including on a process pool)
+
+    :param tile_info: Tuple of (2d bool array of the tile, connectivity, first row of the tile, first column of the tile, height of the whole image)
+    :return: Tuple of (MARK of the tile, position of the first pixel of each tile component in the raster order of the whole image)
+    """
+
+    tile, connectivity, x, y, height = tile_info
+    tile_mark = label_union_find(tile, connectivity)
+    tile_count = int(tile_mark.max()) if tile_mark.size > 0 else 0
+
+    on_x, on_y = np.nonzero(tile_mark)
+    first = np.full(tile_count + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, tile_mark[on_x, on_y], (on_x + x) * height + (on_y + y))
+
+    return tile_mark, first[1:]
+
+
+def label_tiled(mask: np.ndarray, connectivity: int = 8, tile_shape: tuple = (1024, 1024), mark_path: Union[str, None] = None,
+                executor: Union[Executor, None] = None) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels the connected components of a binary image one tile at a time
+    The mask can be a memory mapped array, and MARK can be written to a memory mapped .npy file,
+    so only one tile of the image (or a few per worker, when an executor is given) needs to be in memory at once
+    Components are numbered in raster order, the same as the other engines
+
+    ---------------
+    General Overview
+    ---------------
+    Label each tile on its own, giving every tile component a provisional number unique across the whole image
+    Record the first pixel (in raster order of the whole image) of every tile component
+    For each seam between tiles, union the tile components that touch across it
+    Number the merged components by their first pixel
+    Rewrite each tile of MARK with the final numbers
+
+    :param mask: 2d bool array of on pixels, may be memory mapped
+    :param connectivity: 4 or 8
+    :param tile_shape: (rows, columns) in each tile
+    :param mark_path: Path of a .npy file to write MARK to, None keeps MARK in memory
+    :param executor: Thread or process pool to label the tiles on, None labels them one after another
+    :return: 2D array MARK (a memory mapped int32 array if mark_path was given)
+    """
+
+    if connectivity not in (4, 8):
+        raise ValueError("Connectivity must be 4 or 8")
+    width, height = mask.shape
+    if mark_path is None:
+        mark = np.zeros((width, height), dtype=int)
+    else:
+        mark = np.lib.format.open_memmap(mark_path, mode='w+', dtype=np.int32, shape=(width, height))
+
+    # Label each tile and give its components provisional numbers following on from the previous tile
+    tile_rows, tile_columns = tile_shape
+    corners = [(x, y) for x in range(0, width, tile_rows) for y in range(0, height, tile_columns)]
+    tiles = ((np.asarray(mask[x:x + tile_rows, y:y + tile_columns], dtype=bool), connectivity, x, y, height) for x, y in corners)
+    labelled_tiles = map(label_tile, tiles) if executor is None else map_bounded(executor, label_tile, tiles)
+
+    first_pixels = [np.zeros(1, dtype=np.int64)]  # Provisional number 0 is the background
+    component_count = 0
+    for (x, y), (tile_mark, first) in zip(corners, labelled_tiles):
+        mark[x:x + tile_rows, y:y + tile_columns] = np.where(tile_mark > 0, tile_mark + component_count, 0)
+        first_pixels.append(first)
+        component_count += first.size
+    first_pixels = np.concatenate(first_pixels)
+
+    # Union tile components that touch across a seam, using a strip two pixels wide either side of the seam
+    parent = np.arange(component_count + 1)
+    seams = [(slice(None), slice(y - 1, y + 1)) for y in range(tile_columns, height, tile_columns)]
+    seams += [(slice(x - 1, x + 1), slice(None)) for x in range(tile_rows, width, tile_rows)]
+    for seam in seams:
+        strip = np.asarray(mark[seam])
+        for pixel, neighbour in neighbour_pairs(strip > 0, connectivity):
+            labels = strip[pixel]
+            neighbour_labels = strip[neighbour]
+            touching = (labels > 0) & (neighbour_labels > 0) & (labels != neighbour_labels)
+            union_labels(parent, labels[touching], neighbour_labels[touching])
+    roots = find_roots(parent)
+
+    # Number the merged components in the order of their first pixel
+    component_first = np.full(component_count + 1, width * height, dtype=np.int64)
+    np.minimum.at(component_first, roots[1:], first_pixels[1:])
+    is_root = roots == np.arange(component_count + 1)
+    is_root[0] = False
+    order = np.argsort(component_first[is_root], kind="stable")
+    final_number = np.zeros(component_count + 1, dtype=np.int32)
+    final_number[np.flatnonzero(is_root)[order]] = np.arange(1, order.size + 1)
+    final_number = final_number[roots]
+
+    # Rewrite MARK tile by tile with the final numbers
+    for x in range(0, width, tile_rows):
+        for y in range(0, height, tile_columns):
+            mark[x:x + tile_rows, y:y + tile_columns] = final_number[mark[x:x + tile_rows, y:y + tile_columns]]
+
+    if isinstance(mark, np.memmap):
+        mark.flush()
+    return mark
+
+
+def label_parallel(mask: np.ndarray, connectivity: int = 8, workers: Union[int, None] = None, processes: bool = False) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Labels the connected components of a binary image on several cores
+    The image is split into one horizontal strip per worker, each strip is labelled on a pool
+    and the labels are merged along the strip borders (see label_tiled),
+    so MARK is identical to the serial engines
+
+    A thread pool is used by default since the labelling is done with numpy, which releases the GIL for much of the work,
+    a process pool avoids the GIL entirely at the cost of copying each strip to its process
+
+    :param mask: 2d bool array of on pixels
+    :param connectivity: 4 or 8
+    :param workers: Number of workers, None uses one per CPU
+    :param processes: Use a process pool rather than a thread pool
+    :return: 2D array MARK
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    strip_rows = max(1, -(-mask.shape[0] // workers))
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=workers) as executor:
+        return label_tiled(mask, connectivity, (strip_rows, max(1, mask.shape[1])), executor=executor)
+
+
+def detect_connected_components_tiled(map_filename: str, condition: Callable, upper_threshold: int = 100, lower_threshold: int = 50,
+                                      work_directory: str = ".", tile_shape: tuple = (1024, 1024), connectivity: int = 8) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Out of core version of filtering a map and calling detect_connected_components on it, for maps too big to fit in memory
+    The mask and MARK are kept in memory mapped .npy files in the work directory,
+    the mask is only made from the image if it is missing or older than the image
+    Writes the output to a txt file called cc-output-2a.txt, the same as detect_connected_components
+
+    ---------------
+    General Overview
+    ---------------
+    Convert the image into a memory mapped mask, if it has not already been done
+    Label the mask tile by tile into a memory mapped MARK
+    Count the pixels in each component tile by tile
+    Write the counts to cc-output-2a.txt
+
+    :param map_filename: Name of the map in the data directory
+    :param condition: Whole image predicate, e.g. red_pixel_mask
+    :param upper_threshold: Upper threshold passed to the condition
+    :param lower_threshold: Lower threshold passed to the condition
+    :param work_directory: Directory to keep the mask and MARK files in
+    :param tile_shape: (rows, columns) in each tile
+    :param connectivity: 4 or 8
+    :return: Memory mapped 2D array MARK
+    """
+
+    name = os.path.splitext(os.path.basename(map_filename))[0]
+    mask_path = os.path.join(work_directory, f"{name}-{condition.__name__}-{upper_threshold}-{lower_threshold}-mask.npy")
+    mark_path = os.path.join(work_directory, f"{name}-{condition.__name__}-{upper_threshold}-{lower_threshold}-mark.npy")
+
+    # Only convert the image once
+    if os.path.exists(mask_path) and os.path.getmtime(mask_path) >= os.path.getmtime(data_path(map_filename)):
+        mask = np.load(mask_path, mmap_mode='r')
+    else:
+        mask = mask_to_memmap(map_filename, mask_path, condition, upper_threshold, lower_threshold)
+
+    mark = label_tiled(mask, connectivity, tile_shape, mark_path)
+
+    # Count the pixels in each component a tile at a time
+    sizes = np.zeros(int(mark.max()) + 1, dtype=np.int64) if mark.size > 0 else np.zeros(1, dtype=np.int64)
+    for x in range(0, mark.shape[0], tile_shape[0]):
+        sizes += np.bincount(np.asarray(mark[x:x + tile_shape[0]]).ravel(), minlength=sizes.size)
+    write_component_sizes("cc-output-2a.txt", sizes[1:])
+
+    return mark
+
+
+# Colour classes found by process_maps, as (name, condition, upper threshold, lower threshold)
+BATCH_RULES = [
+    ("red", red_pixel_condition, 100, 50),
+    ("cyan", cyan_pixel_condition, 100, 50)
+]
+
+
+def process_map(task: tuple) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Finds the pixels and connected components of every colour class in one map, for process_maps
+    Each class gets its own directory in the output directory holding map-{name}-pixels.png,
+    cc-output-2a.txt, cc-output-2b.txt and cc-top-{k}.png (the same files the menu writes)
+    Errors are recorded in the summary rather than raised, so one bad map does not stop the batch
+
+    ---------------
+    General Overview
+    ---------------
+    Classify every pixel with one pass over the image (see segment_map)
+    Label the components of every class at once (see label_classes)
+    Write the output files of each class
+
+    :param task: Tuple of (path of the map, output directory, rules, connectivity, k)
+    :return: Summary dictionary with the map, output directory, component and pixel counts of each class, timings and any error
+    """
+
+    map_path, output_directory, rules, connectivity, k = task
+    summary = {"map": map_path, "output": output_directory, "classes": {}, "seconds": {}, "error": None}
+    start = time.perf_counter()
+    try:
+        classes = segment_map(map_path, [rule[1:] for rule in rules])
+        summary["seconds"]["segment"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mark, component_class = label_classes(classes, connectivity)
+        summary["seconds"]["label"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for number, rule in enumerate(rules, start=1):
+            name = rule[0]
+            class_directory = os.path.join(output_directory, name)
+            os.makedirs(class_directory, exist_ok=True)
+
+            IMAGE_WRITER.write_mask(os.path.join(class_directory, f"map-{name}-pixels.png"), classes == number)
+            mark_of_class = class_mark(mark, component_class, number)
+            stats = component_statistics(mark_of_class)
+            write_component_sizes(os.path.join(class_directory, "cc-output-2a.txt"), stats['size'])
+            detect_connected_components_sorted(mark_of_class, k, stats, class_directory)
+
+            summary["classes"][name] = {"components": int(stats['size'].size), "pixels": int(stats['size'].sum())}
+    # Image readers raise many different errors for bad files, any of them just fails this map
+    except Exception as error:
+        summary["error"] = f"{type(error).__name__}: {error}"
+    finally:
+        # Wait for this map's writes even when it failed, so they are never left for the next map on this worker to report
+        try:
+            IMAGE_WRITER.flush()
+        except Exception as error:
+            if summary["error"] is None:
+                summary["error"] = f"{type(error).__name__}: {error}"
+    if summary["error"] is None:
+        summary["seconds"]["write"] = time.perf_counter() - start
+
+    return summary
+
+
+def process_maps(map_directory: str, output_directory: str, rules: Union[list, None] = None, workers: Union[int, None] = None,
+                 processes: bool = True, connectivity: int = 8, k: int = 2) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Batch version of the intelligence menu, finds the connected components of every colour class in every PNG in a directory
+    Maps are processed on a pool of workers, each map writes to its own directory (named after the map) in the output directory,
+    so maps never overwrite each other's files
+    A manifest summarising each map (see process_map) is written to manifest.json in the output directory
+
+    :param map_directory: Directory containing the PNG maps
+    :param output_directory: Directory to write the output to, made if it does not exist
+    :param rules: List of (name, condition, upper threshold, lower threshold), None uses BATCH_RULES
+    :param workers: Number of workers, None lets the executor decide
+    :param processes: True to use processes (maps are processed in parallel), False to use threads
+    :param connectivity: 4 or 8
+    :param k: Number of the largest components to save to each cc-top image
+    :return: The manifest
+    """
+
+    if rules is None:
+        rules = BATCH_RULES
+    os.makedirs(output_directory, exist_ok=True)
+
+    map_names = sorted(name for name in os.listdir(map_directory) if name.lower().endswith(".png"))
+    tasks = [(os.path.abspath(os.path.join(map_directory, name)), os.path.join(output_directory, os.path.splitext(name)[0]),
+              rules, connectivity, k) for name in map_names]
+
+    start = time.perf_counter()
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(workers) as executor:
+        maps = list(executor.map(process_map, tasks))
+
+    manifest = {
+        "map_directory": os.path.abspath(map_directory),
+        "classes": [rule[0] for rule in rules],
+        "connectivity": connectivity,
+        "seconds": time.perf_counter() - start,
+        "maps": maps
+    }
+    with open(os.path.join(output_directory, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+# Labelling engines that detect_connected_components can use, other than bfs
+# Each takes a 2d bool array and a connectivity and returns MARK
+LABELLING_ENGINES = {
+    "union_find": label_union_find,
+    "rle": label_rle,
+    "tiled": label_tiled,
+    "parallel": label_parallel
+}
+
+# Names of the files AnalysisCache stores, a key (SHA-256 hex digest) followed by the kind of entry
+# Anything else in the cache directory is not an entry and is never listed or removed
+ANALYSIS_CACHE_ENTRY = re.compile(r"[0-9a-f]{64}-(mask\.npz|mark-\d+\.npy|distances\.npz)")
+
+
+class AnalysisCache:
+    """
+    ---------------
+    Description
+    ---------------
+    Cache of masks and MARKs stored in a directory, so analysing the same map again does not read, filter or label it again
+    Entries are keyed by a hash of the image file's contents, the name of the condition and the thresholds,
+    so a changed image (even with the same name) never gets an old entry
+
+    ---------------
+    General Overview
+    ---------------
+    Masks are stored bit packed in a compressed .npz file (1 bit per pixel)
+    MARKs are stored as int32 .npy files and memory mapped when loaded, so only the parts used are read from disk
+    The modification time of an entry is updated each time it is used,
+    when the directory is larger than max_bytes the least recently used entries are removed first
+    """
+
+    def __init__(self, directory: str = "cache", max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param directory: Directory to store the entries in, made if it does not exist
+        :param max_bytes: Largest total size of the entries in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Hashes of image files, keyed by (path, modification time, size) so files are only hashed once
+        self.image_hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def image_hash(self, file_name: str) -> str:
+        """
+        ---------------
+        Description
+        ---------------
+        Works out the SHA-256 hash of the contents of an image in the data directory
+
+        :param file_name: Name of the image
+        :return: Hex digest of the hash
+        """
+        path = data_path(file_name)
+        status = os.stat(path)
+        file_key = (path, status.st_mtime_ns, status.st_size)
+        if file_key not in self.image_hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            self.image_hashes[file_key] = digest.hexdigest()
+        return self.image_hashes[file_key]
+
+    def key(self, file_name: str, condition: Callable, upper_threshold: int, lower_threshold: int) -> str:
+        """
+        :param file_name: Name of the image
+        :param condition: Pixel condition used to make the mask
+        :param upper_threshold: Upper threshold given to the condition
+        :param lower_threshold: Lower threshold given to the condition
+        :return: Key for entries made from the image with this condition and thresholds
+        """
+        text = f"{self.image_hash(file_name)}:{condition.__name__}:{upper_threshold}:{lower_threshold}"
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def mask(self, file_name: str, condition: Callable, upper_threshold: int, lower_threshold: int) -> BinaryMask:
+        """
+        ---------------
+        Description
+        ---------------
+        Gets the mask of the pixels in the image that meet the condition, making and storing it if it is not cached
+
+        :param file_name: Name of the image
+        :param condition: Pixel condition, e.g. red_pixel_condition
+        :param upper_threshold: Upper threshold given to the condition
+        :param lower_threshold: Lower threshold given to the condition
+        :return: BinaryMask of the pixels
+        """
+        path = os.path.join(self.directory, self.key(file_name, condition, upper_threshold, lower_threshold) + "-mask.npz")
+        if os.path.exists(path):
+            self.touch(path)
+            with np.load(path) as data:
+                return BinaryMask.from_packed(data['packed'], tuple(data['shape']))
+
+        mask = filter_pixels(read_image(file_name) * 255, upper_threshold, lower_threshold, condition)
+        np.savez_compressed(path, packed=mask.pack(), shape=np.array(mask.mask.shape))
+        self.evict(keep=path)
+        return mask
+
+    def mark(self, file_name: str, condition: Callable, upper_threshold: int, lower_threshold: int, connectivity: int = 8) -> np.ndarray:
+        """
+        ---------------
+        Description
+        ---------------
+        Gets MARK for the mask of the pixels in the image that meet the condition, labelling and storing it if it is not cached
+        The MARK is the same as detect_connected_components gives for the mask
+
+        :param file_name: Name of the image
+        :param condition: Pixel condition, e.g. red_pixel_condition
+        :param upper_threshold: Upper threshold given to the condition
+        :param lower_threshold: Lower threshold given to the condition
+        :param connectivity: 4 or 8
+        :return: Read only MARK, memory mapped unless it is too large for the cache to keep
+        """
+        path = os.path.join(self.directory, self.key(file_name, condition, upper_threshold, lower_threshold) + f"-mark-{connectivity}.npy")
+        if os.path.exists(path):
+            self.touch(path)
+            return np.load(path, mmap_mode='r')
+
+        mark = label_union_find(self.mask(file_name, condition, upper_threshold, lower_threshold).mask, connectivity)
+        # int32 holds over 2 billion components and is half the size of the default int
+        if mark.size < np.iinfo(np.int32).max:
+            mark = mark.astype(np.int32)
+        mark.setflags(write=False)
+        # A MARK larger than the whole cache can not be kept, so it is only returned
+        if mark.nbytes > self.max_bytes:
+            return mark
+        np.save(path, mark)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def distances(self, file_name: str, condition: Callable, upper_threshold: int, lower_threshold: int) -> RoadDistances:
+        """
+        ---------------
+        Description
+        ---------------
+        Gets the distance from every pixel to the nearest pixel that meets the condition, working it out and storing it if it is not cached
+
+        :param file_name: Name of the image
+        :param condition: Pixel condition, e.g. red_pixel_condition
+        :param upper_threshold: Upper threshold given to the condition
+        :param lower_threshold: Lower threshold given to the condition
+        :return: RoadDistances of the mask
+        """
+        path = os.path.join(self.directory, self.key(file_name, condition, upper_threshold, lower_threshold) + "-distances.npz")
+        if os.path.exists(path):
+            self.touch(path)
+            return RoadDistances.load(path)
+
+        distances = road_distances(self.mask(file_name, condition, upper_threshold, lower_threshold))
+        distances.save(path)
+        self.evict(keep=path)
+        return distances
+
+    @staticmethod
+    def touch(path: str):
+        """
+        Marks an entry as just used by updating its modification time
+        :param path: Path of the entry
+        :return: None
+        """
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def entries(self) -> list:
+        """
+        :return: List of (modification time, size, path) of each entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            # Only files named like an entry, other files may share the directory
+            if ANALYSIS_CACHE_ENTRY.fullmatch(name) and os.path.isfile(path):
+                status = os.stat(path)
+                entries.append((status.st_mtime_ns, status.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep: Union[str, None] = None):
+        """
+        ---------------
+        Description
+        ---------------
+        Removes the least recently used entries until the total size is no more than max_bytes
+        The entry that has just been stored is never removed, so it can still be loaded even if it is larger than max_bytes
+
+        :param keep: Path of an entry not to remove
+        :return: None
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # On some systems a memory mapped file can not be removed while it is open, leave it for next time
+                continue
+            total -= size
+
+    def clear(self):
+        """
+        Removes every entry, leaving any other files in the directory
+        :return: None
+        """
+        for _, _, path in self.entries():
+            os.remove(path)
+
+
+# -------------------------
+# Template Functions
+# -------------------------
+
+def find_red_pixels(map_filename, upper_threshold=100, lower_threshold=50, cache: Union[AnalysisCache, None] = None):
+    """
+    ---------------
+    Description
+    ---------------
+    Finds all the red pixels in the input image and saves them to a binary png file
+    If, at a pixel, r > Upper Threshold and g < Lower Threshold
+    and b < Lower Threshold, this pixel is red.
+
+    :param lower_threshold: Lower threshold for considering an RGB value in a pixel to be valid
+    :param upper_threshold: Upper threshold for considering an RGB value in a pixel to be valid
+    :param map_filename: Name of the map to load
+    :param cache: AnalysisCache to get the mask from, None always filters the image
+    :return: BinaryMask containing all the binary pixels
+    """
+
+    if cache is not None:
+        new_map = cache.mask(map_filename, red_pixel_condition, upper_threshold, lower_threshold)
+    else:
+        # Load the image
+        map_file = read_image(map_filename) * 255
+        # Get all red pixels from the image
+        new_map = filter_pixels(map_file, upper_threshold, lower_threshold, red_pixel_condition)
+
+    # Save the binary image as a 1 bit png file in the background
+    IMAGE_WRITER.write_mask("map-red-pixels.png", new_map)
+
+    return new_map
+
+
+def find_cyan_pixels(map_filename, upper_threshold, lower_threshold, cache: Union[AnalysisCache, None] = None):
+    """
+    ---------------
+    Description
+    ---------------
+    Finds all the cyan pixels in the input image and saves them to a binary png file
+    If, at a pixel, r < Lower Threshold and
+    g > Upper Threshold and b > Upper Threshold, this pixel is cyan
+
+    :param lower_threshold: Lower threshold for considering an RGB value in a pixel to be valid
+    :param upper_threshold: Upper threshold for considering an RGB value in a pixel to be valid
+    :param map_filename: Name of the map to load
+    :param cache: AnalysisCache to get the mask from, None always filters the image
+    :return: BinaryMask containing all the binary pixels
+    """
+
+    if cache is not None:
+        new_map = cache.mask(map_filename, cyan_pixel_condition, upper_threshold, lower_threshold)
+    else:
+        # Load the image
+        map_file = read_image(map_filename) * 255
+        # Get all cyan pixels from the image
+        new_map = filter_pixels(map_file, upper_threshold, lower_threshold, cyan_pixel_condition)
+
+    # Save the binary image as a 1 bit png file in the background
+    IMAGE_WRITER.write_mask("map-cyan-pixels.png", new_map)
+
+    return new_map
+
+
+def detect_connected_components(img, engine: str = "bfs", connectivity: int = 8, min_size: int = 0,
+                                max_hole_size: Union[int, None] = 0):
+    """
+    ---------------
+    Description
+    ---------------
+    Detects all of the connected components in the input image
+    Gives each connected component a number and counts the number of pixels in the component
+    Writes the output to a txt file called cc-output-2a.txt
+
+    Components are numbered in the order their first pixel is found scanning the image row by row,
+    every engine gives the same MARK for the same connectivity
+    • bfs - Breadth first search from each unvisited pixel (8-connectivity only)
+    • union_find - Two pass union-find labelling, see label_union_find
+    • rle - Labelling of run length encoded rows, see label_runs (use label_runs directly to avoid making MARK)
+    • tiled - Labelling tile by tile, see label_tiled (use detect_connected_components_tiled for maps that do not fit in memory)
+    • parallel - Labelling strips of the image on a thread pool, see label_parallel
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when the engine is unknown or does not support the connectivity
+
+    :param img: BinaryMask or numpy array containing binary image to find connected components for
+    :param engine: Name of the labelling engine to use
+    :param connectivity: 4 or 8, which neighbouring pixels count as connected
+    :param min_size: Leave out components with fewer pixels than this, see clean_mark
+    :param max_hole_size: Fill holes in components up to this size, 0 fills none and None fills every hole
+    :return: 2D array MARK
+    """
+
+    # Get the pavement pixels as a 2d bool array
+    pavement = as_binary_mask(img)
+    cleaning = min_size > 1 or max_hole_size is None or max_hole_size > 0
+    # Gets the width and height of the input image
+    img_width = pavement.shape[0]
+    img_height = pavement.shape[1]
+
+    # Other engines label the whole image at once
+    if engine != "bfs":
+        if engine not in LABELLING_ENGINES:
+            raise ValueError(f"Unknown labelling engine: {engine}")
+        mark = LABELLING_ENGINES[engine](pavement, connectivity)
+        if cleaning:
+            mark = clean_mark(mark, min_size, max_hole_size, connectivity)
+        write_component_sizes("cc-output-2a.txt", component_sizes(mark))
+        return mark
+    if connectivity != 8:
+        raise ValueError("The bfs engine only supports 8-connectivity")
+    # The bfs engine labels the cleaned mask
+    if cleaning:
+        pavement = clean_mask(pavement, min_size, max_hole_size, connectivity)
+
+    # List to store the pixel count of each component to write to cc-output-2a.txt (modification to original algorithm)
+    sizes = []
+    # Two variables to hold the number of the component that is currently being processed and the number of pixels in the component (modification to original algorithm)
+    component_number = 0
+    current_component_pixel_count = 0
+
+    # Set all elements in MARK as unvisited, i.e., 0.
+    # When a pixel is visited it will be marked in MARK with its component number (modification to original algorithm)
+    mark = np.zeros((img_width, img_height), dtype=int)
     # Create an empty queue-like ndarray Q
     max_queue_length = img_height * img_width
     queue = np.zeros((max_queue_length, 2), dtype=int)
@@ -320,7 +3394,7 @@ def detect_connected_components(img):
     for x in range(img_width):
         for y in range(img_height):
             # if p(x, y) is the pavement pixel and MARK(x, y) is unvisited then
-            if img[x, y, 0] >= 255 and mark[x, y] == 0:
+            if pavement[x, y] and mark[x, y] == 0:
                 # Increment the component number as a new component has been found (modification to original algorithm)
                 component_number += 1
                 # Set the current number of pixels in this component to 1 because the first pixel has been found (modification to original algorithm)
@@ -339,7 +3413,7 @@ def detect_connected_components(img):
                         s = neighbour[0]
                         t = neighbour[1]
                         # if n(s, t) is the pavement pixel and MARK(s, t) is unvisited then
-                        if img[s, t, 0] >= 255 and mark[s, t] == 0:
+                        if pavement[s, t] and mark[s, t] == 0:
                             # Increment the pixel count for the current component (modification to original algorithm)
                             current_component_pixel_count += 1
                             # set MARK(s, t) as visited;
@@ -348,97 +3422,51 @@ def detect_connected_components(img):
                             queue_tail = push_queue(queue, [s, t], queue_tail)
 
                 # All pixels in the current component have been found
-                # Add a string containing this information to the output_strings list
-                output_strings.append(f"Connected Component {component_number}, number of pixels = {current_component_pixel_count}")
-
-    # Opens and overwrites the cc-output-2a.txt file if it exists, else it makes a new one
-    with open("cc-output-2a.txt", 'w') as f:
-        # Writes all lines to the file
-        for line in output_strings:
-            f.write(line)
-            f.write("\n")
-        # Writes the total number of connected components to the end of the file (highest component number which is the last)
-        f.write(f"Total number of connected components = {component_number}")
+                # Add the pixel count to the sizes list
+                sizes.append(current_component_pixel_count)
+
+    write_component_sizes("cc-output-2a.txt", sizes)
 
     return mark
 
 
-def detect_connected_components_sorted(mark):
+def detect_connected_components_sorted(mark, k: int = 2, stats: Union[dict, None] = None, output_directory: str = "."):
     """
     ---------------
     Description
     ---------------
     Uses MARK from detect_connected_components function and orders the connected components largest to smallest
+    Components of the same size are ordered by component number
     Writes the output to "cc-output-2b.txt"
-    Write the top two components to "cc-top-2.jpg"
+    Write the top k components (two by default) to "cc-top-{k}.png"
+
+    ---------------
+    General Overview
+    ---------------
+    Find the statistics of every component in one pass over MARK
+    Sort the components by size
+    Write the sorted components to the file
+    Make a binary image of the top k components and save it
 
     :param mark: MARK from detect_connected_components function
+    :param k: Number of the largest components to save to the image
+    :param stats: Table from component_statistics for MARK, None works it out
+    :param output_directory: Directory to write the files to
     :return: None
     """
 
-    # Will contain tuples of (component number, pixel count)
-    components = []
-    components_as_dict = {}
-    component_number = 1
-    # Count the number of pixels in each component
-    for x in range(mark.shape[0]):
-        for y in range(mark.shape[1]):
-            if mark[x, y] > 0:
-                if mark[x, y] not in components_as_dict:
-                    components_as_dict[mark[x, y]] = 1
-                else:
-                    components_as_dict[mark[x, y]] += 1
-
-    # Convert to tuples as defined above
-    for key in components_as_dict:
-        components.append((key, components_as_dict[key]))
-
-    def sort_components(comp):
-        """
-        Modified version of the sort function in reporting.py so that it functions with tuples
-        Defined locally within another function because this is its only use
-
-        :param comp: List of components to sort
-        :return: Sorted list of component tuples
-        """
-        if len(comp) <= 1:
-            return comp
-
-        # select the first element in the array to be the pivot
-        pivot = comp[0][1]
-
-        # create two empty lists to act as buckets, one for elements less than the pivot and one for elements greater than the pivot
-        less = []
-        greater = []
-
-        # iterate over the rest of the array
-        for i in range(1, len(comp)):
-            # if the element is less than the pivot, add it to the less list otherwise, add it to the greater list
-            if comp[i][1] < pivot:
-                less.append(comp[i])
-            else:
-                greater.append(comp[i])
-
-        # call sort on the less list, then the greater list, then combine the sorted lists and return them
-        return sort_components(less) + [comp[0]] + sort_components(greater)
-
-    sorted_components = sort_components(components)
-    # Create line to write to file
-    output_strings = []
-    for i in range(len(sorted_components)):
-        output_strings.append(f"Connected Component {sorted_components[i][0]}, number of pixels = {sorted_components[i][1]}")
+    if stats is None:
+        stats = component_statistics(mark)
+    order = top_components(stats)
 
     # Opens and overwrites the cc-output-2b.txt file if it exists, else it makes a new one
-    with open("cc-output-2b.txt", 'w') as f:
-        # Writes all lines to the file
-        for line in output_strings:
-            f.write(line)
+    with open(os.path.join(output_directory, "cc-output-2b.txt"), 'w') as f:
+        # Writes a line for each component, largest first
+        for i in order:
+            f.write(f"Connected Component {stats['label'][i]}, number of pixels = {stats['size'][i]}")
             f.write("\n")
         # Writes the total number of connected components to the end of the file
-        f.write(f"Total number of connected components = {sorted_components[-1][0]}")
-
-    # Very hacked together use of the filter_pixels function :)
-    top_two_map = filter_pixels(mark, sorted_components[0][0], sorted_components[1][0], top_two_condition)
-    # Save the binary image of the top two components as a jpg file
-    mat_plot.imsave("cc-top-2.jpg", np.uint8(top_two_map))
+        f.write(f"Total number of connected components = {order.size}")
 
+    # Save the binary image of the top k components as a 1 bit png file in the background
+    IMAGE_WRITER.write_mask(os.path.join(output_directory, f"cc-top-{k}.png"), np.isin(mark, stats['label'][order[:k]]))
@@ -0,0 +1,268 @@
+# Benchmarks the intelligence module on synthetic road maps
+# Usage: python intelligence_benchmark.py [--sizes 256 512 1024] [--components 100] [--density 0.1]
+#                                         [--engines bfs union_find rle tiled parallel] [--repeats 3] [--output report.json]
+#
+# Each map is made of a grid of cells with one road (a random walk) in each cell, the cells are far enough apart
+# that roads never touch, so every map has exactly the number of components asked for
+# Every stage is timed (the fastest of the repeats is reported) and then its peak memory is measured with tracemalloc
+# in a separate run, so tracing does not slow down the timings, the MARK of every labelling engine is checked against union_find
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import intelligence
+
+# Engines compared by default, bfs is left out as it takes minutes on large maps
+DEFAULT_ENGINES = ["union_find", "rle", "tiled", "parallel"]
+
+
+def reflect(positions: np.ndarray, length: int) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Folds positions back into 0 to length - 1 as if bouncing off the ends
+    Neighbouring positions stay neighbours (or the same), so a connected walk stays connected
+
+    :param positions: Array of positions
+    :param length: Number of places to fold into
+    :return: Array of positions between 0 and length - 1
+    """
+    if length == 1:
+        return np.zeros_like(positions)
+    period = 2 * (length - 1)
+    folded = np.mod(positions, period)
+    return np.where(folded >= length, period - folded, folded)
+
+
+def synthetic_road_map(width: int, height: int, components: int, density: float, seed: int = 0) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Makes a white map with red roads, for benchmarking
+    The map is split into a grid of cells, each cell (up to the number of components) gets one road that is a random walk,
+    with a one pixel border in each cell so roads in different cells never touch, even diagonally
+
+    ---------------
+    General Overview
+    ---------------
+    Work out the grid of cells and the number of steps each walk needs to cover about density of its cell
+    Make every walk at once, each step moves one pixel up, down, left or right
+    Fold the walks back into their cells so they stay connected
+    Draw the roads
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when the components do not fit on the map or the density is not between 0 and 1
+
+    :param width: Number of rows
+    :param height: Number of columns
+    :param components: Number of roads
+    :param density: Fraction of each cell to cover with road (approximate, as walks cross themselves)
+    :param seed: Seed for the random numbers
+    :return: Tuple of (uint8 RGB map of shape (width, height, 3), 2d bool array of the road pixels)
+    """
+    if not 0 < density <= 1:
+        raise ValueError("Density must be more than 0 and at most 1")
+
+    mask = np.zeros((width, height), dtype=bool)
+    if components > 0:
+        # As square a grid as the map allows
+        rows = max(1, round(math.sqrt(components * width / height)))
+        columns = math.ceil(components / rows)
+        cell_width = width // rows - 2
+        cell_height = height // columns - 2
+        if cell_width < 1 or cell_height < 1:
+            raise ValueError("Too many components for the size of the map")
+
+        rng = np.random.default_rng(seed)
+        steps = max(1, int(density * cell_width * cell_height * 2))
+        # One of the four directions for each step of each walk
+        direction = rng.integers(0, 4, (components, steps))
+        dx = np.where(direction == 0, 1, np.where(direction == 1, -1, 0))
+        dy = np.where(direction == 2, 1, np.where(direction == 3, -1, 0))
+        start_x = rng.integers(0, cell_width, (components, 1))
+        start_y = rng.integers(0, cell_height, (components, 1))
+        walk_x = reflect(start_x + np.cumsum(dx, axis=1), cell_width)
+        walk_y = reflect(start_y + np.cumsum(dy, axis=1), cell_height)
+
+        # Move each walk into its cell, inside the cell's border
+        cell = np.arange(components)[:, np.newaxis]
+        mask[(cell // columns) * (cell_width + 2) + 1 + walk_x, (cell % columns) * (cell_height + 2) + 1 + walk_y] = True
+
+    image = np.full((width, height, 3), 255, dtype=np.uint8)
+    image[mask] = (255, 0, 0)
+    return image, mask
+
+
+def measure(function, *args, repeats: int = 1) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Times a function and measures the most memory it allocates at once (numpy arrays included)
+    tracemalloc slows down every allocation, so the timed runs are made with it off
+    and the memory is measured in one more run of its own
+
+    :param function: Function to measure
+    :param args: Arguments for the function
+    :param repeats: Number of times to time it
+    :return: Tuple of (result of the last timed run, fastest time in seconds, peak memory in bytes)
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def run_case(width: int, height: int, components: int, density: float, engines: list, repeats: int = 1, seed: int = 0) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Benchmarks every stage of the intelligence module on one synthetic map
+    • filter - filter_pixels finding the red pixels
+    • label_{engine} - Labelling the mask with each engine
+    • statistics - component_statistics of MARK
+    • write_sizes - detect_connected_components writing cc-output-2a.txt (with the fastest engine)
+    • sorted - detect_connected_components_sorted writing cc-output-2b.txt and the top 2 image
+
+    :param width: Number of rows
+    :param height: Number of columns
+    :param components: Number of roads
+    :param density: Fraction of each cell to cover with road
+    :param engines: Names of the labelling engines to compare, "bfs" or any in LABELLING_ENGINES
+    :param repeats: Number of times to run each stage
+    :param seed: Seed for the random map
+    :return: Dictionary of the map, the seconds and peak bytes of each stage and whether every engine gave the same MARK
+    """
+    image, expected_mask = synthetic_road_map(width, height, components, density, seed)
+    result = {
+        "width": width, "height": height, "components": components, "density": density,
+        "road_pixels": int(expected_mask.sum()), "seconds": {}, "peak_bytes": {}, "engines": {}
+    }
+
+    def record(stage, measured):
+        value, seconds, peak = measured
+        result["seconds"][stage] = seconds
+        result["peak_bytes"][stage] = peak
+        return value
+
+    mask = record("filter", measure(intelligence.filter_pixels, image, 100, 50, intelligence.red_pixel_condition, repeats=repeats))
+    pavement = mask.mask
+
+    reference = intelligence.label_union_find(pavement)
+    for engine in engines:
+        label = intelligence.LABELLING_ENGINES.get(engine)
+        if engine == "bfs":
+            # The bfs engine only exists inside detect_connected_components, which also writes the sizes file
+            with tempfile.TemporaryDirectory() as directory:
+                working_directory = os.getcwd()
+                os.chdir(directory)
+                try:
+                    mark = record("label_bfs", measure(intelligence.detect_connected_components, pavement, "bfs", repeats=repeats))
+                finally:
+                    os.chdir(working_directory)
+        else:
+            mark = record(f"label_{engine}", measure(label, pavement, 8, repeats=repeats))
+        result["engines"][engine] = {"identical": bool(np.array_equal(mark, reference)), "components": int(mark.max(initial=0))}
+
+    stats = record("statistics", measure(intelligence.component_statistics, reference, repeats=repeats))
+
+    fastest = min((engine for engine in engines if engine != "bfs"), key=lambda engine: result["seconds"][f"label_{engine}"],
+                  default="union_find")
+    with tempfile.TemporaryDirectory() as directory:
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        try:
+            record("write_sizes", measure(intelligence.detect_connected_components, pavement, fastest, repeats=repeats))
+
+            def sorted_output():
+                intelligence.detect_connected_components_sorted(reference, 2, stats)
+                intelligence.IMAGE_WRITER.flush()
+            record("sorted", measure(sorted_output, repeats=repeats))
+        finally:
+            os.chdir(working_directory)
+
+    result["identical"] = all(engine["identical"] for engine in result["engines"].values())
+    result["component_count_correct"] = int(reference.max(initial=0)) == components
+    return result
+
+
+def benchmark(sizes: list, components: int, density: float, engines: list, repeats: int = 1, seed: int = 0) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Benchmarks square maps of each size, see run_case
+
+    :param sizes: Width (and height) of each map
+    :param components: Number of roads on each map
+    :param density: Fraction of each cell to cover with road
+    :param engines: Names of the labelling engines to compare
+    :param repeats: Number of times to run each stage
+    :param seed: Seed for the random maps
+    :return: Report with the settings, the Python and numpy versions and the result of each map
+    """
+    return {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "repeats": repeats,
+        "engines": engines,
+        "cases": [run_case(size, size, components, density, engines, repeats, seed) for size in sizes]
+    }
+
+
+def print_report(report: dict):
+    """
+    Prints a benchmark report as a table, one row per map and one column per stage (milliseconds)
+    :param report: Report from benchmark
+    :return: None
+    """
+    stages = list(report["cases"][0]["seconds"]) if report["cases"] else []
+    print(f"{'size':>6}{'pixels':>10}" + "".join(f"{stage:>18}" for stage in stages) + f"{'peak MB':>10}{'identical':>11}")
+    for case in report["cases"]:
+        peak = max(case["peak_bytes"].values()) / 1e6
+        times = "".join(f"{case['seconds'][stage] * 1000:>18.1f}" for stage in stages)
+        print(f"{case['width']:>6}{case['road_pixels']:>10}{times}{peak:>10.1f}{str(case['identical']):>11}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the intelligence module on synthetic road maps")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--components", type=int, default=100)
+    parser.add_argument("--density", type=float, default=0.1)
+    parser.add_argument("--engines", nargs="+", default=DEFAULT_ENGINES,
+                        choices=["bfs"] + list(intelligence.LABELLING_ENGINES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    options = parser.parse_args()
+
+    benchmark_report = benchmark(options.sizes, options.components, options.density, options.engines, options.repeats, options.seed)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(benchmark_report, f, indent=2)
+    if options.json:
+        print(json.dumps(benchmark_report, indent=2))
+    else:
+        print_report(benchmark_report)
@@ -1,18 +1,46 @@
 # This is a template. 
 # You should modify the functions below to match
 # the signatures determined by the project specification
+import argparse
 import csv
 import datetime
+import importlib.util
 import os
 import re
 import time
 from typing import Union
-import reporting
-import monitoring
-import intelligence
 import sys
 
 
+def lazy_import(name: str):
+    """
+    ---------------
+    Description
+    ---------------
+    Imports a module the first time one of its attributes is used rather than straight away
+    The modules below import numpy, matplotlib and requests, which take a long time to import,
+    so the menu can be shown before they are loaded (and they are never loaded if they are not used)
+
+    :param name: Name of the module
+    :return: The module, which loads itself when it is first used
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+reporting = lazy_import("reporting")
+monitoring = lazy_import("monitoring")
+intelligence = lazy_import("intelligence")
+
+
 class Menu:
     """
     This class is used to store the menu text and regex for menu's that are not dynamically created
@@ -379,6 +407,61 @@ def clear():
     os.system('cls')
 
 
+def cached_mark(cache: "intelligence.AnalysisCache", file_name: str, filter_choice: str):
+    """
+    ---------------
+    Description
+    ---------------
+    Gets MARK for the red or cyan pixels of a map from the cache
+    Also saves the filtered image, as finding connected components did before the cache was used
+
+    :param cache: AnalysisCache to get the mask and MARK from
+    :param file_name: Name of the map
+    :param filter_choice: FR for red pixels, FC for cyan pixels
+    :return: 2D array MARK
+    """
+    if filter_choice.lower() == 'fr':
+        intelligence.find_red_pixels(file_name, upper_threshold=100, lower_threshold=50, cache=cache)
+        condition = intelligence.red_pixel_condition
+    else:
+        intelligence.find_cyan_pixels(file_name, upper_threshold=100, lower_threshold=50, cache=cache)
+        condition = intelligence.cyan_pixel_condition
+
+    return cache.mark(file_name, condition, upper_threshold=100, lower_threshold=50)
+
+
+def batch(arguments: list):
+    """
+    ---------------
+    Description
+    ---------------
+    Runs the intelligence module on every PNG map in a directory without going through the menus
+    Usage: python main.py batch MAP_DIRECTORY OUTPUT_DIRECTORY [--workers N] [--threads] [--connectivity {4,8}]
+
+    :param arguments: Command line arguments after "batch"
+    :return: None
+    """
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Find connected components in a directory of maps")
+    parser.add_argument("map_directory")
+    parser.add_argument("output_directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads", action="store_true", help="use threads instead of processes")
+    parser.add_argument("--connectivity", type=int, choices=[4, 8], default=8)
+    options = parser.parse_args(arguments)
+
+    manifest = intelligence.process_maps(options.map_directory, options.output_directory, workers=options.workers,
+                                         processes=not options.threads, connectivity=options.connectivity)
+
+    # Print a line for each map
+    for summary in manifest["maps"]:
+        if summary["error"] is not None:
+            print(f"{summary['map']}: {summary['error']}")
+        else:
+            counts = ", ".join(f"{name} {counts['components']}" for name, counts in summary["classes"].items())
+            print(f"{summary['map']}: {counts} components")
+    print(f"Processed {len(manifest['maps'])} maps in {manifest['seconds']:.2f}s")
+
+
 # -------------------------
 # Template Functions
 # -------------------------
@@ -635,6 +718,9 @@ def intelligence_menu():
     • B - Return to main menu
     :return: None
     """
+    # Masks and MARKs are cached so analysing the same map again is quick
+    cache = intelligence.AnalysisCache()
+
     while True:
         # Finds all the files in the data directory
         file_names = os.listdir("data")
@@ -653,35 +739,27 @@ def intelligence_menu():
             break
 
         if user_choice.lower() == 'fr':  # Filter red pixels
-            intelligence.find_red_pixels(file_name, upper_threshold=100, lower_threshold=50)
+            intelligence.find_red_pixels(file_name, upper_threshold=100, lower_threshold=50, cache=cache)
 
         elif user_choice.lower() == 'fc':  # Filter cyan pixels
-            intelligence.find_cyan_pixels(file_name, upper_threshold=100, lower_threshold=50)
+            intelligence.find_cyan_pixels(file_name, upper_threshold=100, lower_threshold=50, cache=cache)
 
         elif user_choice.lower() == 'cc':  # Find connected components
             # Find the type of pixel the user wishes to find connected components for
             filter_choice = get_valid_user_input(Menu.Filter.options, Menu.Filter.regex)
-            if filter_choice.lower() == 'fr':
-                filtered = intelligence.find_red_pixels(file_name, upper_threshold=100, lower_threshold=50)
-
-            else:
-                filtered = intelligence.find_cyan_pixels(file_name, upper_threshold=100, lower_threshold=50)
-
-            intelligence.detect_connected_components(filtered)
+            mark = cached_mark(cache, file_name, filter_choice)
+            intelligence.write_component_sizes("cc-output-2a.txt", intelligence.component_sizes(mark))
 
         elif user_choice.lower() == 'scc':  # Find connected components sorted
             # Find the type of pixel the user wishes to find connected components for
             filter_choice = get_valid_user_input(Menu.Filter.options, Menu.Filter.regex)
-
-            if filter_choice.lower() == 'fr':
-                filtered = intelligence.find_red_pixels(file_name, upper_threshold=100, lower_threshold=50)
-
-            else:
-                filtered = intelligence.find_cyan_pixels(file_name, upper_threshold=100, lower_threshold=50)
-
-            mark = intelligence.detect_connected_components(filtered)
+            mark = cached_mark(cache, file_name, filter_choice)
+            intelligence.write_component_sizes("cc-output-2a.txt", intelligence.component_sizes(mark))
             intelligence.detect_connected_components_sorted(mark)
 
+        # Output images are written in the background, wait for them so write errors are not lost
+        intelligence.IMAGE_WRITER.flush()
+
 
 def about():
     """
@@ -710,4 +788,7 @@ def quit():
 
 
 if __name__ == '__main__':
-    main_menu()
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch(sys.argv[2:])
+    else:
+        main_menu()
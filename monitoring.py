@@ -7,12 +7,55 @@
 # 
 # You can access the API documentation here http://api.erg.ic.ac.uk/AirQuality/help
 #
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
 import csv
-import requests
 import datetime
+import hashlib
+import json
 import math
+import os
+import re
+import threading
+import time
 import utils
 
+# Base url of the LondonAir API, every endpoint is appended to this
+API_URL = "http://api.erg.ic.ac.uk/AirQuality"
+# Most API calls that are made at the same time, which is also the number of connections kept open
+MAX_CONCURRENT_REQUESTS = 4
+# Seconds to wait for the API to respond
+REQUEST_TIMEOUT = 30
+# Species fetched by get_current_data, as (species code in the API, key used in the rest of the AQUA system)
+SPECIES = [("NO", "no"), ("PM10", "pm10"), ("PM25", "pm25")]
+# Days of data get_current_data asks for in each call, long ranges are split into windows of this many days
+CHUNK_DAYS = 7
+# Times a failed call for one window is tried again, waiting RETRY_DELAY seconds (doubled each time) in between
+CHUNK_RETRIES = 3
+RETRY_DELAY = 0.5
+
+# Directory and size limit of the cache of API responses
+CACHE_DIRECTORY = "api-cache"
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Seconds a cached response is used for before asking the API again, by the start of the endpoint (first match is used)
+# None keeps the response forever, Data/SiteSpecies calls are handled by cache_ttl
+CACHE_TTLS = [
+    ("Information/Groups", 7 * 24 * 60 * 60),
+    ("Information/Species", 7 * 24 * 60 * 60),
+    ("Information/MonitoringSites", 24 * 60 * 60),
+    ("Information/News", 60 * 60),
+    ("Data/SiteSpecies", 15 * 60)
+]
+CACHE_DEFAULT_TTL = 5 * 60
+# Days after the end of a date range (in GMT) before its data is kept forever, readings are published late and revised
+CACHE_SETTLED_DAYS = 2
+# In offline mode no calls are made to the API and cached responses are used however old they are
+OFFLINE = os.environ.get("AQUA_OFFLINE", "") not in ("", "0")
+
+# Session shared by every API call so connections are kept alive and reused, made by get_session when it is first needed
+session = None
+session_lock = threading.Lock()
+
 # -------------------------
 # Data presentation functions
 # -------------------------
@@ -214,9 +257,7 @@ def make_graph(data: list[dict], pollutant: str):
         values.append(d[pollutant])
 
     # Get the values of the input pollutant and convert them to floats
-    values_for_min_max = values.copy()
-    utils.remove_no_value(values_for_min_max)
-    values_as_float = [float(value) for value in values_for_min_max]
+    values_as_float = utils.filter_no_value(values).tolist()
 
     # Find the min and max values and find the range
     max_value_index = utils.maxvalue(values_as_float)
@@ -272,26 +313,330 @@ def make_graph(data: list[dict], pollutant: str):
 # -------------------------
 
 
+def get_session():
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the session shared by every API call, making it the first time
+    The session keeps connections to the API open (keep-alive) so later calls do not have to connect again,
+    its connection pool holds MAX_CONCURRENT_REQUESTS connections so calls made at the same time each get one
+
+    :return: requests.Session
+    """
+    global session
+    with session_lock:
+        if session is None:
+            # requests takes a long time to import, so it is only imported when the first call is made
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            new_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+            new_session.mount("http://", adapter)
+            new_session.mount("https://", adapter)
+            session = new_session
+    return session
+
+
+def cache_ttl(endpoint: str, today: Union[datetime.date, None] = None) -> Union[float, None]:
+    """
+    ---------------
+    Description
+    ---------------
+    Gets the number of seconds a response to an endpoint can be cached for before it is checked with the API again
+    Data for a date range that ended at least CACHE_SETTLED_DAYS ago will not change, so it is kept forever
+    Readings are published hours late and then revised, so more recent ranges are checked again like live data
+    The API's dates are in GMT, so today is the date in GMT rather than the local date
+
+    :param endpoint: Endpoint of the API call, see make_api_call
+    :param today: Today's date in GMT, None uses the real date
+    :return: Seconds to keep the response, None to keep it forever
+    """
+    endpoint = endpoint.lstrip('/')
+    end_date = re.search(r"EndDate=(\d{4}-\d{2}-\d{2})", endpoint)
+    if endpoint.startswith("Data/") and end_date is not None:
+        if today is None:
+            today = datetime.datetime.now(datetime.timezone.utc).date()
+        if datetime.date.fromisoformat(end_date.group(1)) <= today - datetime.timedelta(days=CACHE_SETTLED_DAYS):
+            return None
+
+    for start, ttl in CACHE_TTLS:
+        if endpoint.startswith(start):
+            return ttl
+    return CACHE_DEFAULT_TTL
+
+
+class ResponseCache:
+    """
+    ---------------
+    Description
+    ---------------
+    Cache of API responses stored on disk as one JSON file per endpoint, so screens can be shown without waiting for the API
+    Each entry keeps the response, when it was stored and the ETag and Last-Modified headers so it can be checked with the API
+    The modification time of an entry is updated each time it is used,
+    when the directory is larger than max_bytes the least recently used entries are removed first
+    The total size is kept as a running count, so the directory is only listed when the count goes over max_bytes
+    """
+
+    def __init__(self, directory: str = CACHE_DIRECTORY, max_bytes: int = CACHE_MAX_BYTES):
+        """
+        :param directory: Directory to store the entries in, made when the first entry is stored
+        :param max_bytes: Largest total size of the entries in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Total size of the entries, None until the directory is first listed
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, endpoint: str) -> str:
+        """
+        :param endpoint: Endpoint of the API call
+        :return: Path of the entry for the endpoint
+        """
+        return os.path.join(self.directory, hashlib.sha256(endpoint.lstrip('/').encode()).hexdigest() + ".json")
+
+    def get(self, endpoint: str) -> Union[dict, None]:
+        """
+        :param endpoint: Endpoint of the API call
+        :return: Entry with the keys body, stored, etag and last_modified, None if there is no entry
+        """
+        path = self.path(endpoint)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, endpoint: str, body, etag: Union[str, None] = None, last_modified: Union[str, None] = None):
+        """
+        ---------------
+        Description
+        ---------------
+        Stores a response, replacing any entry for the endpoint
+        The entry is written to a temporary file and then moved into place, so a reader never sees half an entry
+
+        :param endpoint: Endpoint of the API call
+        :param body: Decoded JSON response
+        :param etag: ETag header of the response
+        :param last_modified: Last-Modified header of the response
+        :return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(endpoint)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump({"endpoint": endpoint.lstrip('/'), "stored": time.time(), "etag": etag, "last_modified": last_modified,
+                       "body": body}, f)
+        new_size = os.path.getsize(temporary_path)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(temporary_path, path)
+
+        with self.lock:
+            if self.size is None:
+                # Listing the directory counts the new entry too
+                self.size = sum(size for _, size, _ in self.entries())
+            else:
+                self.size += new_size - old_size
+            too_large = self.size > self.max_bytes
+        if too_large:
+            self.evict()
+
+    def refresh(self, endpoint: str, entry: dict):
+        """
+        Marks an entry as just checked with the API, so its time to live starts again
+        :param endpoint: Endpoint of the API call
+        :param entry: Entry from get
+        :return: None
+        """
+        self.put(endpoint, entry["body"], entry["etag"], entry["last_modified"])
+
+    def entries(self) -> list:
+        """
+        :return: List of (modification time, size, file name) of each entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    status = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((status.st_mtime_ns, status.st_size, name))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size is no more than max_bytes
+        :return: None
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Already removed by another thread
+                pass
+            total -= size
+        with self.lock:
+            self.size = total
+
+
+# Cache used by make_api_call, set to None to turn caching off
+response_cache = ResponseCache()
+
+
 def make_api_call(endpoint: str):
     """
     ---------------
     Description
     ---------------
     Takes the last part of the url to make the API call
+    Responses are cached (see response_cache and cache_ttl), a cached response that is too old is checked with the API
+    using its ETag or Last-Modified header and only downloaded again if it has changed
+    If the API can not be reached (or OFFLINE is set) an old cached response is used rather than failing
 
     ---------------
     General Overview
     ---------------
+    Use the cached response if it is new enough
     Append the endpoint to form a url
-    Make http request with the url
+    Make http request with the url, using the shared session
+    If the response has not changed use the cached one, otherwise cache the new one
     Return the data
 
+    ---------------
+    Raises
+    ---------------
+    ConnectionError when offline and the response is not cached
+    requests.RequestException when the API can not be reached or has a server error and the response is not cached
+
     :param endpoint: Remaining part of the url
     :return: Response from API
     """
-    url = f"http://api.erg.ic.ac.uk/AirQuality/{endpoint}"
-    res = requests.get(url)
-    return res.json()
+    entry = response_cache.get(endpoint) if response_cache is not None else None
+    if entry is not None:
+        ttl = cache_ttl(endpoint)
+        if OFFLINE or ttl is None or time.time() - entry["stored"] < ttl:
+            return entry["body"]
+    elif OFFLINE:
+        raise ConnectionError(f"No cached response for {endpoint} while offline")
+
+    # Ask the API to only send the response if it has changed since it was cached
+    headers = {}
+    if entry is not None and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry is not None and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    import requests
+    url = f"{API_URL}/{endpoint.lstrip('/')}"
+    try:
+        res = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        # A server error is treated the same as not reaching the API
+        if res.status_code >= 500:
+            res.raise_for_status()
+    except requests.RequestException:
+        if entry is not None:
+            return entry["body"]
+        raise
+
+    if res.status_code == 304 and entry is not None:
+        response_cache.refresh(endpoint, entry)
+        return entry["body"]
+
+    body = res.json()
+    if res.ok and response_cache is not None:
+        response_cache.put(endpoint, body, res.headers.get("ETag"), res.headers.get("Last-Modified"))
+    return body
+
+
+def make_api_call_retrying(endpoint: str, retries: int = CHUNK_RETRIES):
+    """
+    ---------------
+    Description
+    ---------------
+    Makes an API call, trying again if the API can not be reached, has a server error or sends a broken response
+    The wait between tries starts at RETRY_DELAY and doubles each time
+
+    ---------------
+    Raises
+    ---------------
+    The error of the last try when every try fails
+
+    :param endpoint: Endpoint of the API call, see make_api_call
+    :param retries: Number of times to try again
+    :return: Response from API
+    """
+    import requests
+    for attempt in range(retries + 1):
+        try:
+            return make_api_call(endpoint)
+        except (requests.RequestException, ValueError):
+            # requests' JSONDecodeError is a ValueError
+            if attempt == retries:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def make_api_calls(endpoints: list, max_workers: int = MAX_CONCURRENT_REQUESTS, retries: int = 0) -> list:
+    """
+    ---------------
+    Description
+    ---------------
+    Makes several API calls at the same time on a pool of threads, so they take about as long as the slowest one
+    rather than the total of all of them
+    Each call is tried again on its own when it fails, see make_api_call_retrying
+
+    :param endpoints: List of endpoints, see make_api_call
+    :param max_workers: Most calls to make at the same time
+    :param retries: Number of times to try each call again
+    :return: List of responses, in the same order as the endpoints
+    """
+    def call(endpoint):
+        return make_api_call_retrying(endpoint, retries)
+
+    if len(endpoints) <= 1 or max_workers <= 1:
+        return [call(endpoint) for endpoint in endpoints]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(endpoints))) as executor:
+        return list(executor.map(call, endpoints))
+
+
+def date_chunks(start_date: datetime.date, end_date: datetime.date, days: int = CHUNK_DAYS) -> list[tuple]:
+    """
+    ---------------
+    Description
+    ---------------
+    Splits a date range into windows of a fixed number of days
+    Windows are counted from 0001-01-01 (a Monday) rather than from start_date, so weekly windows always run Monday to Monday
+    and ranges that overlap share the same windows (and their cached responses), only the first and last are cut short
+    A range that starts and ends on the same date is kept as one window, so it is still asked for
+
+    :param start_date: First date of the range
+    :param end_date: End date of the range
+    :param days: Length of each window in days
+    :return: List of (start date, end date) of each window, in order
+    """
+    if start_date == end_date:
+        return [(start_date, end_date)]
+
+    chunks = []
+    chunk_start = start_date
+    while chunk_start < end_date:
+        # Start of the next window after chunk_start
+        chunk_end = datetime.date.fromordinal(chunk_start.toordinal() + days - (chunk_start.toordinal() - 1) % days)
+        chunks.append((chunk_start, min(chunk_end, end_date)))
+        chunk_start = chunk_end
+    return chunks
 
 
 def get_monitoring_sites(group: str) -> str:
@@ -344,55 +689,55 @@ def get_groups() -> str:
     return table
 
 
-def get_current_data(start_date: datetime.date, end_date: datetime.date, site_code: str) -> list[dict]:
+def get_current_data(start_date: datetime.date, end_date: datetime.date, site_code: str,
+                     max_workers: int = MAX_CONCURRENT_REQUESTS, chunk_days: int = CHUNK_DAYS) -> list[dict]:
     """
     ---------------
     Description
     ---------------
     Gets data from the specified site between the given dates
+    The range is split into windows of chunk_days (see date_chunks) so long ranges are downloaded as many small calls
+    made at the same time, a call that fails is tried again on its own rather than downloading the whole range again
 
     ---------------
     General Overview
     ---------------
-    Make 3 API calls - One for each of the three pollutants the AQUA System deals with
+    Split the dates into windows
+    Make an API call for each window of each of the three pollutants the AQUA System deals with, several at the same time
     Rename the dictionary keys to ones used in the rest of the AQUA system
     Set empty values to 'No data'
-    Merge the 3 dictionaries into one
-    Turn into list of dicts in the correct format
+    Merge the readings with the same time into one dictionary
+    Turn into list of dicts in the correct format, in time order
 
     :param start_date: Date to start getting data for
     :param end_date: Date to stop getting data for
     :param site_code: Site to get data from
+    :param max_workers: Most API calls to make at the same time
+    :param chunk_days: Days of data to get in each API call
     :return: List of dicts containing the data for the three pollutants
     """
 
-    # Get data for the three pollutant types between the given dates for the given site
-    res_no = make_api_call(f"Data/SiteSpecies/SiteCode={site_code}/SpeciesCode=NO/StartDate={start_date}/EndDate={end_date}/Json")['RawAQData']['Data']
-    # Rename @value key to 'no' and the @MeasurementDateGMT to 'datetime'
-    for entry in res_no:
-        entry['no'] = entry.pop('@Value')
-        entry['datetime'] = entry.pop('@MeasurementDateGMT')
-        if entry['no'] == '':
-            entry['no'] = 'No data'
-
-    res_pm10 = make_api_call(f"/Data/SiteSpecies/SiteCode={site_code}/SpeciesCode=PM10/StartDate={start_date}/EndDate={end_date}/Json")['RawAQData']['Data']
-    for entry in res_pm10:
-        entry['pm10'] = entry.pop('@Value')
-        entry['datetime'] = entry.pop('@MeasurementDateGMT')
-        if entry['pm10'] == '':
-            entry['pm10'] = 'No data'
-
-    res_pm25 = make_api_call(f"/Data/SiteSpecies/SiteCode={site_code}/SpeciesCode=PM25/StartDate={start_date}/EndDate={end_date}/Json")['RawAQData']['Data']
-    for entry in res_pm25:
-        entry['pm25'] = entry.pop('@Value')
-        entry['datetime'] = entry.pop('@MeasurementDateGMT')
-        if entry['pm25'] == '':
-            entry['pm25'] = 'No data'
-
-    # Merge all the dictionaries into one and reformat datetime
+    # Get data for the three pollutant types for each window between the given dates for the given site
+    chunks = date_chunks(start_date, end_date, chunk_days)
+    calls = [(key, f"Data/SiteSpecies/SiteCode={site_code}/SpeciesCode={code}/StartDate={chunk_start}/EndDate={chunk_end}/Json")
+             for code, key in SPECIES for chunk_start, chunk_end in chunks]
+    responses = make_api_calls([endpoint for _, endpoint in calls], max_workers, CHUNK_RETRIES)
+
+    # Merge the readings by time, windows may overlap at their ends so a reading can come more than once
+    readings = {}
+    for (key, _), res in zip(calls, responses):
+        for entry in res['RawAQData']['Data']:
+            # Rename @value key to the species key (e.g. 'no') and the @MeasurementDateGMT to 'datetime'
+            reading = readings.setdefault(entry['@MeasurementDateGMT'], {})
+            reading[key] = entry['@Value'] if entry['@Value'] != '' else 'No data'
+            reading['datetime'] = entry['@MeasurementDateGMT']
+
+    # Reformat datetime, in time order
     data = []
-    for i in range(len(res_no)):
-        merged = res_no[i] | res_pm10[i] | res_pm25[i]
+    for timestamp in sorted(readings):
+        merged = readings[timestamp]
+        for _, key in SPECIES:
+            merged.setdefault(key, 'No data')
         merged['datetime'] = datetime.datetime.fromisoformat(merged['datetime'])
         merged['date'] = str(merged['datetime'].date())
         merged['time'] = str((merged['datetime'] + datetime.timedelta(hours=1)).time()) if str(merged['datetime'].time()) != '23:00:00' else '24:00:00'
@@ -162,8 +162,7 @@ def daily_average(data, monitoring_station, pollutant):
         # Get data for the day
         daily_data = get_time_range(station_data, start_date, start_date + time_delta, pollutant)
         # Remove 'No data' entries and convert to data to floats
-        utils.remove_no_value(daily_data)
-        daily_data = [float(d) for d in daily_data]
+        daily_data = utils.filter_no_value(daily_data).tolist()
 
         # If there is no data of the day the output for that day is 'No data'
         if len(daily_data) == 0:
@@ -217,8 +216,7 @@ def daily_median(data, monitoring_station, pollutant):
         day_values = get_time_range(station_data, start_date, start_date + time_delta, pollutant)
         # Remove 'No data' entries and convert data to floats and sort
         # This may change the length of the list so later indexes could be any length
-        utils.remove_no_value(day_values)
-        day_values = [float(d) for d in day_values]
+        day_values = utils.filter_no_value(day_values).tolist()
         sorted_values = sort(day_values)
 
         # If there is no data for all values in the day, return 'No data' as median
@@ -293,8 +291,7 @@ def hourly_average(data, monitoring_station, pollutant):
             start_date += time_delta_day
 
         # Remove 'No data' entries and convert to floats
-        utils.remove_no_value(hour_values)
-        hour_values = [float(value) for value in hour_values]
+        hour_values = utils.filter_no_value(hour_values).tolist()
 
         # If there is no data return 'No data' as the average for that hour, otherwise, find the mean
         if len(hour_values) == 0:
@@ -352,8 +349,7 @@ def monthly_average(data, monitoring_station, pollutant):
     for i in range(12):
         end_date = add_month(start_date)
         month_values = get_time_range(station_data, start_date, end_date, pollutant)
-        utils.remove_no_value(month_values)
-        month_values = [float(value) for value in month_values]
+        month_values = utils.filter_no_value(month_values).tolist()
 
         # If there is no data for the month append 'No data' for that month, otherwise, find the mean
         if len(month_values) == 0:
@@ -394,8 +390,7 @@ def peak_hour_date(data, date, monitoring_station, pollutant):
 
     # Gets all the values for the specified date and remove 'No data'
     day_values = get_time_range(station_data, date, date + time_delta, pollutant)
-    utils.remove_no_value(day_values)
-    day_values = [float(value) for value in day_values]
+    day_values = utils.filter_no_value(day_values).tolist()
 
     # If all the values for the day are 'No data' and hence removed
     if len(day_values) == 0:
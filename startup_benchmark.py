@@ -0,0 +1,121 @@
+# Measures how long the program takes to start and how much of that is spent importing each module
+# Usage: python startup_benchmark.py [--runs N] [--json]
+#
+# Every measurement is made in a new interpreter (python -X importtime) so modules imported by an earlier
+# measurement do not make later ones look faster, the fastest of the runs is reported
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+
+# Modules of the program and the libraries they depend on
+MODULES = ["main", "reporting", "monitoring", "intelligence", "utils", "numpy", "matplotlib.pyplot", "requests"]
+
+# Lines written by -X importtime look like "import time:       437 |      77607 |     requests"
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def parse_import_times(text: str) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Reads the output of python -X importtime
+
+    :param text: Text written to stderr by the interpreter
+    :return: Dictionary of module name to (self time, cumulative time) in seconds
+    """
+    times = {}
+    for line in text.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)) / 1e6, int(match.group(2)) / 1e6)
+    return times
+
+
+def import_times(statement: str, runs: int = 5) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Runs a statement in a new interpreter several times and times every import it makes
+
+    :param statement: Python statement to run, e.g. "import main"
+    :param runs: Number of times to run it
+    :return: Dictionary of module name to (self time, cumulative time) in seconds, the fastest of the runs
+    """
+    best = {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+        for name, times in parse_import_times(result.stderr).items():
+            if name not in best or times[1] < best[name][1]:
+                best[name] = times
+    return best
+
+
+def wall_time(statement: str, runs: int = 5) -> float:
+    """
+    :param statement: Python statement to run in a new interpreter
+    :param runs: Number of times to run it
+    :return: Fastest time in seconds to start the interpreter, run the statement and exit
+    """
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(runs: int = 5) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Measures the start up time of the program
+    • startup - Time to start the interpreter and import main, and the same for an empty program
+    • imported_by_main - Cumulative import time of each module when main is imported, None if main does not import it
+    • on_its_own - Cumulative import time of each module imported on its own
+
+    :param runs: Number of times to run each measurement
+    :return: Dictionary of the results, times in seconds
+    """
+    by_main = import_times("import main", runs)
+    return {
+        "runs": runs,
+        "startup": {"import main": wall_time("import main", runs), "empty": wall_time("pass", runs)},
+        "imported_by_main": {name: by_main[name][1] if name in by_main else None for name in MODULES},
+        "on_its_own": {name: import_times(f"import {name}", runs)[name][1] for name in MODULES}
+    }
+
+
+def print_report(results: dict):
+    """
+    Prints the results of benchmark as a table
+    :param results: Results from benchmark
+    :return: None
+    """
+    startup = results["startup"]
+    print(f"Start up (import main): {startup['import main'] * 1000:8.1f} ms")
+    print(f"Empty interpreter:      {startup['empty'] * 1000:8.1f} ms")
+    print()
+    print(f"{'Module':<20}{'Imported by main':>18}{'On its own':>14}")
+    for name in MODULES:
+        by_main = results["imported_by_main"][name]
+        by_main_text = "not imported" if by_main is None else f"{by_main * 1000:.1f} ms"
+        print(f"{name:<20}{by_main_text:>18}{results['on_its_own'][name] * 1000:>11.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure start up time and the import cost of each module")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    options = parser.parse_args()
+
+    benchmark_results = benchmark(options.runs)
+    if options.json:
+        print(json.dumps(benchmark_results, indent=2))
+    else:
+        print_report(benchmark_results)
@@ -1,6 +1,11 @@
+import concurrent.futures
 import pytest
 import intelligence
 import numpy as np
+import os
+import struct
+import threading
+import zlib
 
 
 class TestCustom:
@@ -28,6 +33,67 @@ class TestCustom:
             img_shape = img.shape
             assert img_shape == (1140, 1053, 4)
 
+    class TestLoadImage:
+
+        @pytest.fixture
+        def full(self):
+            """
+            Fixture for the whole map as uint8 values
+            :return: 3d uint8 numpy array
+            """
+            return np.round(intelligence.read_image("map.png") * 255).astype(np.uint8)
+
+        @pytest.mark.parametrize(["region", "step", "expected_slice"], [
+            (None, 1, np.s_[:, :]),
+            (None, 3, np.s_[::3, ::3]),
+            ((100, 200, 300, 500), 1, np.s_[100:301, 200:501]),
+            ((101, 7, 900, 1052), 4, np.s_[101:901:4, 7:1053:4]),
+            ((-5, -5, 5000, 5000), 7, np.s_[::7, ::7]),
+            ((1139, 1052, 1139, 1052), 1, np.s_[1139:, 1052:])
+        ])
+        def test_expected(self, full, region, step, expected_slice):
+            """
+            Test the region and step give the same pixels as slicing the whole image
+            :param full: Whole map fixture
+            :param region: Region to read
+            :param step: Step between pixels
+            :param expected_slice: Slice of the whole map that should be returned
+            :return: None
+            """
+            img = intelligence.load_image("map.png", region, step)
+            assert img.dtype == np.uint8
+            assert np.array_equal(img, full[expected_slice])
+
+        def test_cached(self):
+            """
+            Test loading the same region again gives the cached, read only array
+            :return: None
+            """
+            first = intelligence.load_image("map.png", (0, 0, 49, 49))
+            assert intelligence.load_image("map.png", (0, 0, 49, 49)) is first
+            assert not first.flags.writeable
+
+        @pytest.mark.parametrize(["region", "step"], [
+            ((2000, 0, 2100, 10), 1),
+            (None, 0)
+        ])
+        def test_invalid(self, region, step):
+            """
+            Test a ValueError is raised for a region outside the image or a step less than 1
+            :param region: Region to read
+            :param step: Step between pixels
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                intelligence.load_image("map.png", region, step)
+
+        def test_missing(self):
+            """
+            Test None is returned when the file does not exist
+            :return: None
+            """
+            assert intelligence.load_image("This image does not exist.png") is None
+
     class TestConditions:
 
         @pytest.fixture
@@ -142,6 +208,276 @@ class TestCustom:
 
             assert (intelligence.filter_pixels(arr, 100, 50, intelligence.red_pixel_condition) == expected).all()
 
+    class TestPixelMask:
+
+        @pytest.fixture
+        def map_array(self):
+            """
+            Fixture for mock map data with red and cyan pixels
+            :return: 3d numpy array containing mock pixel data
+            """
+            arr = [[[255, 40, 30], [255, 255, 255], [255, 255, 255]],
+                   [[255, 255, 255], [255, 10, 49], [255, 255, 255]],
+                   [[255, 255, 255], [10, 255, 255], [255, 42, 32]]]
+            return np.array(arr)
+
+        @pytest.mark.parametrize(["condition", "mask_condition"], [
+            (intelligence.red_pixel_condition, intelligence.red_pixel_mask),
+            (intelligence.cyan_pixel_condition, intelligence.cyan_pixel_mask)
+        ])
+        def test_matches_per_pixel_condition(self, map_array, condition, mask_condition):
+            """
+            Test the whole image predicates agree with the per pixel conditions at every pixel
+            :param map_array: Mock map data
+            :param condition: Per pixel condition
+            :param mask_condition: Whole image predicate
+            :return: None
+            """
+            mask = intelligence.pixel_mask(map_array, 100, 50, mask_condition)
+            for x in range(3):
+                for y in range(3):
+                    assert mask[x, y] == condition(map_array, 100, 50, x, y)
+
+        def test_fallback_condition(self, map_array):
+            """
+            Test that a per pixel condition without a whole image version is still evaluated for every pixel
+            :param map_array: Mock map data
+            :return: None
+            """
+            def blue_condition(map_file, upper_threshold, lower_threshold, x, y):
+                return map_file[x, y, 2] < lower_threshold
+
+            mask = intelligence.pixel_mask(map_array, 100, 50, blue_condition)
+            assert mask.tolist() == [[True, False, False], [False, True, False], [False, False, True]]
+
+        def test_top_two_mask(self):
+            """
+            Test the top two predicate picks out both values
+            :return: None
+            """
+            arr = np.array([[100, 100, 50], [50, 5, 3], [5, 70, 3]])
+            mask = intelligence.pixel_mask(arr, 100, 50, intelligence.top_two_condition)
+            assert mask.tolist() == [[True, True, True], [True, False, False], [False, False, False]]
+
+    class TestColourLut:
+
+        @pytest.fixture
+        def rules(self):
+            """
+            Fixture for red and cyan colour rules
+            :return: List of (condition, upper threshold, lower threshold)
+            """
+            return [(intelligence.red_pixel_condition, 100, 50), (intelligence.cyan_pixel_condition, 100, 50)]
+
+        def test_matches_masks(self, rules):
+            """
+            Test classifying the map with the lookup table matches the mask of each colour
+            :param rules: Rules fixture
+            :return: None
+            """
+            map_file = intelligence.read_image("map.png") * 255
+            classes = intelligence.classify_pixels(map_file, intelligence.build_colour_lut(rules))
+            assert np.array_equal(classes == 1, intelligence.pixel_mask(map_file, 100, 50, intelligence.red_pixel_condition))
+            assert np.array_equal(classes == 2, intelligence.pixel_mask(map_file, 100, 50, intelligence.cyan_pixel_condition))
+            assert np.array_equal(intelligence.segment_map(intelligence.data_path("map.png"), rules, block_rows=100), classes)
+
+        def test_first_rule_wins(self):
+            """
+            Test a colour meeting more than one rule gets the class of the first
+            :return: None
+            """
+            rules = [(intelligence.red_pixel_condition, 100, 50), (intelligence.red_pixel_condition, 50, 60)]
+            lut = intelligence.build_colour_lut(rules)
+            pixels = np.array([[[200, 0, 0], [80, 55, 55], [200, 55, 0], [0, 0, 0]]], dtype=np.uint8)
+            assert intelligence.classify_pixels(pixels, lut).tolist() == [[1, 2, 2, 0]]
+
+        @pytest.mark.parametrize("bits", [0, 9])
+        def test_invalid_bits(self, rules, bits):
+            """
+            Test a ValueError is raised for a number of bits that can not be used
+            :param rules: Rules fixture
+            :param bits: Invalid number of bits
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                intelligence.build_colour_lut(rules, bits)
+
+        @pytest.mark.parametrize("connectivity", [4, 8])
+        def test_label_classes(self, connectivity):
+            """
+            Test labelling every class at once matches labelling each class on its own
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            classes = np.random.default_rng(1).integers(0, 4, (30, 20)).astype(np.uint8)
+            mark, component_class = intelligence.label_classes(classes, connectivity)
+            for class_number in range(1, 4):
+                expected = intelligence.label_union_find(classes == class_number, connectivity)
+                assert np.array_equal(intelligence.class_mark(mark, component_class, class_number), expected)
+
+
+    class TestBinaryMask:
+
+        @pytest.fixture
+        def mask(self):
+            """
+            Fixture for a small binary mask
+            :return: BinaryMask with a diagonal line
+            """
+            return intelligence.BinaryMask(np.eye(3, 5, dtype=bool))
+
+        def test_rgb(self, mask):
+            """
+            Test the RGB form is white where the mask is on and black elsewhere
+            :param mask: Binary mask fixture
+            :return: None
+            """
+            rgb = mask.to_rgb()
+            assert rgb.shape == mask.shape == (3, 5, 3)
+            assert rgb.dtype == np.uint8
+            assert (rgb[:, :, 0] == np.eye(3, 5) * 255).all()
+            assert (np.asarray(mask) == rgb).all()
+
+        def test_pack_round_trip(self, mask):
+            """
+            Test that packing and unpacking gives back the same mask
+            :param mask: Binary mask fixture
+            :return: None
+            """
+            packed = mask.pack()
+            assert packed.nbytes == 2
+            assert (intelligence.BinaryMask.from_packed(packed, (3, 5)).mask == mask.mask).all()
+
+        def test_memory(self):
+            """
+            Test the mask uses 24 times less memory than a float64 RGB array
+            :return: None
+            """
+            mask = intelligence.BinaryMask(np.zeros((100, 100)))
+            assert mask.nbytes * 24 == np.zeros((100, 100, 3)).nbytes
+
+        @pytest.mark.parametrize("img", [
+            intelligence.BinaryMask(np.eye(3)),
+            np.eye(3)[:, :, np.newaxis].repeat(3, axis=2) * 255,
+            np.eye(3, dtype=np.uint8)
+        ])
+        def test_as_binary_mask(self, img):
+            """
+            Test each form of binary image gives the same bool mask
+            :param img: Binary image
+            :return: None
+            """
+            assert (intelligence.as_binary_mask(img) == np.eye(3, dtype=bool)).all()
+
+    class TestImageWriter:
+
+        @pytest.mark.parametrize("width", [1, 7, 8, 9, 17])
+        def test_mask_round_trip(self, tmp_path, width):
+            """
+            Test a mask written as a 1 bit png is read back the same, for widths that do and do not fill the last byte
+            :param tmp_path: Directory to write the image to
+            :param width: Width of the mask
+            :return: None
+            """
+            mask = np.random.default_rng(width).random((5, width)) < 0.5
+            path = intelligence.write_mask_png(str(tmp_path / "mask.png"), mask)
+            assert np.array_equal(intelligence.as_binary_mask(intelligence.read_image(path)), mask)
+
+        def test_labels_round_trip(self, tmp_path):
+            """
+            Test MARK with few components is written as a palette png and with many as a npy file, both read back the same
+            :param tmp_path: Directory to write the images to
+            :return: None
+            """
+            few = np.array([[0, 1, 1], [2, 0, 255]])
+            path = intelligence.write_label_image(str(tmp_path / "few.png"), few)
+            assert path.endswith(".png")
+            assert np.array_equal(intelligence.read_label_image(path), few)
+
+            many = np.arange(300).reshape(15, 20)
+            path = intelligence.write_label_image(str(tmp_path / "many.png"), many)
+            assert path.endswith("many.npy")
+            assert np.array_equal(intelligence.read_label_image(path), many)
+
+        def test_background(self, tmp_path):
+            """
+            Test writes in the background are finished by flush and use a copy of the data
+            :param tmp_path: Directory to write the images to
+            :return: None
+            """
+            writer = intelligence.ImageWriter()
+            mask = np.eye(4, dtype=bool)
+            writer.write_mask(str(tmp_path / "mask.png"), mask)
+            writer.write_labels(str(tmp_path / "labels.png"), mask.astype(int))
+            mask[:] = False
+            writer.flush()
+            assert np.array_equal(intelligence.as_binary_mask(intelligence.read_image(str(tmp_path / "mask.png"))), np.eye(4))
+            assert np.array_equal(intelligence.read_label_image(str(tmp_path / "labels.png")), np.eye(4))
+
+        def test_error(self, tmp_path):
+            """
+            Test an error while writing in the background is raised by flush
+            :param tmp_path: Temporary directory
+            :return: None
+            """
+            writer = intelligence.ImageWriter()
+            writer.write_mask(str(tmp_path / "missing" / "mask.png"), np.eye(3))
+            with pytest.raises(FileNotFoundError):
+                writer.flush()
+
+        def test_threads(self, tmp_path):
+            """
+            Test threads sharing a writer each wait for their own writes and only get their own errors
+            :param tmp_path: Temporary directory
+            :return: None
+            """
+            writer = intelligence.ImageWriter()
+            errors = {}
+
+            def task(number):
+                directory = tmp_path / str(number)
+                # Odd numbered tasks write to a directory that does not exist
+                if number % 2 == 0:
+                    directory.mkdir()
+                for image in range(5):
+                    writer.write_mask(str(directory / f"{image}.png"), np.eye(50))
+                try:
+                    writer.flush()
+                    errors[number] = None
+                    assert len(os.listdir(directory)) == 5
+                except FileNotFoundError as error:
+                    errors[number] = error
+
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                list(executor.map(task, range(8)))
+            for number in range(8):
+                assert (errors[number] is None) == (number % 2 == 0)
+                if errors[number] is not None:
+                    assert f"{os.sep}{number}{os.sep}" in str(errors[number].filename)
+            assert writer.pending == {}
+
+        def test_relative_path(self, tmp_path, monkeypatch):
+            """
+            Test a relative path is resolved when the write is queued, not when it runs
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            writer = intelligence.ImageWriter()
+            (tmp_path / "queued").mkdir()
+            (tmp_path / "later").mkdir()
+            started = threading.Event()
+            # Hold the background thread so the write runs after the working directory has changed
+            writer.submit(lambda path, data: started.wait(5), "unused", None)
+            monkeypatch.chdir(tmp_path / "queued")
+            writer.write_mask("mask.png", np.eye(3))
+            monkeypatch.chdir(tmp_path / "later")
+            started.set()
+            writer.flush()
+            assert os.listdir(tmp_path / "queued") == ["mask.png"]
+            assert os.listdir(tmp_path / "later") == []
+
+
     class TestQueuePop:
 
         @pytest.mark.parametrize(["queue", "head", "output"], [
@@ -227,6 +563,1060 @@ class TestCustom:
             assert count == expected
 
 
+    class TestLabelUnionFind:
+
+        @pytest.mark.parametrize(["connectivity", "expected"], [
+            (8, [[1, 0, 1, 1],
+                 [0, 1, 0, 1],
+                 [0, 0, 0, 0],
+                 [2, 2, 0, 3]]),
+            (4, [[1, 0, 2, 2],
+                 [0, 3, 0, 2],
+                 [0, 0, 0, 0],
+                 [4, 4, 0, 5]])
+        ])
+        def test_expected(self, connectivity, expected):
+            """
+            Test components are found and numbered in raster order for both connectivities
+            :param connectivity: 4 or 8
+            :param expected: Expected MARK
+            :return: None
+            """
+            mask = np.array([[1, 0, 1, 1],
+                             [0, 1, 0, 1],
+                             [0, 0, 0, 0],
+                             [1, 1, 0, 1]], dtype=bool)
+            assert intelligence.label_union_find(mask, connectivity).tolist() == expected
+
+        def test_matches_bfs(self, tmp_path, monkeypatch):
+            """
+            Test the union-find engine gives the same MARK as the bfs engine on random images
+            :param tmp_path: Directory to write the output files to
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            monkeypatch.chdir(tmp_path)
+            rng = np.random.default_rng(0)
+            for i in range(20):
+                mask = rng.random((12, 9)) < 0.45
+                bfs = intelligence.detect_connected_components(mask)
+                union_find = intelligence.detect_connected_components(mask, engine="union_find")
+                assert (bfs == union_find).all()
+
+        def test_bad_parameters(self):
+            """
+            Test unknown engines and connectivities raise a ValueError
+            :return: None
+            """
+            mask = np.eye(3, dtype=bool)
+            with pytest.raises(ValueError):
+                intelligence.detect_connected_components(mask, engine="unknown")
+            with pytest.raises(ValueError):
+                intelligence.detect_connected_components(mask, connectivity=4)
+            with pytest.raises(ValueError):
+                intelligence.label_union_find(mask, 6)
+
+
+    class TestRunLabels:
+
+        @pytest.fixture
+        def mask(self):
+            """
+            Fixture for a binary image with runs that touch only diagonally
+            :return: 2d bool array
+            """
+            return np.array([[1, 1, 0, 0, 1],
+                             [0, 0, 1, 0, 1],
+                             [1, 0, 0, 0, 0]], dtype=bool)
+
+        def test_encode_runs(self, mask):
+            """
+            Test each row is split into runs of on pixels
+            :param mask: Binary image fixture
+            :return: None
+            """
+            rows, starts, ends = intelligence.encode_runs(mask)
+            assert rows.tolist() == [0, 0, 1, 1, 2]
+            assert starts.tolist() == [0, 4, 2, 4, 0]
+            assert ends.tolist() == [2, 5, 3, 5, 1]
+
+        @pytest.mark.parametrize(["connectivity", "labels", "sizes"], [
+            (8, [1, 2, 1, 2, 3], [3, 2, 1]),
+            (4, [1, 2, 3, 2, 4], [2, 2, 1, 1])
+        ])
+        def test_label_runs(self, mask, connectivity, labels, sizes):
+            """
+            Test runs are labelled in raster order and their sizes counted
+            :param mask: Binary image fixture
+            :param connectivity: 4 or 8
+            :param labels: Expected label of each run
+            :param sizes: Expected size of each component
+            :return: None
+            """
+            runs = intelligence.label_runs(mask, connectivity)
+            assert runs.labels.tolist() == labels
+            assert runs.sizes().tolist() == sizes
+            assert (runs.to_mark() == intelligence.label_union_find(mask, connectivity)).all()
+
+        def test_empty(self):
+            """
+            Test an image with no on pixels has no runs or components
+            :return: None
+            """
+            runs = intelligence.label_runs(np.zeros((3, 4), dtype=bool))
+            assert runs.component_count == 0
+            assert runs.sizes().tolist() == []
+            assert (runs.to_mark() == 0).all()
+
+        def test_matches_union_find(self):
+            """
+            Test the rle engine gives the same MARK as the union-find engine on random images
+            :return: None
+            """
+            rng = np.random.default_rng(1)
+            for i in range(20):
+                mask = rng.random((10, 13)) < 0.5
+                for connectivity in (4, 8):
+                    assert (intelligence.label_rle(mask, connectivity) == intelligence.label_union_find(mask, connectivity)).all()
+
+
+    class TestPngRows:
+
+        def test_matches_read_image(self):
+            """
+            Test that decoding the map by blocks of rows gives the same pixels as read_image
+            :return: None
+            """
+            blocks = list(intelligence.png_rows(intelligence.data_path("map.png"), 100))
+            assert [first_row for first_row, rows in blocks] == list(range(0, 1140, 100))
+            decoded = np.concatenate([rows for first_row, rows in blocks])
+            expected = np.round(intelligence.read_image("map.png") * 255)
+            assert (decoded == expected).all()
+
+        def test_stop_row(self):
+            """
+            Test that decoding stops at the requested row
+            :return: None
+            """
+            blocks = list(intelligence.png_rows(intelligence.data_path("map.png"), 64, stop_row=10))
+            assert len(blocks) == 1
+            assert blocks[0][1].shape == (10, 1053, 4)
+
+        @staticmethod
+        def filter_row(filter_type, row, prior, bytes_per_pixel):
+            """
+            Applies a PNG filter to one row, written straight from the PNG specification
+            :param filter_type: PNG filter type (0 to 4)
+            :param row: Bytes of the row
+            :param prior: Bytes of the row above
+            :param bytes_per_pixel: Number of bytes in a pixel
+            :return: List of the filtered bytes
+            """
+            filtered = []
+            for i, value in enumerate(row):
+                left = row[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+                above = prior[i]
+                upper_left = prior[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+                estimate = left + above - upper_left
+                distances = [abs(estimate - left), abs(estimate - above), abs(estimate - upper_left)]
+                paeth = left if distances[0] <= distances[1] and distances[0] <= distances[2] else above if distances[1] <= distances[2] else upper_left
+                predictor = [0, left, above, (left + above) // 2, paeth][filter_type]
+                filtered.append((value - predictor) % 256)
+            return filtered
+
+        @pytest.mark.parametrize(["block_rows", "unfilter_bytes"], [(3, 64 * 1024 * 1024), (3, 1), (64, 1), (64, 64 * 1024 * 1024)])
+        def test_filters(self, tmp_path, monkeypatch, block_rows, unfilter_bytes):
+            """
+            Test every filter type is undone, in batches of any size and with rows split across IDAT chunks
+            :param tmp_path: Directory to write the image to
+            :param monkeypatch: Used to change the size of the batches
+            :param block_rows: Rows in each block
+            :param unfilter_bytes: Working memory for each batch, 1 gives batches of one block
+            :return: None
+            """
+            monkeypatch.setattr(intelligence, "PNG_UNFILTER_BYTES", unfilter_bytes)
+            rng = np.random.default_rng(block_rows)
+            # Few different values so the Paeth predictor often has ties
+            image = rng.integers(0, 4, (17, 13, 3)).astype(np.uint8) * 85
+            filter_types = rng.integers(0, 5, 17)
+            filter_types[:5] = [4, 3, 4, 4, 1]
+            data = b""
+            prior = [0] * 39
+            for filter_type, row in zip(filter_types, image.reshape(17, 39).tolist()):
+                data += bytes([filter_type] + self.filter_row(filter_type, row, prior, 3))
+                prior = row
+            compressed = zlib.compress(data)
+            path = tmp_path / "filters.png"
+            path.write_bytes(b"\x89PNG\r\n\x1a\n" + intelligence.png_chunk(b"IHDR", struct.pack(">IIBBBBB", 13, 17, 8, 2, 0, 0, 0)) +
+                             intelligence.png_chunk(b"IDAT", compressed[:50]) + intelligence.png_chunk(b"IDAT", compressed[50:]) +
+                             intelligence.png_chunk(b"IEND", b""))
+
+            blocks = list(intelligence.png_rows(str(path), block_rows))
+            assert [first_row for first_row, rows in blocks] == list(range(0, 17, block_rows))
+            assert np.array_equal(np.concatenate([rows for first_row, rows in blocks]), image)
+
+        def test_not_png(self, tmp_path):
+            """
+            Test that a file that is not a PNG raises a ValueError
+            :param tmp_path: Directory to write the file to
+            :return: None
+            """
+            path = tmp_path / "not_png.png"
+            path.write_bytes(b"not a png image")
+            with pytest.raises(ValueError):
+                list(intelligence.png_rows(str(path)))
+
+        def test_truncated(self, tmp_path, monkeypatch):
+            """
+            Test a PNG that ends part way through raises a ValueError, and image_blocks does not start again from row 0
+            once it has given out rows
+            :param tmp_path: Directory to write the image to
+            :param monkeypatch: Used to unfilter a block at a time, so blocks are given out before the end of the data
+            :return: None
+            """
+            monkeypatch.setattr(intelligence, "PNG_UNFILTER_BYTES", 1)
+            image = np.random.default_rng(6).integers(0, 256, (20, 10, 3)).astype(np.uint8)
+            # Stored rather than compressed, so the rows in the first half of the data can be decoded
+            data = zlib.compress(b"".join(b"\x00" + row.tobytes() for row in image), 0)
+            path = tmp_path / "truncated.png"
+            path.write_bytes(b"\x89PNG\r\n\x1a\n" + intelligence.png_chunk(b"IHDR", struct.pack(">IIBBBBB", 10, 20, 8, 2, 0, 0, 0)) +
+                             intelligence.png_chunk(b"IDAT", data[:len(data) // 2]))
+            with pytest.raises(ValueError):
+                list(intelligence.png_rows(str(path), 4))
+
+            first_rows = []
+            with pytest.raises(ValueError):
+                for first_row, rows in intelligence.image_blocks(str(path), 4):
+                    assert np.array_equal(rows, image[first_row:first_row + 4])
+                    first_rows.append(first_row)
+            assert first_rows == [0, 4]
+
+    class TestLabelTiled:
+
+        @pytest.mark.parametrize("tile_shape", [(1, 1), (3, 4), (7, 2), (100, 100)])
+        def test_matches_union_find(self, tile_shape):
+            """
+            Test labelling by tiles gives the same MARK as labelling the whole image, whatever the tile size
+            :param tile_shape: Shape of the tiles
+            :return: None
+            """
+            rng = np.random.default_rng(2)
+            for i in range(10):
+                mask = rng.random((15, 11)) < 0.5
+                for connectivity in (4, 8):
+                    expected = intelligence.label_union_find(mask, connectivity)
+                    assert (intelligence.label_tiled(mask, connectivity, tile_shape) == expected).all()
+
+        @pytest.mark.parametrize("engine", list(intelligence.LABELLING_ENGINES))
+        def test_dtype(self, engine):
+            """
+            Test every labelling engine gives MARK with the same dtype
+            :param engine: Name of the engine
+            :return: None
+            """
+            mask = np.random.default_rng(4).random((9, 7)) < 0.5
+            assert intelligence.LABELLING_ENGINES[engine](mask, 8).dtype == intelligence.label_union_find(mask).dtype
+
+        @pytest.mark.parametrize(["workers", "processes"], [(1, False), (3, False), (4, True)])
+        def test_parallel_matches_serial(self, workers, processes):
+            """
+            Test labelling strips on a pool gives the same MARK as labelling the whole image
+            :param workers: Number of workers
+            :param processes: Use a process pool
+            :return: None
+            """
+            rng = np.random.default_rng(3)
+            mask = rng.random((21, 17)) < 0.5
+            expected = intelligence.label_union_find(mask)
+            assert (intelligence.label_parallel(mask, 8, workers, processes) == expected).all()
+
+        def test_pipeline(self, tmp_path, monkeypatch):
+            """
+            Test the out of core pipeline writes memory mapped files and gives the same MARK as filtering and labelling in memory
+            :param tmp_path: Directory to use as the work directory
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            map_path = intelligence.data_path("map.png")
+            monkeypatch.chdir(tmp_path)
+            mark = intelligence.detect_connected_components_tiled(map_path, intelligence.red_pixel_mask, 100, 50, str(tmp_path), (256, 300))
+            assert isinstance(mark, np.memmap)
+            assert len(list(tmp_path.glob("*.npy"))) == 2
+
+            img = intelligence.read_image(map_path) * 255
+            expected = intelligence.label_union_find(intelligence.red_pixel_mask(img, 100, 50))
+            assert (mark == expected).all()
+            with open("cc-output-2a.txt") as f:
+                assert f.read().endswith(f"Total number of connected components = {expected.max()}")
+
+        @pytest.mark.parametrize("workers", [1, 3])
+        def test_map_bounded(self, workers):
+            """
+            Test tiles are only taken from the iterable a window at a time, and the results come back in order
+            :param workers: Number of workers in the pool
+            :return: None
+            """
+            taken = []
+
+            def items():
+                for item in range(20):
+                    taken.append(item)
+                    yield item
+
+            results = []
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                for result in intelligence.map_bounded(executor, lambda item: item * 2, items()):
+                    # At most a window of items past the one given back has been taken
+                    assert len(taken) <= result // 2 + 2 * workers
+                    results.append(result)
+            assert results == [item * 2 for item in range(20)]
+
+
+    class TestComponentStatistics:
+
+        @pytest.fixture
+        def mark(self):
+            """
+            Fixture for a MARK with four components
+            :return: 2d numpy array
+            """
+            return np.array([[1, 1, 0, 2],
+                             [0, 0, 0, 2],
+                             [3, 0, 4, 2]])
+
+        def test_expected(self, mark):
+            """
+            Test the sizes, bounding boxes and centroids of each component
+            :param mark: MARK fixture
+            :return: None
+            """
+            stats = intelligence.component_statistics(mark)
+            assert stats['label'].tolist() == [1, 2, 3, 4]
+            assert stats['size'].tolist() == [2, 3, 1, 1]
+            assert stats['min_x'].tolist() == [0, 0, 2, 2]
+            assert stats['max_x'].tolist() == [0, 2, 2, 2]
+            assert stats['min_y'].tolist() == [0, 3, 0, 2]
+            assert stats['max_y'].tolist() == [1, 3, 0, 2]
+            assert stats['extent_x'].tolist() == [1, 3, 1, 1]
+            assert stats['extent_y'].tolist() == [2, 1, 1, 1]
+            assert stats['centroid_x'].tolist() == [0, 1, 2, 2]
+            assert stats['centroid_y'].tolist() == [0.5, 3, 0, 2]
+            assert stats['first_pixel'].tolist() == [0, 3, 8, 10]
+
+        @pytest.mark.parametrize(["k", "expected"], [
+            (None, [2, 1, 3, 4]),
+            (2, [2, 1]),
+            (3, [2, 1, 3]),
+            (10, [2, 1, 3, 4]),
+            (0, [])
+        ])
+        def test_top_components(self, mark, k, expected):
+            """
+            Test the k largest components are returned largest first, ties ordered by component number
+            :param mark: MARK fixture
+            :param k: Number of components
+            :param expected: Expected component numbers
+            :return: None
+            """
+            stats = intelligence.component_statistics(mark)
+            assert stats['label'][intelligence.top_components(stats, k)].tolist() == expected
+
+        def test_empty(self):
+            """
+            Test a MARK with no components gives an empty table
+            :return: None
+            """
+            stats = intelligence.component_statistics(np.zeros((3, 3), dtype=int))
+            assert stats['size'].size == 0
+            assert intelligence.top_components(stats, 2).size == 0
+
+
+    class TestCleanComponents:
+
+        @pytest.fixture
+        def mask(self):
+            """
+            Fixture for a ring with a one pixel hole, a ring with a four pixel hole and a single pixel
+            :return: 2d bool numpy array
+            """
+            return np.array([[1, 1, 1, 0, 1, 1, 1, 1, 0],
+                             [1, 0, 1, 0, 1, 0, 0, 1, 0],
+                             [1, 1, 1, 0, 1, 0, 0, 1, 0],
+                             [0, 0, 0, 0, 1, 1, 1, 1, 0],
+                             [0, 1, 0, 0, 0, 0, 0, 0, 0]], dtype=bool)
+
+        @pytest.mark.parametrize(["min_size", "expected_sizes"], [
+            (0, [8, 12, 1]),
+            (2, [8, 12]),
+            (9, [12]),
+            (13, [])
+        ])
+        def test_filter_components(self, mask, min_size, expected_sizes):
+            """
+            Test components smaller than the minimum size are removed and the rest numbered again
+            :param mask: Mask fixture
+            :param min_size: Smallest component to keep
+            :param expected_sizes: Sizes of the kept components in order
+            :return: None
+            """
+            mark = intelligence.filter_components(intelligence.label_union_find(mask), min_size)
+            assert intelligence.component_sizes(mark).tolist() == expected_sizes
+
+        @pytest.mark.parametrize(["max_hole_size", "expected_sizes"], [
+            (0, [8, 12, 1]),
+            (1, [9, 12, 1]),
+            (3, [9, 12, 1]),
+            (4, [9, 16, 1]),
+            (None, [9, 16, 1])
+        ])
+        def test_fill_holes(self, mask, max_hole_size, expected_sizes):
+            """
+            Test holes up to the maximum size are filled, in the mask and in MARK
+            :param mask: Mask fixture
+            :param max_hole_size: Largest hole to fill
+            :param expected_sizes: Sizes of the components after filling
+            :return: None
+            """
+            cleaned = intelligence.clean_mark(intelligence.label_union_find(mask), max_hole_size=max_hole_size)
+            assert intelligence.component_sizes(cleaned).tolist() == expected_sizes
+            assert np.array_equal(intelligence.label_union_find(intelligence.clean_mask(mask, max_hole_size=max_hole_size)), cleaned)
+
+        def test_edge_is_not_hole(self):
+            """
+            Test off pixels that reach the edge of the image are not filled
+            :return: None
+            """
+            mask = np.array([[1, 1, 1],
+                             [1, 0, 0],
+                             [1, 1, 1]], dtype=bool)
+            assert np.array_equal(intelligence.fill_holes(mask), mask)
+
+        @pytest.mark.parametrize("connectivity", [4, 8])
+        def test_hole_with_island(self, connectivity):
+            """
+            Test filling a hole with an island in it joins the island to the component around it
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            mask = np.zeros((7, 7), dtype=bool)
+            mask[[0, -1], :] = True
+            mask[:, [0, -1]] = True
+            mask[3, 3] = True
+            cleaned = intelligence.clean_mark(intelligence.label_union_find(mask, connectivity), max_hole_size=None,
+                                              connectivity=connectivity)
+            assert intelligence.component_sizes(cleaned).tolist() == [49]
+            assert np.array_equal(intelligence.label_union_find(intelligence.clean_mask(mask, max_hole_size=None,
+                                                                                        connectivity=connectivity), connectivity), cleaned)
+
+        @pytest.mark.parametrize("connectivity", [4, 8])
+        def test_random(self, connectivity):
+            """
+            Test cleaning the mask then labelling gives the same MARK as labelling then cleaning MARK
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            mask = np.random.default_rng(2).random((40, 40)) < 0.55
+            expected = intelligence.label_union_find(intelligence.clean_mask(mask, 3, 5, connectivity), connectivity)
+            actual = intelligence.clean_mark(intelligence.label_union_find(mask, connectivity), 3, 5, connectivity)
+            assert np.array_equal(actual, expected)
+
+        @pytest.mark.parametrize("engine", ["bfs", "union_find"])
+        def test_detect_connected_components(self, mask, engine, tmp_path, monkeypatch):
+            """
+            Test small components are left out of the output file for both ways of cleaning
+            :param mask: Mask fixture
+            :param engine: Labelling engine
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            monkeypatch.chdir(tmp_path)
+            mark = intelligence.detect_connected_components(mask, engine, min_size=2, max_hole_size=None)
+            assert intelligence.component_sizes(mark).tolist() == [9, 16]
+            assert (tmp_path / "cc-output-2a.txt").read_text().splitlines()[-1] == "Total number of connected components = 2"
+
+
+    class TestRelabelIncremental:
+
+        @pytest.fixture
+        def old_mask(self):
+            """
+            Fixture for a mask with a road that is split in two by a gap
+            :return: 2d bool numpy array
+            """
+            return np.array([[1, 1, 0, 1, 1],
+                             [0, 0, 0, 0, 0],
+                             [1, 0, 0, 0, 1]], dtype=bool)
+
+        @staticmethod
+        def assert_matches(mark, stats, new_mask, connectivity=8):
+            """
+            Checks MARK and its statistics table have the same components as labelling the new mask from scratch,
+            whatever numbers the components have
+            :param mark: MARK from relabel_incremental
+            :param stats: Statistics table from relabel_incremental
+            :param new_mask: New mask
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            expected = intelligence.label_union_find(new_mask, connectivity)
+            expected_stats = intelligence.component_statistics(expected)
+            assert list(stats) == list(expected_stats)
+            assert np.array_equal(stats['label'], expected_stats['label'])
+            # Number the components in raster order, the same as labelling from scratch
+            order = np.argsort(stats['first_pixel'])
+            renumber = np.zeros(order.size + 1, dtype=int)
+            renumber[order + 1] = np.arange(1, order.size + 1)
+            assert np.array_equal(renumber[mark], expected)
+            for name in expected_stats:
+                if name != 'label':
+                    assert np.allclose(stats[name][order], expected_stats[name])
+
+        @pytest.mark.parametrize(["changes", "connectivity"], [
+            ([(0, 2, True)], 8),  # Join two components
+            ([(0, 1, False)], 8),  # Shrink a component
+            ([(0, 0, False), (0, 1, False)], 4),  # Remove a component, so another is moved into its number
+            ([(1, 2, True)], 4),  # Add a new component between the others
+            ([(1, 2, True)], 8),  # Add a pixel joining components diagonally
+            ([], 8)  # No change
+        ])
+        def test_matches_full(self, old_mask, changes, connectivity):
+            """
+            Test the incremental MARK and statistics have the same components as labelling the new mask from scratch
+            :param old_mask: Mask fixture
+            :param changes: List of (x, y, value) pixels to change
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            old_mark = intelligence.label_union_find(old_mask, connectivity)
+            new_mask = old_mask.copy()
+            for x, y, value in changes:
+                new_mask[x, y] = value
+            mark, stats = intelligence.relabel_incremental(old_mask, old_mark, new_mask, connectivity=connectivity)
+            self.assert_matches(mark, stats, new_mask, connectivity)
+
+        @pytest.mark.parametrize("connectivity", [4, 8])
+        def test_random(self, connectivity):
+            """
+            Test a run of random changes to random masks, each updating the last MARK and table in place,
+            match labelling from scratch
+            :param connectivity: 4 or 8
+            :return: None
+            """
+            rng = np.random.default_rng(connectivity)
+            for i in range(20):
+                mask = rng.random((40, 30)) < rng.uniform(0.3, 0.6)
+                mark = intelligence.label_union_find(mask, connectivity)
+                stats = intelligence.component_statistics(mark)
+                for j in range(10):
+                    new_mask = mask.copy()
+                    x, y = rng.integers(0, 38), rng.integers(0, 28)
+                    size_x, size_y = rng.integers(1, 6, 2)
+                    new_mask[x:x + size_x, y:y + size_y] = rng.random(new_mask[x:x + size_x, y:y + size_y].shape) < 0.5
+                    mark, stats = intelligence.relabel_incremental(mask, mark, new_mask, stats, rng.integers(1, 3), connectivity)
+                    self.assert_matches(mark, stats, new_mask, connectivity)
+                    mask = new_mask
+
+        def test_only_window_labelled(self, monkeypatch):
+            """
+            Test a change to one large road network only labels a small window, and keeps the network's number
+            :param monkeypatch: Used to record the shapes that are labelled
+            :return: None
+            """
+            mask = np.zeros((200, 200), dtype=bool)
+            mask[::20] = True
+            mask[:, ::20] = True
+            mask[5, 5] = True
+            mark = intelligence.label_union_find(mask)
+            stats = intelligence.component_statistics(mark)
+            shapes = []
+            label_union_find = intelligence.label_union_find
+
+            def record(mask, connectivity=8):
+                shapes.append(mask.shape)
+                return label_union_find(mask, connectivity)
+            monkeypatch.setattr(intelligence, "label_union_find", record)
+
+            # Cut one road (the network stays joined round the block), then join the lone pixel to the network
+            closed = mask.copy()
+            closed[100, 110] = False
+            mark, stats = intelligence.relabel_incremental(mask, mark, closed, stats)
+            joined = closed.copy()
+            joined[1:5, 5] = True
+            mark, stats = intelligence.relabel_incremental(closed, mark, joined, stats)
+            assert max(shape[0] * shape[1] for shape in shapes) <= 100 * 100
+            assert mark[0, 0] == 1
+            monkeypatch.undo()
+            self.assert_matches(mark, stats, joined)
+
+        def test_split(self):
+            """
+            Test cutting the only road joining two parts of a component splits it in two
+            :return: None
+            """
+            mask = np.zeros((9, 30), dtype=bool)
+            mask[4] = True
+            mask[:, 0] = True
+            mark = intelligence.label_union_find(mask)
+            new_mask = mask.copy()
+            new_mask[4, 15] = False
+            mark, stats = intelligence.relabel_incremental(mask, mark, new_mask)
+            assert stats['size'].tolist() == [23, 14]
+            self.assert_matches(mark, stats, new_mask)
+
+        def test_output_file(self, old_mask, tmp_path, monkeypatch):
+            """
+            Test the incremental version of detect_connected_components writes the new sizes
+            :param old_mask: Mask fixture
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            monkeypatch.chdir(tmp_path)
+            old_mark = intelligence.label_union_find(old_mask)
+            new_mask = old_mask.copy()
+            new_mask[0, 2] = True
+            mark, stats = intelligence.detect_connected_components_incremental(new_mask, old_mask, old_mark)
+            lines = (tmp_path / "cc-output-2a.txt").read_text().splitlines()
+            assert lines == ["Connected Component 1, number of pixels = 5",
+                             "Connected Component 2, number of pixels = 1",
+                             "Connected Component 3, number of pixels = 1",
+                             "Total number of connected components = 3"]
+
+
+    class TestAnalysisCache:
+
+        @pytest.fixture
+        def cache(self, tmp_path):
+            """
+            Fixture for a cache in a temporary directory
+            :param tmp_path: Temporary directory
+            :return: AnalysisCache
+            """
+            return intelligence.AnalysisCache(str(tmp_path / "cache"))
+
+        def test_mask_and_mark(self, cache, tmp_path, monkeypatch):
+            """
+            Test cached masks and MARKs match working them out, and the second time they come from the cache
+            :param cache: Cache fixture
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to change the working directory and stop the image being filtered or labelled again
+            :return: None
+            """
+            map_path = intelligence.data_path("map.png")
+            monkeypatch.chdir(tmp_path)
+            expected = intelligence.find_red_pixels(map_path).mask
+            mask = cache.mask(map_path, intelligence.red_pixel_condition, 100, 50)
+            mark = cache.mark(map_path, intelligence.red_pixel_condition, 100, 50)
+            assert np.array_equal(mask.mask, expected)
+            assert np.array_equal(mark, intelligence.label_union_find(expected))
+
+            def fail(*args):
+                raise AssertionError("cache was not used")
+            monkeypatch.setattr(intelligence, "filter_pixels", fail)
+            monkeypatch.setattr(intelligence, "label_union_find", fail)
+            assert np.array_equal(cache.mask(map_path, intelligence.red_pixel_condition, 100, 50).mask, expected)
+            assert np.array_equal(cache.mark(map_path, intelligence.red_pixel_condition, 100, 50), mark)
+            assert np.array_equal(intelligence.find_red_pixels(map_path, cache=cache).mask, expected)
+
+        @pytest.mark.parametrize("max_bytes", [200_000, 1])
+        def test_larger_than_cache(self, tmp_path, monkeypatch, max_bytes):
+            """
+            Test a MARK is still returned when it is larger than the whole cache, and is stored as int32
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to change the working directory
+            :param max_bytes: Size of the cache, smaller than the MARK (and with 1 smaller than the mask too)
+            :return: None
+            """
+            map_path = intelligence.data_path("map.png")
+            monkeypatch.chdir(tmp_path)
+            cache = intelligence.AnalysisCache(str(tmp_path / "cache"), max_bytes=max_bytes)
+            mark = cache.mark(map_path, intelligence.red_pixel_condition, 100, 50)
+            assert mark.dtype == np.int32
+            assert np.array_equal(mark, intelligence.label_union_find(intelligence.find_red_pixels(map_path, cache=cache).mask))
+
+        def test_key(self, cache, tmp_path):
+            """
+            Test the key changes with the contents of the image, the condition and the thresholds
+            :param cache: Cache fixture
+            :param tmp_path: Temporary directory
+            :return: None
+            """
+            image = tmp_path / "image.png"
+            image.write_bytes(b"first")
+            first = cache.key(str(image), intelligence.red_pixel_condition, 100, 50)
+            assert first == cache.key(str(image), intelligence.red_pixel_condition, 100, 50)
+            assert first != cache.key(str(image), intelligence.cyan_pixel_condition, 100, 50)
+            assert first != cache.key(str(image), intelligence.red_pixel_condition, 100, 60)
+            image.write_bytes(b"second contents")
+            assert first != cache.key(str(image), intelligence.red_pixel_condition, 100, 50)
+
+        def test_evict(self, tmp_path):
+            """
+            Test the least recently used entries are removed when the cache is too large
+            :param tmp_path: Temporary directory
+            :return: None
+            """
+            cache = intelligence.AnalysisCache(str(tmp_path), max_bytes=25)
+            names = ["a" * 64 + "-mask.npz", "b" * 64 + "-mark-8.npy", "c" * 64 + "-distances.npz"]
+            for number, name in enumerate(names):
+                path = tmp_path / name
+                path.write_bytes(b"0" * 10)
+                os.utime(path, ns=(number, number))
+            cache.touch(str(tmp_path / names[0]))
+            cache.evict()
+            assert sorted(os.listdir(tmp_path)) == [names[0], names[2]]
+
+        @pytest.mark.parametrize("name", ["notes.txt", "a" * 64 + ".json", "a" * 63 + "-mask.npz", "a" * 64 + "-mask.npz.bak"])
+        def test_other_files(self, tmp_path, name):
+            """
+            Test files in the cache directory that are not entries are never removed by evict or clear
+            :param tmp_path: Temporary directory
+            :param name: Name of a file that is not an entry
+            :return: None
+            """
+            cache = intelligence.AnalysisCache(str(tmp_path), max_bytes=1)
+            (tmp_path / name).write_bytes(b"0" * 10)
+            (tmp_path / ("a" * 64 + "-mark-4.npy")).write_bytes(b"0" * 10)
+            assert len(cache.entries()) == 1
+            cache.evict()
+            assert sorted(os.listdir(tmp_path)) == [name]
+            (tmp_path / ("a" * 64 + "-mark-4.npy")).write_bytes(b"0" * 10)
+            cache.clear()
+            assert os.listdir(tmp_path) == [name]
+
+
+    class TestProcessMaps:
+
+        @pytest.fixture
+        def map_directory(self, tmp_path):
+            """
+            Fixture for a directory with two copies of the map and a file that is not an image
+            :param tmp_path: Temporary directory
+            :return: Path of the directory
+            """
+            directory = tmp_path / "maps"
+            directory.mkdir()
+            map_bytes = open(intelligence.data_path("map.png"), 'rb').read()
+            (directory / "first.png").write_bytes(map_bytes)
+            (directory / "second.png").write_bytes(map_bytes)
+            (directory / "broken.png").write_bytes(b"not an image")
+            return directory
+
+        def test_outputs(self, map_directory, tmp_path):
+            """
+            Test each map gets its own output files and a manifest, and a broken map is recorded rather than stopping the batch
+            :param map_directory: Map directory fixture
+            :param tmp_path: Temporary directory
+            :return: None
+            """
+            output = tmp_path / "output"
+            manifest = intelligence.process_maps(str(map_directory), str(output), workers=2, processes=False)
+            assert [os.path.basename(summary["map"]) for summary in manifest["maps"]] == ["broken.png", "first.png", "second.png"]
+            assert manifest["maps"][0]["error"] is not None
+
+            map_file = intelligence.read_image(intelligence.data_path("map.png")) * 255
+            expected_mark = intelligence.label_union_find(intelligence.pixel_mask(map_file, 100, 50, intelligence.red_pixel_condition))
+            for summary in manifest["maps"][1:]:
+                assert summary["error"] is None
+                assert summary["classes"]["red"]["components"] == expected_mark.max()
+                for name in ["red", "cyan"]:
+                    for file_name in ["cc-output-2a.txt", "cc-output-2b.txt", "cc-top-2.png", f"map-{name}-pixels.png"]:
+                        assert (output / os.path.basename(summary["output"]) / name / file_name).exists()
+            assert (output / "manifest.json").exists()
+
+        def test_write_errors(self, map_directory, tmp_path, monkeypatch):
+            """
+            Test an error writing in the background is recorded under the map that asked for the write,
+            and a map that fails leaves none of its writes for the next map to report
+            :param map_directory: Map directory fixture
+            :param tmp_path: Temporary directory
+            :param monkeypatch: Used to make writing fail
+            :return: None
+            """
+            def fail_write(path, data):
+                raise OSError("disk full")
+
+            def fail_sizes(path, sizes):
+                raise RuntimeError("sizes failed")
+
+            task = (str(map_directory / "first.png"), str(tmp_path / "first"), intelligence.BATCH_RULES, 8, 2)
+            monkeypatch.setattr(intelligence, "write_mask_png", fail_write)
+            assert intelligence.process_map(task)["error"] == "OSError: disk full"
+
+            monkeypatch.setattr(intelligence, "write_component_sizes", fail_sizes)
+            assert intelligence.process_map(task)["error"] == "RuntimeError: sizes failed"
+            monkeypatch.undo()
+            assert intelligence.process_map(task)["error"] is None
+
+
+    class TestDistanceTransform:
+
+        def test_matches_brute_force(self):
+            """
+            Test the distances and nearest pixels agree with checking every on pixel
+            :return: None
+            """
+            rng = np.random.default_rng(4)
+            for i in range(20):
+                mask = rng.random((9, 12)) < 0.1
+                mask[0, 0] = True
+                distances, nearest_x, nearest_y = intelligence.distance_transform(mask)
+                on_x, on_y = np.nonzero(mask)
+                grid_x, grid_y = np.indices(mask.shape)
+                expected = np.sqrt((grid_x[:, :, np.newaxis] - on_x) ** 2 + (grid_y[:, :, np.newaxis] - on_y) ** 2).min(axis=2)
+                assert np.allclose(distances, expected)
+                assert mask[nearest_x, nearest_y].all()
+                assert np.allclose(np.hypot(grid_x - nearest_x, grid_y - nearest_y), distances)
+
+        def test_no_pixels(self):
+            """
+            Test an empty mask gives infinite distances and no nearest pixel
+            :return: None
+            """
+            distances, nearest_x, nearest_y = intelligence.distance_transform(np.zeros((2, 3), dtype=bool))
+            assert np.isinf(distances).all()
+            assert (nearest_x == -1).all() and (nearest_y == -1).all()
+
+    class TestRoadDistances:
+
+        @pytest.fixture
+        def mask(self):
+            """
+            Fixture for a mask with two road pixels
+            :return: 2d bool numpy array
+            """
+            mask = np.zeros((6, 8), dtype=bool)
+            mask[1, 1] = True
+            mask[4, 6] = True
+            return mask
+
+        def test_matches_distance_transform(self, mask):
+            """
+            Test the distances and nearest road pixels match distance_transform
+            :param mask: Mask fixture
+            :return: None
+            """
+            distances, nearest_x, nearest_y = intelligence.distance_transform(mask)
+            roads = intelligence.RoadDistances.from_mask(mask)
+            assert np.array_equal(roads.distances, distances)
+            assert np.array_equal(roads.nearest_x, nearest_x)
+            assert np.array_equal(roads.nearest_y, nearest_y)
+
+        def test_query(self, mask):
+            """
+            Test the nearest road pixel to some points, and that points outside the map raise a ValueError
+            :param mask: Mask fixture
+            :return: None
+            """
+            distances, nearest_x, nearest_y = intelligence.RoadDistances.from_mask(mask).query([0, 5, 1], [0, 7, 1])
+            assert np.allclose(distances, [np.sqrt(2), np.sqrt(2), 0])
+            assert nearest_x.tolist() == [1, 4, 1]
+            assert nearest_y.tolist() == [1, 6, 1]
+            with pytest.raises(ValueError):
+                intelligence.RoadDistances.from_mask(mask).query([6], [0])
+
+        def test_no_roads(self):
+            """
+            Test a mask with no road pixels gives infinite distances
+            :return: None
+            """
+            roads = intelligence.RoadDistances.from_mask(np.zeros((3, 3), dtype=bool))
+            assert np.isinf(roads.distances).all()
+            assert (roads.nearest_x == -1).all()
+
+        def test_cached(self, mask, monkeypatch):
+            """
+            Test asking for the distances of the same mask again uses the cache, even for a copy of the mask
+            :param mask: Mask fixture
+            :param monkeypatch: Used to stop the distance transform being worked out again
+            :return: None
+            """
+            first = intelligence.road_distances(mask)
+            monkeypatch.setattr(intelligence, "distance_transform", None)
+            assert intelligence.road_distances(intelligence.BinaryMask(mask.copy())) is first
+
+        def test_analysis_cache(self, tmp_path, monkeypatch):
+            """
+            Test distances stored in an AnalysisCache are loaded the second time rather than worked out
+            :param tmp_path: Directory for the cache
+            :param monkeypatch: Used to stop the distance transform being worked out again
+            :return: None
+            """
+            cache = intelligence.AnalysisCache(str(tmp_path))
+            map_path = intelligence.data_path("map.png")
+            first = cache.distances(map_path, intelligence.red_pixel_condition, 100, 50)
+            monkeypatch.setattr(intelligence, "DISTANCE_CACHE", intelligence.OrderedDict())
+            monkeypatch.setattr(intelligence, "distance_transform", None)
+            second = cache.distances(map_path, intelligence.red_pixel_condition, 100, 50)
+            assert np.array_equal(second.distances, first.distances)
+            assert np.array_equal(second.nearest_y, first.nearest_y)
+
+
+    class TestComponentIndex:
+
+        @pytest.fixture
+        def index(self):
+            """
+            Fixture for an index of a MARK with three components
+            :return: ComponentIndex
+            """
+            mark = np.array([[1, 1, 0, 0, 0],
+                             [0, 0, 0, 0, 2],
+                             [0, 0, 0, 0, 2],
+                             [3, 0, 0, 0, 0]])
+            return intelligence.ComponentIndex(mark)
+
+        def test_point_lookup(self, index):
+            """
+            Test looking up the component at single points and many points
+            :param index: Index fixture
+            :return: None
+            """
+            assert index.component_at(0, 1) == 1
+            assert index.component_at(2, 2) == 0
+            assert index.components_at([1, 3, 0], [4, 0, 4]).tolist() == [2, 3, 0]
+
+        @pytest.mark.parametrize(["box", "expected"], [
+            ((0, 0, 3, 4), [1, 2, 3]),
+            ((1, 0, 2, 3), []),
+            ((2, 3, 3, 4), [2]),
+            ((3, 0, 3, 0), [3])
+        ])
+        def test_components_in_box(self, index, box, expected):
+            """
+            Test finding components with bounding boxes overlapping a box
+            :param index: Index fixture
+            :param box: (min_x, min_y, max_x, max_y)
+            :param expected: Expected component numbers
+            :return: None
+            """
+            assert index.components_in_box(*box).tolist() == expected
+
+        @pytest.mark.parametrize("max_cells", [1, 4, 256])
+        def test_components_in_box_random(self, monkeypatch, max_cells):
+            """
+            Test the grid of buckets finds the same components as checking every bounding box, with and without large boxes
+            :param monkeypatch: Used to change how many cells a box can cover before it is kept as a large box
+            :param max_cells: Most cells a box can cover and still be listed in each cell
+            :return: None
+            """
+            monkeypatch.setattr(intelligence, "BOX_GRID_MAX_CELLS", max_cells)
+            rng = np.random.default_rng(max_cells)
+            index = intelligence.ComponentIndex(intelligence.label_union_find(rng.random((40, 60)) < 0.3))
+            stats = index.stats
+            for _ in range(100):
+                min_x, max_x = sorted(rng.integers(-5, 45, 2))
+                min_y, max_y = sorted(rng.integers(-5, 65, 2))
+                expected = (stats['min_x'] <= max_x) & (stats['max_x'] >= min_x) & (stats['min_y'] <= max_y) & (stats['max_y'] >= min_y)
+                assert index.components_in_box(min_x, min_y, max_x, max_y).tolist() == np.sort(stats['label'][expected]).tolist()
+
+        def test_nearest(self, index):
+            """
+            Test finding the nearest component pixel
+            :param index: Index fixture
+            :return: None
+            """
+            assert index.nearest_road_pixel(1, 1) == (0, 1, 1.0)
+            assert index.nearest_component(2, 3) == 2
+            assert index.nearest_road_pixel(0, 0) == (0, 0, 0.0)
+
+        def test_save_load(self, index, tmp_path):
+            """
+            Test an index saved to a file answers queries the same once loaded
+            :param index: Index fixture
+            :param tmp_path: Directory to save the index to
+            :return: None
+            """
+            path = str(tmp_path / "index.npz")
+            index.save(path)
+            loaded = intelligence.ComponentIndex.load(path)
+            assert (loaded.mark == index.mark).all()
+            assert loaded.nearest_road_pixel(2, 2) == index.nearest_road_pixel(2, 2)
+            assert loaded.components_in_box(0, 0, 3, 4).tolist() == [1, 2, 3]
+            assert loaded.nearest_x.dtype == loaded.nearest_y.dtype == np.int32
+
+        @pytest.mark.parametrize("nearest", [
+            (np.zeros((4, 5), dtype=int), None),
+            (None, np.zeros((4, 5), dtype=int)),
+            (np.zeros((4, 4), dtype=int), np.zeros((4, 4), dtype=int))
+        ])
+        def test_invalid_nearest(self, index, nearest):
+            """
+            Test a ValueError is raised when only one nearest array is given or they do not match MARK
+            :param index: Index fixture
+            :param nearest: Tuple of (nearest_x, nearest_y)
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                intelligence.ComponentIndex(index.mark, *nearest)
+
+        def test_given_nearest(self, index):
+            """
+            Test an index made from given nearest positions gives the same distances as working them out
+            :param index: Index fixture
+            :return: None
+            """
+            given = intelligence.ComponentIndex(index.mark, index.nearest_x, index.nearest_y)
+            assert np.array_equal(given.distances, intelligence.distance_transform(index.mark > 0)[0])
+            assert given.nearest_road_pixel(3, 3) == index.nearest_road_pixel(3, 3)
+
+
+    class TestRoadGraph:
+
+        @pytest.fixture
+        def mark(self):
+            """
+            Fixture for a MARK with a thick cross shaped road and a separate straight road
+            :return: 2d numpy array
+            """
+            mark = np.zeros((21, 30), dtype=int)
+            mark[9:12, :21] = 1
+            mark[:, 9:12] = 1
+            mark[2:19, 25:28] = 2
+            return mark
+
+        def test_skeletonise(self, mark):
+            """
+            Test that thick roads are thinned to one pixel wide lines that stay inside the road
+            :param mark: MARK fixture
+            :return: None
+            """
+            skeleton = intelligence.skeletonise(mark > 0)
+            assert (mark[skeleton] > 0).all()
+            assert skeleton[:, 26].sum() > 10
+            assert not skeleton[:, 25].any() and not skeleton[:, 27].any()
+
+        def test_graph(self, mark):
+            """
+            Test the cross becomes a junction joined to four dead ends, and the straight road two joined dead ends
+            :param mark: MARK fixture
+            :return: None
+            """
+            graph = intelligence.build_road_graph(mark)
+            assert graph.node_count == 7
+            assert graph.edge_count == 5
+            assert sorted(np.bincount(graph.node_component).tolist()) == [0, 2, 5]
+            junction = graph.nearest_node(10, 10)
+            assert len(graph.adjacency[junction]) == 4
+
+        def test_route(self, mark):
+            """
+            Test routing along the cross, and that there is no route between separate roads
+            :param mark: MARK fixture
+            :return: None
+            """
+            graph = intelligence.build_road_graph(mark)
+            length, route = graph.route(0, 10, 20, 10)
+            assert len(route) == 3
+            assert route[1] == (10, 10)
+            assert length == pytest.approx(17)
+
+            start = graph.nearest_node(10, 0)
+            other_road = graph.nearest_node(10, 26)
+            assert graph.shortest_path(start, other_road) == (np.inf, [])
+
+
 class TestTemplate:
 
     @pytest.fixture(autouse=True)
@@ -295,4 +1685,26 @@ class TestTemplate:
         def test_expected(self):
             pass  # Not sure how to test this since the function does not return anything
 
+        def test_output_files(self, tmp_path, monkeypatch):
+            """
+            Test the sorted components are written largest first and the top k image is saved
+            :param tmp_path: Directory to write the output files to
+            :param monkeypatch: Used to change the working directory
+            :return: None
+            """
+            monkeypatch.chdir(tmp_path)
+            mark = np.array([[1, 1, 0, 2],
+                             [0, 0, 0, 2],
+                             [3, 0, 4, 2]])
+            intelligence.detect_connected_components_sorted(mark, k=3)
+            with open("cc-output-2b.txt") as f:
+                assert f.read() == "Connected Component 2, number of pixels = 3\n" \
+                                   "Connected Component 1, number of pixels = 2\n" \
+                                   "Connected Component 3, number of pixels = 1\n" \
+                                   "Connected Component 4, number of pixels = 1\n" \
+                                   "Total number of connected components = 4"
+            intelligence.IMAGE_WRITER.flush()
+            top_k = intelligence.as_binary_mask(intelligence.read_image(str(tmp_path / "cc-top-3.png")))
+            assert np.array_equal(top_k, np.isin(mark, [1, 2, 3]))
+
 
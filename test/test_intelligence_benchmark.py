@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import intelligence
+import intelligence_benchmark
+
+
+class TestCustom:
+
+    class TestReflect:
+
+        @pytest.mark.parametrize(["positions", "length", "expected"], [
+            ([0, 1, 2, 3, 4, 5, 6], 3, [0, 1, 2, 1, 0, 1, 2]),
+            ([-1, -2, -3], 3, [1, 2, 1]),
+            ([5, -5], 1, [0, 0])
+        ])
+        def test_expected(self, positions, length, expected):
+            """
+            Test positions are folded back into the range
+            :param positions: Positions to fold
+            :param length: Number of places to fold into
+            :param expected: Folded positions
+            :return: None
+            """
+            assert intelligence_benchmark.reflect(np.array(positions), length).tolist() == expected
+
+    class TestSyntheticRoadMap:
+
+        @pytest.mark.parametrize(["width", "height", "components", "density"], [
+            (64, 64, 1, 0.2),
+            (64, 100, 10, 0.1),
+            (200, 50, 37, 0.5),
+            (30, 30, 0, 0.1)
+        ])
+        def test_component_count(self, width, height, components, density):
+            """
+            Test the map has exactly the number of components asked for and its red pixels are the roads
+            :param width: Number of rows
+            :param height: Number of columns
+            :param components: Number of roads
+            :param density: Fraction of each cell to cover
+            :return: None
+            """
+            image, mask = intelligence_benchmark.synthetic_road_map(width, height, components, density)
+            assert image.shape == (width, height, 3)
+            assert intelligence.label_union_find(mask).max(initial=0) == components
+            assert np.array_equal(intelligence.pixel_mask(image, 100, 50, intelligence.red_pixel_condition), mask)
+
+        @pytest.mark.parametrize(["components", "density"], [
+            (10000, 0.1),
+            (1, 0),
+            (1, 1.5)
+        ])
+        def test_invalid(self, components, density):
+            """
+            Test a ValueError is raised when the components do not fit or the density is not valid
+            :param components: Number of roads
+            :param density: Fraction of each cell to cover
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                intelligence_benchmark.synthetic_road_map(32, 32, components, density)
+
+    class TestRunCase:
+
+        def test_report(self):
+            """
+            Test a small benchmark times every stage and finds the engines give the same MARK
+            :return: None
+            """
+            result = intelligence_benchmark.run_case(48, 48, 4, 0.2, ["bfs", "union_find", "rle"])
+            assert result["identical"]
+            assert result["component_count_correct"]
+            assert set(result["seconds"]) == {"filter", "label_bfs", "label_union_find", "label_rle", "statistics",
+                                              "write_sizes", "sorted"}
+            assert all(peak >= 0 for peak in result["peak_bytes"].values())
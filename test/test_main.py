@@ -1,11 +1,51 @@
 import datetime
+import os
 import pytest
+import subprocess
+import sys
 import main
 import reporting
 
 
 class TestCustom:
 
+    class TestLazyImport:
+
+        def test_heavy_modules_not_imported(self):
+            """
+            Test importing main does not import numpy, matplotlib or requests
+            :return: None
+            """
+            statement = "import main, sys; print([name for name in ('numpy', 'matplotlib', 'requests') if name in sys.modules])"
+            result = subprocess.run([sys.executable, "-c", statement], capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            assert result.stdout.strip() == "[]"
+
+        def test_loaded_on_use(self):
+            """
+            Test a lazily imported module works when it is used
+            :return: None
+            """
+            assert main.reporting.add_month(datetime.datetime(2021, 1, 15)) == datetime.datetime(2021, 2, 15)
+
+    class TestBatch:
+
+        def test_batch(self, tmp_path, capsys):
+            """
+            Test the batch command processes every map in the directory and prints a line for each
+            :param tmp_path: Temporary directory
+            :param capsys: Used to read what is printed
+            :return: None
+            """
+            map_directory = tmp_path / "maps"
+            map_directory.mkdir()
+            (map_directory / "map.png").write_bytes(open("data/map.png", 'rb').read())
+            main.batch([str(map_directory), str(tmp_path / "output"), "--threads"])
+            printed = capsys.readouterr().out.splitlines()
+            assert printed[0].endswith("map.png: red 223, cyan 334 components")
+            assert printed[1].startswith("Processed 1 maps")
+            assert (tmp_path / "output" / "manifest.json").exists()
+
     class TestReadFile:
 
         @pytest.fixture
@@ -1,8 +1,340 @@
+import datetime
+import hashlib
+import http.server
+import os
+import json
+import re
+import threading
+import time
 import pytest
+import requests
 import monitoring
 import main
 
 
+class StubApiHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for the LondonAir API, answering Data/SiteSpecies calls with one reading an hour between the dates
+    The value of a reading is the species code followed by the hour, e.g. "NO 2021-01-01 05"
+    Every response has an ETag, a request with a matching If-None-Match gets 304 Not Modified
+    A path in server.failures gets 500 Internal Server Error that many times before it succeeds
+    """
+    protocol_version = "HTTP/1.1"  # Keeps connections open between requests
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.clients.add(self.client_address)
+        time.sleep(server.delay)
+
+        with server.lock:
+            failing = server.failures.get(self.path, 0) > 0
+            if failing:
+                server.failures[self.path] -= 1
+                server.statuses.append(500)
+        if failing:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        match = re.search(r"SpeciesCode=(\w+)/StartDate=([\d-]+)/EndDate=([\d-]+)", self.path)
+        if match:
+            species, start, end = match.group(1), datetime.date.fromisoformat(match.group(2)), datetime.date.fromisoformat(match.group(3))
+            hour = datetime.datetime.combine(start, datetime.time())
+            readings = []
+            while hour < datetime.datetime.combine(end, datetime.time()):
+                readings.append({"@MeasurementDateGMT": hour.strftime("%Y-%m-%d %H:%M:%S"), "@Value": f"{species} {hour:%Y-%m-%d %H}"})
+                hour += datetime.timedelta(hours=1)
+            body = {"RawAQData": {"Data": readings}}
+        else:
+            body = {"Path": self.path}
+
+        content = json.dumps(body).encode()
+        etag = f'"{hashlib.sha256(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.statuses.append(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with server.lock:
+            server.statuses.append(200)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_api(monkeypatch, tmp_path):
+    """
+    Fixture for a local server standing in for the API, monitoring is pointed at it with a new session and an empty cache
+    :param monkeypatch: Used to change the API url, session and cache
+    :param tmp_path: Directory for the cache
+    :return: The server, with the paths requested, the status of each response, the client addresses that connected,
+             a delay for each response and the number of times each path should fail
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubApiHandler)
+    server.lock = threading.Lock()
+    server.paths = []
+    server.statuses = []
+    server.failures = {}
+    server.clients = set()
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(monitoring, "API_URL", f"http://127.0.0.1:{server.server_address[1]}/AirQuality")
+    monkeypatch.setattr(monitoring, "session", None)
+    monkeypatch.setattr(monitoring, "response_cache", monitoring.ResponseCache(str(tmp_path / "api-cache")))
+    monkeypatch.setattr(monitoring, "OFFLINE", False)
+    monkeypatch.setattr(monitoring, "RETRY_DELAY", 0)
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class TestMakeApiCall:
+
+    def test_keep_alive(self, stub_api):
+        """
+        Test calls made one after another reuse the same connection
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        for number in range(3):
+            assert monitoring.make_api_call(f"/Information/Test{number}/Json") == {"Path": f"/AirQuality/Information/Test{number}/Json"}
+        assert len(stub_api.clients) == 1
+
+    def test_concurrent(self, stub_api):
+        """
+        Test calls made together run at the same time, in their own connections, and come back in order
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        stub_api.delay = 0.3
+        start = time.perf_counter()
+        responses = monitoring.make_api_calls([f"Test{number}" for number in range(3)], max_workers=3)
+        assert time.perf_counter() - start < 0.8
+        assert [response["Path"] for response in responses] == [f"/AirQuality/Test{number}" for number in range(3)]
+
+
+class TestResponseCache:
+
+    def test_cached(self, stub_api):
+        """
+        Test a second call is answered from the cache without asking the API
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        first = monitoring.make_api_call("/Information/Groups/Json")
+        assert monitoring.make_api_call("Information/Groups/Json") == first
+        assert len(stub_api.paths) == 1
+
+    def test_revalidate(self, stub_api, monkeypatch):
+        """
+        Test an expired response is checked with the API using its ETag and kept when it has not changed
+        :param stub_api: Stub API fixture
+        :param monkeypatch: Used to make responses expire straight away
+        :return: None
+        """
+        monkeypatch.setattr(monitoring, "CACHE_DEFAULT_TTL", 0)
+        first = monitoring.make_api_call("Information/Test/Json")
+        assert monitoring.make_api_call("Information/Test/Json") == first
+        assert stub_api.statuses == [200, 304]
+
+    def test_offline(self, stub_api, monkeypatch):
+        """
+        Test offline mode uses expired responses and fails for ones that were never cached
+        :param stub_api: Stub API fixture
+        :param monkeypatch: Used to turn on offline mode
+        :return: None
+        """
+        monkeypatch.setattr(monitoring, "CACHE_DEFAULT_TTL", 0)
+        first = monitoring.make_api_call("Information/Test/Json")
+        monkeypatch.setattr(monitoring, "OFFLINE", True)
+        assert monitoring.make_api_call("Information/Test/Json") == first
+        with pytest.raises(ConnectionError):
+            monitoring.make_api_call("Information/Other/Json")
+        assert len(stub_api.paths) == 1
+
+    def test_unreachable(self, stub_api, monkeypatch):
+        """
+        Test an expired response is used when the API can not be reached
+        :param stub_api: Stub API fixture
+        :param monkeypatch: Used to make responses expire straight away and move the API
+        :return: None
+        """
+        monkeypatch.setattr(monitoring, "CACHE_DEFAULT_TTL", 0)
+        first = monitoring.make_api_call("Information/Test/Json")
+        stub_api.shutdown()
+        stub_api.server_close()
+        monkeypatch.setattr(monitoring, "session", None)
+        assert monitoring.make_api_call("Information/Test/Json") == first
+
+    def test_evict(self, tmp_path):
+        """
+        Test the least recently used entries are removed when the cache is too large
+        :param tmp_path: Directory for the cache
+        :return: None
+        """
+        cache = monitoring.ResponseCache(str(tmp_path), max_bytes=10 ** 6)
+        for number in range(3):
+            cache.put(f"Test{number}", "x" * 1000)
+            os.utime(cache.path(f"Test{number}"), (number, number))
+        cache.get("Test0")
+        cache.max_bytes = 2500
+        cache.evict()
+        assert cache.get("Test1") is None
+        assert cache.get("Test0")["body"] == "x" * 1000
+        assert cache.get("Test2")["body"] == "x" * 1000
+
+    def test_evict_on_put(self, tmp_path, monkeypatch):
+        """
+        Test storing entries only lists the directory once the running total goes over the limit
+        :param tmp_path: Directory for the cache
+        :param monkeypatch: Used to count the directory listings
+        :return: None
+        """
+        cache = monitoring.ResponseCache(str(tmp_path), max_bytes=3500)
+        listings = []
+        entries = cache.entries
+        monkeypatch.setattr(cache, "entries", lambda: listings.append(1) or entries())
+        for number in range(3):
+            cache.put(f"Test{number}", "x" * 1000)
+            os.utime(cache.path(f"Test{number}"), (number, number))
+        cache.put("Test1", "y" * 1000)
+        assert len(listings) == 1
+        cache.put("Test3", "x" * 1000)
+        assert len(listings) == 2
+        assert cache.get("Test0") is None
+        assert cache.get("Test1")["body"] == "y" * 1000
+        assert cache.size == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+
+    @pytest.mark.parametrize(['endpoint', 'expected'], [
+        ("Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-01-01/EndDate=2021-01-08/Json", None),
+        ("Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-05-29/EndDate=2021-05-30/Json", None),
+        ("Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-05-30/EndDate=2021-05-31/Json", 15 * 60),
+        ("/Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-05-31/EndDate=2021-06-01/Json", 15 * 60),
+        ("/Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-06-01/EndDate=2021-06-02/Json", 15 * 60),
+        ("Information/Groups/Json", 7 * 24 * 60 * 60),
+        ("Information/News/Json", 60 * 60),
+        ("Unknown/Json", 5 * 60)
+    ])
+    def test_cache_ttl(self, endpoint, expected):
+        """
+        Test data for dates that ended at least two days ago is kept forever and other responses expire
+        :param endpoint: Endpoint of the call
+        :param expected: Expected seconds to keep it
+        :return: None
+        """
+        assert monitoring.cache_ttl(endpoint, datetime.date(2021, 6, 1)) == expected
+
+
+class TestGetCurrentData:
+
+    @pytest.mark.parametrize("max_workers", [1, 3])
+    def test_expected(self, stub_api, max_workers):
+        """
+        Test the three species are fetched and merged into one row an hour
+        :param stub_api: Stub API fixture
+        :param max_workers: Most calls to make at the same time
+        :return: None
+        """
+        data = monitoring.get_current_data(datetime.date(2021, 1, 1), datetime.date(2021, 1, 2), "MY1", max_workers)
+        assert len(data) == 24
+        assert len(stub_api.paths) == 3
+        assert data[5]['no'] == "NO 2021-01-01 05"
+        assert data[5]['pm10'] == "PM10 2021-01-01 05"
+        assert data[5]['pm25'] == "PM25 2021-01-01 05"
+        assert data[5]['date'] == "2021-01-01"
+        assert data[5]['time'] == "06:00:00"
+        assert data[23]['time'] == "24:00:00"
+
+    def test_same_day(self, stub_api):
+        """
+        Test a range that starts and ends on the same day still asks the API, once for each species
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        monitoring.get_current_data(datetime.date(2021, 1, 1), datetime.date(2021, 1, 1), "MY1")
+        assert sorted(stub_api.paths) == [f"/AirQuality/Data/SiteSpecies/SiteCode=MY1/SpeciesCode={code}/StartDate=2021-01-01/EndDate=2021-01-01/Json"
+                                          for code in ("NO", "PM10", "PM25")]
+
+    def test_chunked(self, stub_api):
+        """
+        Test a long range is fetched in weekly windows and stitched back together in time order
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        data = monitoring.get_current_data(datetime.date(2021, 1, 1), datetime.date(2021, 1, 20), "MY1", 4)
+        # Windows 1st-4th, 4th-11th, 11th-18th and 18th-20th (the 4th is a Monday) for each species
+        assert len(stub_api.paths) == 12
+        assert len(data) == 19 * 24
+        assert [row['datetime'] for row in data] == sorted(row['datetime'] for row in data)
+        assert data[-1]['no'] == "NO 2021-01-19 23"
+        assert data[100]['pm25'] == "PM25 2021-01-05 04"
+
+    def test_retry(self, stub_api):
+        """
+        Test a window that fails is tried again on its own
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        failing = "/AirQuality/Data/SiteSpecies/SiteCode=MY1/SpeciesCode=PM10/StartDate=2021-01-04/EndDate=2021-01-11/Json"
+        stub_api.failures[failing] = 2
+        data = monitoring.get_current_data(datetime.date(2021, 1, 1), datetime.date(2021, 1, 20), "MY1", 4)
+        assert stub_api.statuses.count(500) == 2
+        assert stub_api.paths.count(failing) == 3
+        assert len(stub_api.paths) == 14
+        assert data[100]['pm10'] == "PM10 2021-01-05 04"
+
+    def test_retries_exhausted(self, stub_api):
+        """
+        Test the error is raised when a window keeps failing
+        :param stub_api: Stub API fixture
+        :return: None
+        """
+        stub_api.failures["/AirQuality/Data/SiteSpecies/SiteCode=MY1/SpeciesCode=NO/StartDate=2021-01-01/EndDate=2021-01-02/Json"] = 10
+        with pytest.raises(requests.HTTPError):
+            monitoring.get_current_data(datetime.date(2021, 1, 1), datetime.date(2021, 1, 2), "MY1")
+        assert stub_api.statuses.count(500) == monitoring.CHUNK_RETRIES + 1
+
+
+class TestDateChunks:
+
+    @pytest.mark.parametrize(['start_date', 'end_date', 'days', 'expected'], [
+        (datetime.date(2021, 1, 4), datetime.date(2021, 1, 18), 7, [(datetime.date(2021, 1, 4), datetime.date(2021, 1, 11)),
+                                                                    (datetime.date(2021, 1, 11), datetime.date(2021, 1, 18))]),
+        (datetime.date(2021, 1, 6), datetime.date(2021, 1, 8), 7, [(datetime.date(2021, 1, 6), datetime.date(2021, 1, 8))]),
+        (datetime.date(2021, 1, 6), datetime.date(2021, 1, 6), 7, [(datetime.date(2021, 1, 6), datetime.date(2021, 1, 6))]),
+        (datetime.date(2021, 1, 1), datetime.date(2021, 1, 4), 1, [(datetime.date(2021, 1, 1), datetime.date(2021, 1, 2)),
+                                                                   (datetime.date(2021, 1, 2), datetime.date(2021, 1, 3)),
+                                                                   (datetime.date(2021, 1, 3), datetime.date(2021, 1, 4))])
+    ])
+    def test_expected(self, start_date, end_date, days, expected):
+        """
+        Test ranges are split into windows starting on the same days whatever the start date
+        :param start_date: First date
+        :param end_date: End date
+        :param days: Days in each window
+        :param expected: Expected windows
+        :return: None
+        """
+        assert monitoring.date_chunks(start_date, end_date, days) == expected
+
+
 class TestAddRow:
 
     @pytest.mark.parametrize(['element', 'column_info', 'wrap', 'col_max', 'expected'], [
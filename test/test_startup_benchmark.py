@@ -0,0 +1,25 @@
+import startup_benchmark
+
+
+class TestCustom:
+
+    class TestParseImportTimes:
+
+        def test_expected(self):
+            """
+            Test the self and cumulative times of each module are read from the importtime output
+            :return: None
+            """
+            text = "import time: self [us] | cumulative | imported package\n" \
+                   "import time:       437 |      77607 |     requests\n" \
+                   "import time:      4659 |     619079 | main\n" \
+                   "Some other output"
+            times = startup_benchmark.parse_import_times(text)
+            assert times == {"requests": (0.000437, 0.077607), "main": (0.004659, 0.619079)}
+
+        def test_empty(self):
+            """
+            Test no times are found in output without any import lines
+            :return: None
+            """
+            assert startup_benchmark.parse_import_times("") == {}
@@ -1,4 +1,5 @@
 import pytest
+import numpy as np
 import utils
 
 
@@ -42,6 +43,156 @@ class TestCustom:
             utils.remove_no_value(data)
             assert data == expected
 
+    class TestNoValueMask:
+
+        @pytest.mark.parametrize(['data', 'expected'], [
+            ([3, 'No data', '5.0'], [True, False, True]),
+            (np.array(['No data', '1.5']), [False, True]),
+            (np.array([1.0, 2.0]), [True, True]),
+            ([], [])
+        ])
+        def test_expected(self, data, expected):
+            """
+            Test that the mask marks 'No data' entries as False for lists and arrays
+            :param data: Data to make a mask for
+            :param expected: Expected mask
+            :return: None
+            """
+            assert utils.no_value_mask(data).tolist() == expected
+
+    class TestFilterNoValue:
+
+        @pytest.mark.parametrize(['data', 'expected'], [
+            (['3', '4.5', 'No data', 7], [3.0, 4.5, 7.0]),
+            (np.array(['No data', '2.25', 'No data']), [2.25]),
+            (['No data'], []),
+            ([], [])
+        ])
+        def test_expected(self, data, expected):
+            """
+            Test that 'No data' entries are dropped and the rest converted to floats
+            :param data: Data to filter
+            :param expected: Expected float values
+            :return: None
+            """
+            filtered = utils.filter_no_value(data)
+            assert filtered.dtype == float
+            assert filtered.tolist() == expected
+
+        def test_input_not_modified(self):
+            """
+            Test that the input list is left untouched
+            :return: None
+            """
+            data = ['1', 'No data', '2']
+            utils.filter_no_value(data)
+            assert data == ['1', 'No data', '2']
+
+    class TestFilterNoValueColumns:
+
+        def test_expected(self):
+            """
+            Test that every column is filtered in one call and the masks line up with the rows
+            :return: None
+            """
+            rows = [{'no': '1.5', 'pm10': 'No data'},
+                    {'no': 'No data', 'pm10': '4'},
+                    {'no': '2', 'pm10': '5'}]
+            filtered = utils.filter_no_value_columns(rows, ['no', 'pm10'])
+            assert filtered['no'][0].tolist() == [1.5, 2.0]
+            assert filtered['no'][1].tolist() == [True, False, True]
+            assert filtered['pm10'][0].tolist() == [4.0, 5.0]
+            assert filtered['pm10'][1].tolist() == [False, True, True]
+
+    class TestCountValues:
+        @pytest.mark.parametrize(["data", "xws", "expected"], [
+            ([5, 3, 7, 7, 8], None, {5: 1, 3: 1, 7: 2, 8: 1}),
+            ([2, 1, 2, 'No data', 'No data'], ['No data', 2, 9], {'No data': 2, 2: 2, 9: 0}),
+            ([], [1], {1: 0})
+        ])
+        def test_expected(self, data, xws, expected):
+            """
+            Test that every requested value is counted in one call
+            :param data: Data to count
+            :param xws: Values to count
+            :param expected: Expected counts
+            :return: None
+            """
+            assert utils.countvalues(data, xws) == expected
+
+    class TestCountValuesArray:
+        @pytest.mark.parametrize(["data", "xws", "expected"], [
+            (np.array([[0, 2, 2], [1, 0, 2]]), None, {0: 2, 1: 1, 2: 3}),
+            (np.array([-1, -1, 3]), [-1, 3, 4], {-1: 2, 3: 1, 4: 0}),
+            (np.array([1.5, 1.5, 0.25]), [1.5], {1.5: 2}),
+            (np.array([1000000, 1]), None, {1: 1, 1000000: 1})
+        ])
+        def test_expected(self, data, xws, expected):
+            """
+            Test the array counter on integer, negative and float arrays
+            :param data: Array to count
+            :param xws: Values to count
+            :param expected: Expected counts
+            :return: None
+            """
+            assert utils.countvalues_array(data, xws) == expected
+
+    class TestHistogram:
+        @pytest.mark.parametrize(["data", "bin_edges", "expected"], [
+            ([0, 1, 2, 3, 4], [0, 2, 4], [2, 3]),
+            (['1', 'No data', '5', '10'], [0, 5, 10], [1, 2]),
+            ([0, 1, 2, 3], 3, [1, 1, 2]),
+            ([-5, 50], [0, 10], [0]),
+            ([5, 5, 5], 3, [0, 3, 0]),
+            (np.array([2.5]), 1, [1])
+        ])
+        def test_expected(self, data, bin_edges, expected):
+            """
+            Test values are put into the correct bins, the last bin includes its right edge
+            :param data: Data to count
+            :param bin_edges: Number of bins or bin edges
+            :param expected: Expected count per bin
+            :return: None
+            """
+            counts, edges = utils.histogram(data, bin_edges)
+            assert counts.tolist() == expected
+
+        def test_bad_edges(self):
+            """
+            Test that non-increasing bin edges raise a ValueError
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                utils.histogram([1, 2], [2, 1])
+
+
+    class TestKahanSum:
+        @pytest.mark.parametrize(["data", "expected"], [
+            ([1.0, 1e100, 1.0, -1e100], 2.0),
+            ([0.1] * 10, 1.0),
+            ([], 0)
+        ])
+        def test_expected(self, data, expected):
+            """
+            Test compensated summation recovers the bits lost by naive addition
+            :param data: Data to sum
+            :param expected: Exact sum
+            :return: None
+            """
+            assert utils.kahan_sum(data) == expected
+
+    class TestPairwiseSum:
+        @pytest.mark.parametrize(["workers", "chunk_size"], [(1, 1000), (2, 3), (None, 1)])
+        def test_expected(self, workers, chunk_size):
+            """
+            Test the chunked parallel sum gives the same result as a single sum
+            :param workers: Number of threads
+            :param chunk_size: Values per chunk
+            :return: None
+            """
+            data = np.arange(1, 11) / 10
+            assert utils.pairwise_sum(data, workers, chunk_size) == pytest.approx(5.5)
+
 
 class TestTemplate:
 
@@ -62,6 +213,32 @@ class TestTemplate:
             """
             assert utils.sumvalues(data) == expected
 
+        @pytest.mark.parametrize("method", ["naive", "kahan", "pairwise"])
+        def test_methods(self, method):
+            """
+            Test each summation method sums lists and numpy arrays
+            :param method: Summation method
+            :return: None
+            """
+            assert utils.sumvalues([1.25, 2, 3.75], method) == 7
+            assert utils.sumvalues(np.array([1.5, 2.5]), method) == 4
+
+        def test_unknown_method(self):
+            """
+            Test an unknown method raises a ValueError
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                utils.sumvalues([1, 2], "unknown")
+
+        def test_non_numeric_array(self):
+            """
+            Test a numpy array of strings is rejected
+            :return: None
+            """
+            with pytest.raises(ValueError):
+                utils.sumvalues(np.array(['1', '2']))
+
     class TestMeanValue:
         @pytest.mark.parametrize(["data", "expected"], [
             ([5, 3, 4, 7, 8], 5.4),
@@ -84,7 +261,9 @@ class TestTemplate:
             ([5, 3, 4, 7, 8], 4),
             ([0, 0], 0),
             ([-2, -3], 0),
-            ([1.25, 2, 3.75], 2)
+            ([1.25, 2, 3.75], 2),
+            (np.array([5, 3, 8, 7, 8]), 2),
+            (np.array([1.25, 2, 3.75]), 2)
         ])
         def test_expected(self, data, expected):
             """
@@ -108,7 +287,9 @@ class TestTemplate:
             ([5, 3, 4, 7, 8], 1),
             ([0, 0], 0),
             ([-2, -3], 1),
-            ([1.25, 2, 3.75], 0)
+            ([1.25, 2, 3.75], 0),
+            (np.array([5, 3, 4, 3, 8]), 1),
+            (np.array([1.25, 2, 3.75]), 0)
         ])
         def test_expected(self, data, expected):
             """
@@ -1,7 +1,10 @@
 # This is a template. 
 # You should modify the functions below to match
 # the signatures determined by the project specification
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
+import math
+import os
 import numpy as np
 
 # -------------------------
@@ -20,7 +23,8 @@ def check_numeric(values: Union[list, np.array], exception_message: str):
     ---------------
     General Overview
     ---------------
-    For each element in the input data
+    If the input is a numpy array, check its dtype is an int or float type
+    Otherwise, for each element in the input data
     If the data type is not int or float
     Raise an exception
 
@@ -34,33 +38,211 @@ def check_numeric(values: Union[list, np.array], exception_message: str):
     :return: None
     """
 
+    # Numpy arrays hold a single type so only the dtype needs checking
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind not in "iuf":
+            raise ValueError(exception_message)
+        return
+
     # For each element in values, convert it to a string can check if it is numeric
     for element in values:
         if type(element) != int and type(element) != float:
             raise ValueError(exception_message)
 
 
+def kahan_sum(values: Union[list, np.ndarray]) -> float:
+    """
+    ---------------
+    Description
+    ---------------
+    Sums the input values using compensated (Kahan-Babuska/Neumaier) summation
+    The rounding error of every addition is tracked and added back at the end,
+    so the result does not drift when summing millions of values
+
+    ---------------
+    General Overview
+    ---------------
+    For each value
+    Add it to the running sum
+    Work out the low order bits lost by that addition and add them to a compensation term
+    Return the sum plus the compensation
+
+    :param values: List/array of numeric values to sum
+    :return: Compensated sum of the values
+    """
+
+    total = 0.0
+    compensation = 0.0
+    for element in values:
+        element = float(element)
+        new_total = total + element
+        # Whichever of the two is larger in magnitude keeps its bits, the smaller one loses some
+        if abs(total) >= abs(element):
+            compensation += (total - new_total) + element
+        else:
+            compensation += (element - new_total) + total
+        total = new_total
+
+    return total + compensation
+
+
+def pairwise_sum(values: Union[list, np.ndarray], workers: int = 1, chunk_size: int = 1_000_000) -> float:
+    """
+    ---------------
+    Description
+    ---------------
+    Sums the input values using numpy's pairwise summation, whose error grows with log(n) instead of n
+    Large arrays can be split into chunks that are summed on a thread pool,
+    numpy releases the GIL while summing so the chunks really do run in parallel
+
+    ---------------
+    General Overview
+    ---------------
+    Convert the values to a float array
+    If only one worker is used or the array fits in one chunk, sum it with numpy
+    Otherwise split it into chunks, sum each chunk on the thread pool
+    Add the partial sums together exactly
+
+    :param values: List/array of numeric values to sum
+    :param workers: Number of threads to use, None uses one per CPU
+    :param chunk_size: Number of values in each chunk given to a thread
+    :return: Sum of the values
+    """
+
+    values = np.asarray(values, dtype=float).ravel()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or values.size <= chunk_size:
+        return float(np.sum(values))
+
+    chunks = [values[i:i + chunk_size] for i in range(0, values.size, chunk_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partial_sums = list(executor.map(np.sum, chunks))
+
+    # There are only a handful of partial sums so an exact sum of them is cheap
+    return math.fsum(partial_sums)
+
+
 def remove_no_value(data: list):
     """
     ---------------
     Description
     ---------------
     Removes all 'No data' values from the input data
+    The list is modified in place, see filter_no_value for a version that leaves the input untouched
 
     ---------------
     General Overview
     ---------------
-    For each element in the data
-    If it is 'No data'
-    Remove it from the list
+    Build a new list of the elements that are not 'No data'
+    Replace the contents of the input list with it
 
     :param data: Data to remove 'No data' entries from
     :return: None
     """
 
-    for element in data.copy():
-        if element == "No data":
-            data.remove(element)
+    # Slice assignment keeps the same list object so callers holding a reference see the change
+    # Rebuilding the list in one pass avoids calling list.remove (which is O(n)) for every 'No data' entry
+    data[:] = [element for element in data if element != "No data"]
+
+
+def no_value_mask(data: Union[list, np.ndarray]) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Returns a boolean mask that is True wherever the input data holds a value that is not 'No data'
+    The input data is not modified
+
+    ---------------
+    General Overview
+    ---------------
+    If the input is a numpy array compare it against 'No data' in one vectorised operation
+    Otherwise compare each element in a single pass
+
+    :param data: List/array of values that may contain 'No data' entries
+    :return: Boolean numpy array the same length as data
+    """
+
+    # String arrays can be compared in one go
+    if isinstance(data, np.ndarray) and data.dtype.kind in "UO":
+        return np.asarray(data != "No data", dtype=bool)
+    # Numeric arrays cannot contain 'No data'
+    if isinstance(data, np.ndarray):
+        return np.ones(data.shape[0], dtype=bool)
+
+    return np.fromiter((element != "No data" for element in data), dtype=bool, count=len(data))
+
+
+def filter_no_value(data: Union[list, np.ndarray]) -> np.ndarray:
+    """
+    ---------------
+    Description
+    ---------------
+    Returns the values in the input data that are not 'No data' as a compact float array
+    Unlike remove_no_value this does not modify the input and runs in linear time
+
+    ---------------
+    General Overview
+    ---------------
+    Find which entries are not 'No data'
+    Convert just those entries to floats
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when an entry other than 'No data' cannot be converted to a float
+
+    :param data: List/array of values that may contain 'No data' entries
+    :return: 1d float numpy array of the valid values, in their original order
+    """
+
+    if isinstance(data, np.ndarray):
+        return data[no_value_mask(data)].astype(float)
+
+    return np.fromiter((float(element) for element in data if element != "No data"), dtype=float)
+
+
+def filter_no_value_columns(rows: list[dict], columns: list[str]) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Bulk version of filter_no_value that handles several columns of a station's data at once
+    Each row is visited a single time, regardless of how many columns are asked for
+
+    ---------------
+    General Overview
+    ---------------
+    Create a float array and a mask with a column for each requested key
+    For each row, write the value of each column in and mark it as valid unless it is 'No data'
+    Split the arrays back into columns and drop the invalid entries
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when an entry other than 'No data' cannot be converted to a float
+
+    :param rows: List of dicts, e.g. the data for one monitoring station as returned by main.read_file
+    :param columns: Keys of the columns to filter, e.g. ['no', 'pm10', 'pm25']
+    :return: Dictionary of column key -> (float array of valid values, boolean mask of valid rows)
+    """
+
+    table = np.zeros((len(rows), len(columns)))
+    valid = np.zeros((len(rows), len(columns)), dtype=bool)
+    for i, row in enumerate(rows):
+        for j, column in enumerate(columns):
+            value = row[column]
+            if value != "No data":
+                table[i, j] = float(value)
+                valid[i, j] = True
+
+    filtered = {}
+    for j, column in enumerate(columns):
+        filtered[column] = (table[valid[:, j], j], valid[:, j])
+
+    return filtered
 
 
 # -------------------------
@@ -68,7 +250,7 @@ def remove_no_value(data: list):
 # -------------------------
 
 
-def sumvalues(values):
+def sumvalues(values, method: str = "naive", workers: int = 1):
     """
     ---------------
     Description
@@ -76,25 +258,41 @@ def sumvalues(values):
     Will take an input list/array and sum all the values in it
     Raises ValueError exception if a non-numeric value is present in the input
 
+    The method used to add the values up can be chosen:
+    • naive - Add each value to a running total, left to right
+    • kahan - Compensated summation, see kahan_sum
+    • pairwise - Numpy pairwise summation, optionally in parallel chunks, see pairwise_sum
+
     ---------------
     General Overview
     ---------------
     Check for non-numeric values
-    For each value in the data
+    If a stable method was chosen, use it
+    Otherwise for each value in the data
     Add it to a sum variable
 
     ---------------
     Raises
     ---------------
     ValueError when a non-numeric character is present
+    ValueError when the method is not one of the above
 
     :param values: List/array that will contain the values to sum
+    :param method: Summation method to use, one of 'naive', 'kahan' or 'pairwise'
+    :param workers: Number of threads the pairwise method can use, None uses one per CPU
     :return: Sum of the values in the values parameter
     """
 
     # Check for non-numeric values
     check_numeric(values, "Cannot sum non-numeric values")
 
+    if method == "kahan":
+        return kahan_sum(values)
+    elif method == "pairwise":
+        return pairwise_sum(values, workers)
+    elif method != "naive":
+        raise ValueError(f"Unknown summation method: {method}")
+
     # Holds the current sum value
     sum = 0
     # For each element in values, add its value to the sum value
@@ -135,6 +333,9 @@ def maxvalue(values):
     # Check for no values
     if len(values) == 0:
         raise ValueError("No values present to find maximum for")
+    # Numpy arrays have no index method, argmax gives the first index of the largest value the same as index does
+    if isinstance(values, np.ndarray):
+        return int(np.argmax(values))
 
     # Holds the current maximum value found in the input
     current_max = values[0]
@@ -178,6 +379,9 @@ def minvalue(values):
     # Check for no values
     if len(values) == 0:
         raise ValueError("No values present to find minimum for")
+    # Numpy arrays have no index method, argmin gives the first index of the smallest value the same as index does
+    if isinstance(values, np.ndarray):
+        return int(np.argmin(values))
 
     # Holds the current minimum value found in the input
     # Set to the first element of values to start
@@ -261,3 +465,120 @@ def countvalue(values, xw):
 
     return xw_count
 
+
+def countvalues(values, xws: Union[list, None] = None) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Finds the number of instances of many values in the input list/array in a single pass
+    Bulk version of countvalue, works with any hashable values (including 'No data')
+
+    ---------------
+    General Overview
+    ---------------
+    For each value
+    Add one to the counter for that value
+    If only some values were asked for, return the counters for just those values
+
+    :param values: List/array of values to count
+    :param xws: Values to count the number of instances of, if None every distinct value is counted
+    :return: Dictionary of value -> number of instances
+    """
+
+    # Holds the number of occurrences of each value found so far
+    counts = {}
+    for element in values:
+        counts[element] = counts.get(element, 0) + 1
+
+    if xws is None:
+        return counts
+
+    # Values that never appeared have a count of 0
+    return {xw: counts.get(xw, 0) for xw in xws}
+
+
+def countvalues_array(values: np.ndarray, xws: Union[list, None] = None) -> dict:
+    """
+    ---------------
+    Description
+    ---------------
+    Array version of countvalues that does the counting in numpy
+    Arrays of any dimension are counted over every element
+
+    ---------------
+    General Overview
+    ---------------
+    If the array holds non-negative integers, count with bincount
+    Otherwise count with unique
+    If only some values were asked for, return the counts for just those values
+
+    :param values: Numpy array of values to count
+    :param xws: Values to count the number of instances of, if None every distinct value is counted
+    :return: Dictionary of value -> number of instances
+    """
+
+    values = np.asarray(values).ravel()
+
+    # bincount is a single O(n) pass but needs an array as long as the largest value
+    # so it is only used when the values are small non-negative integers
+    if values.dtype.kind in "ui" and values.size > 0 and values.min() >= 0 and values.max() <= 4 * values.size:
+        bins = np.bincount(values)
+        present = np.flatnonzero(bins)
+        counts = dict(zip(present.tolist(), bins[present].tolist()))
+    else:
+        unique, unique_counts = np.unique(values, return_counts=True)
+        counts = dict(zip(unique.tolist(), unique_counts.tolist()))
+
+    if xws is None:
+        return counts
+
+    return {xw: counts.get(xw, 0) for xw in xws}
+
+
+def histogram(values: Union[list, np.ndarray], bin_edges: Union[int, list, np.ndarray] = 10) -> tuple:
+    """
+    ---------------
+    Description
+    ---------------
+    Counts how many values fall into each range of values in one pass
+    'No data' entries are ignored
+
+    ---------------
+    General Overview
+    ---------------
+    Drop 'No data' entries and convert to floats
+    If a number of bins was given, split the range of the data into that many equal bins
+    (the range is widened by 0.5 either side when every value is the same, as numpy does)
+    Find the bin for every value and count them
+
+    ---------------
+    Raises
+    ---------------
+    ValueError when the bin edges are not increasing
+
+    :param values: List/array of values to count
+    :param bin_edges: Number of equal width bins, or the edges of the bins (the last bin includes its right edge)
+    :return: Tuple of (count in each bin, bin edges)
+    """
+
+    values = filter_no_value(values)
+
+    if isinstance(bin_edges, int):
+        if values.size == 0:
+            bin_edges = np.linspace(0, 1, bin_edges + 1)
+        elif values.min() == values.max():
+            bin_edges = np.linspace(values.min() - 0.5, values.max() + 0.5, bin_edges + 1)
+        else:
+            bin_edges = np.linspace(values.min(), values.max(), bin_edges + 1)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    if np.any(np.diff(bin_edges) <= 0):
+        raise ValueError("Bin edges must be increasing")
+
+    # Bins are half open [left, right) apart from the last which also includes its right edge
+    in_range = (values >= bin_edges[0]) & (values <= bin_edges[-1])
+    bin_index = np.searchsorted(bin_edges, values[in_range], side="right") - 1
+    bin_index[bin_index == len(bin_edges) - 1] -= 1
+    counts = np.bincount(bin_index, minlength=len(bin_edges) - 1)
+
+    return counts, bin_edges